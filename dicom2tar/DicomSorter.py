@@ -11,17 +11,150 @@ Note:
 '''
 
 import os
-import tarfile
-import zipfile
+import io
+import stat
 import shutil
 import tempfile
 import uuid
 import logging
 import subprocess
-from collections import defaultdict
+import shlex
+import threading
+import functools
+import itertools
+import hashlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+except ImportError:
+    # python 2
+    import Queue as queue
+from collections import defaultdict, namedtuple, OrderedDict
+
+import dicom_header
+import archive_stream
+import cmrr_physio
+import parallel_compress
+import manifest
+import group_store
+import tar_writers
+import sort_plan
+import shards
+from placement import place, PLACEMENTS
+import stage_stats
+
+
+# members of compressed files sent to the process pool at a time, at most this many bytes
+MEMBER_BATCH_BYTES = 64 * 1024 * 1024
+
+# a tar failed to write, returned by DicomSorter.tar() instead of aborting the run
+TarError = namedtuple('TarError', ['tar_full_filename', 'error'])
+
+
+def _command_args(command):
+    '''
+    an unwrapper's command as an argument list: a list is used as is, a str is split as a shell would.
+    on windows the split keeps backslashes(C:\\tools\\dicomunwrap.exe), and drops the quotes around an argument
+    '''
+    if isinstance(command, (list, tuple)):
+        return list(command)
+
+    if os.name != 'nt':
+        return shlex.split(command)
+
+    return [arg[1:-1] if len(arg) > 1 and arg[0] == arg[-1] and arg[0] in '"\'' else arg
+            for arg in shlex.split(command, posix=False)]
+
+
+def _apply_sort_rule(full_filename, sort_rule_function, args, fileobj=None, preambleless='reject'):
+    '''
+    read full_filename's header once, apply sort rule
+
+    module level, so it can run in a multiprocessing pool
+
+    input:
+        full_filename: full path filename, or archive_stream.ArchiveMember
+        fileobj: full_filename's content if it is an archive_stream.ArchiveMember
+        preambleless: see dicom_header.is_dicom
+
+    output:
+        [full_filename, sorted_relative_path_filename, header], or None if sort_rule_function returns None,
+        or False if full_filename is rejected as non-dicom before parsing
+    '''
+    logger = logging.getLogger(__name__)
 
-import pydicom
-import extractCMRRPhysio
+    # clear non-dicom: skipped without calling pydicom
+    try:
+        if not dicom_header.is_dicom(str(full_filename), fileobj, preambleless):
+            return False
+    except (IOError, OSError):
+        return False
+
+    read_header_kwargs = getattr(
+        sort_rule_function, 'read_header_kwargs', {})
+
+    # non-dicom or bad dicom: leave it to sort_rule_function
+    try:
+        header = dicom_header.read_header(
+            str(full_filename), fileobj=fileobj, **read_header_kwargs)
+    except Exception:
+        header = None
+
+    # a member of a compressed file has no filename sort_rule_function could read
+    if header is None and fileobj is not None:
+        logger.info('{} is not a dicom file, skipped'.format(full_filename))
+        return None
+
+    try:
+        sorted_relative_path_filename = sort_rule_function(
+            header or full_filename, args)
+    except Exception as e:
+        logger.exception(e)
+        return None
+
+    # apply sort_rule_function on non-dicom or bad dicom return None
+    if sorted_relative_path_filename is None:
+        return None
+
+    # drop the dataset, only the record is kept
+    if header is not None and header.dataset is not None:
+        header = header._replace(dataset=None)
+
+    return [full_filename, sorted_relative_path_filename, header]
+
+
+def _apply_sort_rule_collecting(full_filename, sort_rule_function, args, preambleless='reject'):
+    '''
+    _apply_sort_rule in a worker process, for a sort_rule_function with a collector(see
+    clinical_collector.ClinicalCollector): the rows it collected on this file are returned with the result,
+    the main process updates its sort_rule_function.collector with them
+
+    output:
+        (_apply_sort_rule's result, sort_rule_function.collector.drain())
+    '''
+    result = _apply_sort_rule(full_filename, sort_rule_function,
+                              args, preambleless=preambleless)
+    return result, sort_rule_function.collector.drain()
+
+
+def _apply_sort_rule_to_member(member_data, sort_rule_function, args, preambleless='reject', collecting=False):
+    '''
+    _apply_sort_rule on a member of a compressed file read by the main process, in a worker process
+
+    input:
+        member_data: (archive_stream.ArchiveMember, its content, bytes)
+        collecting: see _apply_sort_rule_collecting
+
+    output:
+        _apply_sort_rule's result, or (result, sort_rule_function.collector.drain()) if collecting
+    '''
+    member, data = member_data
+    result = _apply_sort_rule(member, sort_rule_function,
+                              args, io.BytesIO(data), preambleless)
+    if collecting:
+        return result, sort_rule_function.collector.drain()
+    return result
 
 
 class DicomSorter():
@@ -29,7 +162,8 @@ class DicomSorter():
     Extract compressed files(if any), sort dicom files, or tar the sorted, to a destination directory.
 
     Given a dicom directory:
-        1. Find compressed files(if any) recursively, extract them temporally. Support formats:.  zip, .tgz, .tar.gz, tar.bz2
+        1. Find compressed files(if any) recursively, extract them temporally(or read them in memory, with
+           stream_archives). Support formats:.  zip, .tgz, .tar.gz, tar.bz2
         2. Find dicom files recursively, sort(organizing and renaming) them, according to a given 'sort_rule_function',
         3. Sort or Tar the sorted dicom files to a destination directory.
 
@@ -43,11 +177,70 @@ class DicomSorter():
         extract_to_dir:
             extract compressed files to this directory temporally, default is platform's temp dir.
         dicomunwrap_path:
-            path to dicomunwrap
+            path to dicomunwrap, a command line(str, split as a shell would, backslashes kept on windows) or an
+            argument list. the same for simens_cmrr_mb_unwrap_path
+        jobs:
+            number of processes reading dicom headers, 1: no process pool, 0: one per cpu
+        chunksize:
+            number of files sent to a process at a time
+        tar_jobs:
+            number of tars written at the same time, largest first
+        unwrap_jobs:
+            number of non-imaging dicom files unwrapped at the same time
+        unwrap_timeout:
+            seconds an unwrapper(dicomunwrap/extractCMRRPhysio) may run, None: no limit
+        in_process_physio:
+            extract siemens CMRR MB physio with cmrr_physio in this process, simens_cmrr_mb_unwrap_path is the
+            fallback
+        preambleless:
+            files without the 128 bytes preamble and 'DICM', see dicom_header.is_dicom. 'reject', 'sniff' or 'parse',
+            default: 'parse' if sort_rule_function reads with force=True, otherwise 'reject'
+        dedup:
+            drop duplicate instances before writing, e.g. the same file loose and inside a .zip.
+            None: keep all, 'SOPInstanceUID': same SOPInstanceUID(or same sorted filename if missing),
+            'sorted': same sorted relative filename
+        dedup_verify:
+            compare duplicates' content(sha1), conflicting duplicates are kept and logged, each under its sorted
+            filename suffixed with its sha1(name.conflict_1a2b3c4d.dcm), so a tar has no two members of one name
+        manifest_filename:
+            sqlite manifest of input files, for incremental tar(): only changed files are parsed, only tars
+            whose files changed are rewritten. implies stream_archives. sort() doesn't use it
+        stream_archives:
+            read compressed files' members in memory, instead of extracting them to extract_to_dir.
+            only non-imaging members, for dicomunwrap/extractCMRRPhysio, are written to extract_to_dir
+        compression:
+            compress tars(and .attached.tars), None, 'gz'(*.tar.gz) or 'bz2'(*.tar.bz2)
+        compress_jobs:
+            number of threads compressing blocks of one tar, see parallel_compress
+        group_memory_limit:
+            bytes, tar() groups scan results as they come, held compactly and spilled to disk past this limit,
+            so memory doesn't grow with the number of files. dedup is done within each tar.
+            None: whole scan results in memory. not with manifest_filename
+        stream_tar:
+            tar() appends each file to its tar right after the sort rule, on a writer thread, while the scan goes on.
+            not with manifest_filename, group_memory_limit or compression
+        max_open_tars:
+            stream_tar: number of tars kept open, the least recently used is closed and reopened for appending
+        shard:
+            (i, N): tar() and execute() write only the tars of shard i of N, see shards.shard_of. every shard scans
+            all files. None: all tars. not with manifest_filename
+        pool:
+            a multiprocessing.Pool owned by the caller, kept warm across DicomSorters(e.g. main's --watch),
+            used instead of creating a pool of jobs processes. not closed by DicomSorter
+        placement:
+            how sort() places each file, 'copy', 'hardlink', 'symlink', 'reflink' or 'move', see placement.
+            hardlink/reflink fall back to a copy where not possible. 'move' takes the files out of dicom_dir
+        profile_filename:
+            run the scan(header parsing and sort rule) under cProfile, dump it to this pstats file.
+            with jobs > 1 the sort rule runs in worker processes, which are not profiled.
+            the scan's and unwrap's bytes_read(an os.stat per file) are measured only if set
+        stats:
+            stage_stats.StageStats, wall time, file count, bytes read and written of each stage
 
     methods:
         tar()
         sort()
+        plan(), execute(): tar() in two steps, see sort_plan
 
     Note:
         When extract larger compressed files on a platform, like sharcnet, with limit storage capacity temp folder,
@@ -56,7 +249,12 @@ class DicomSorter():
     '''
 
     def __init__(self, dicom_dir, sort_rule_function, output_dir, args,
-                 extract_to_dir='', dicomunwrap_path='dicomunwrap', simens_cmrr_mb_unwrap_path='extractCMRRPhysio'):
+                 extract_to_dir='', dicomunwrap_path='dicomunwrap', simens_cmrr_mb_unwrap_path='extractCMRRPhysio',
+                 jobs=1, chunksize=64, stream_archives=False, tar_jobs=1, unwrap_jobs=1, preambleless=None,
+                 manifest_filename=None, dedup=None, dedup_verify=False, unwrap_timeout=None,
+                 in_process_physio=True, compression=None, compress_jobs=1,
+                 profile_filename=None, placement='copy', group_memory_limit=None,
+                 stream_tar=False, max_open_tars=64, pool=None, shard=None):
         '''
         init DicomSorter
         '''
@@ -90,6 +288,88 @@ class DicomSorter():
         self.dicomunwrap_path = dicomunwrap_path
 
         self.simens_cmrr_mb_unwrap_path = simens_cmrr_mb_unwrap_path
+        self.in_process_physio = in_process_physio
+
+        # jobs, default is no process pool
+        if jobs < 1:
+            jobs = multiprocessing.cpu_count()
+        self.jobs = jobs
+        self.chunksize = max(1, chunksize)
+        self.tar_jobs = max(1, tar_jobs)
+        self.unwrap_jobs = max(1, unwrap_jobs)
+        self.unwrap_timeout = unwrap_timeout
+
+        # preambleless, default follows how sort_rule_function reads headers
+        if preambleless is None:
+            read_header_kwargs = getattr(
+                sort_rule_function, 'read_header_kwargs', {})
+            preambleless = 'parse' if read_header_kwargs.get(
+                'force') else 'reject'
+        if preambleless not in dicom_header.PREAMBLELESS_MODES:
+            raise ValueError(
+                'preambleless must be one of {}'.format(dicom_header.PREAMBLELESS_MODES))
+        self.preambleless = preambleless
+
+        # number of files rejected as non-dicom, without parsing
+        self.non_dicom_count = 0
+
+        if dedup not in (None, 'SOPInstanceUID', 'sorted'):
+            raise ValueError(
+                "dedup must be one of None, 'SOPInstanceUID', 'sorted'")
+        self.dedup = dedup
+        self.dedup_verify = dedup_verify
+
+        # number of duplicates dropped, [(kept, conflicting duplicate), ...]
+        self.duplicate_count = 0
+        self.duplicate_conflicts = []
+
+        # manifest, incremental tar(). a compressed file is tracked as a whole, its members are streamed
+        if manifest_filename:
+            self.manifest = manifest.Manifest(manifest_filename)
+        else:
+            self.manifest = None
+
+        # stream_archives: compressed files are kept open while tar() or sort() reads their members
+        self.stream_archives = stream_archives or self.manifest is not None
+        self._archive_reader = archive_stream.ArchiveReader()
+
+        if compression not in parallel_compress.COMPRESSION_EXTS:
+            raise ValueError(
+                'compression must be one of None, {}'.format(parallel_compress.COMPRESSIONS))
+        self.compression = compression
+        self.compress_jobs = max(1, compress_jobs)
+        self._tar_ext = ".tar" + parallel_compress.COMPRESSION_EXTS[compression]
+
+        if group_memory_limit is not None and self.manifest is not None:
+            raise ValueError(
+                'group_memory_limit is not supported with manifest_filename')
+        self.group_memory_limit = group_memory_limit
+
+        if stream_tar and (self.manifest is not None or group_memory_limit is not None or compression is not None):
+            raise ValueError(
+                'stream_tar is not supported with manifest_filename, group_memory_limit or compression')
+        self.stream_tar = stream_tar
+        self.max_open_tars = max_open_tars
+
+        self.pool = pool
+        # the process pool created for the scan if jobs > 1 and no pool is given, closed at exit
+        self._own_pool = None
+
+        # shards write to the same output_dir, a shared manifest would be written by all of them
+        if shard is not None and self.manifest is not None:
+            raise ValueError('shard is not supported with manifest_filename')
+        self.shard = shard
+
+        if placement not in PLACEMENTS:
+            raise ValueError(
+                'placement must be one of {}'.format(PLACEMENTS))
+        self.placement = placement
+
+        # per stage instrumentation, cProfile of the scan if profile_filename
+        self.stats = stage_stats.StageStats('scan', profile_filename)
+        if profile_filename and self.jobs > 1:
+            self.logger.warning(
+                'profiling the scan in this process only, use jobs=1 to profile the sort rule')
 
     def _generate_uniq_string(self):
         '''
@@ -97,12 +377,13 @@ class DicomSorter():
         '''
         return str(uuid.uuid4())
 
-    def _check_non_imaging_and_unwrap(self, filename):
+    def _check_non_imaging_and_unwrap(self, filename, header=None):
         '''
         check if the dicom file is non-imaging data(MRS, Physio,...), and unwrap it.
 
         input:
             filename: full path of dicom file
+            header: filename's dicom_header.DicomHeader if already read, avoid reading filename again
 
         output:
             None: if filename is a imaging dicom file
@@ -110,46 +391,49 @@ class DicomSorter():
 
         '''
         try:
-            dataset = pydicom.read_file(filename, stop_before_pixels=True)
-
-            # dicomraw wrapped (wrapped by Igor's script)
-            is_dicomraw_wrapped = \
-                (0x0177, 0x0010) in dataset and \
-                dataset[(0x0177, 0x0010)].value.startswith('Robarts^CFMM')
+            if header is None:
+                header = dicom_header.read_header(filename)
 
-            # siemens CMRR MB sequence
-            is_siemens_CMRR_MB_sequance = \
-                "ImageType" in dataset and \
-                dataset.ImageType == ['ORIGINAL', 'PRIMARY', 'RAWDATA', 'PHYSIO'] and \
-                (0x7fe1, 0x0010) in dataset and \
-                str(dataset[(0x7fe1, 0x0010)].value).strip(
-                ) == 'SIEMENS CSA NON-IMAGE'
+            if not header.is_non_imaging:
+                return None
 
+            # basename+uniq_string: unwrapping runs concurrently, avoid same file names overwrite
             output_directory = os.path.join(
-                self._unwrap_to_dir_uniq, os.path.basename(filename))
+                self._unwrap_to_dir_uniq, os.path.basename(str(filename)) + self._generate_uniq_string())
 
             if not os.path.exists(output_directory):
                 os.makedirs(output_directory)
 
-            if is_dicomraw_wrapped:
+            # siemens CMRR MB sequence: in-process first, no interpreter start per file
+            if header.is_siemens_CMRR_MB_physio and self.in_process_physio:
+                if self._unwrap_cmrr_physio_in_process(filename, output_directory, header):
+                    return output_directory
+
+                self.logger.info('falling back to {} for {}'.format(
+                    self.simens_cmrr_mb_unwrap_path, filename))
+
+            # streamed from a compressed file: only non-imaging members are written to disk
+            if isinstance(filename, archive_stream.ArchiveMember):
+                filename = self._extract_member(filename)
+
+            if header.is_dicomraw_wrapped:
                 # unwrap command:
                 # ./bin/dicomunwrap --input_file=/path/to/file.dcm --output_directory=/out/dir --decompress
-                cmd = '{} '.format(self.dicomunwrap_path) +\
-                    '--input_file={} '.format(filename) +\
-                    '--output_directory={} '.format(output_directory) +\
-                    '--decompress'
+                cmd = _command_args(self.dicomunwrap_path) + [
+                    '--input_file={}'.format(filename),
+                    '--output_directory={}'.format(output_directory),
+                    '--decompress']
 
-                subprocess.check_call(cmd, shell=True)
+                self._run_unwrap_command(cmd)
                 return output_directory
 
-            elif is_siemens_CMRR_MB_sequance:
+            elif header.is_siemens_CMRR_MB_physio:
                 # unwrap command:
                 # python extract_cmrr_physio.py  /path/to/file.dcm /out/dir
-                cmd = '{} '.format(self.simens_cmrr_mb_unwrap_path) +\
-                    '{} '.format(filename) +\
-                    '{} '.format(output_directory)
+                cmd = _command_args(self.simens_cmrr_mb_unwrap_path) + [
+                    filename, output_directory]
 
-                subprocess.check_call(cmd, shell=True)
+                self._run_unwrap_command(cmd)
 
                 return output_directory
 
@@ -160,9 +444,76 @@ class DicomSorter():
             self.logger.exception(e)
             return None
 
+    def _unwrap_cmrr_physio_in_process(self, filename, output_directory, header=None):
+        '''
+        extract siemens CMRR MB physio log files with cmrr_physio
+
+        input:
+            filename: full path of dicom file, or archive_stream.ArchiveMember, read in memory
+            output_directory: write *.log files to it
+            header: filename's dicom_header.DicomHeader, its dataset is used if it has the physio data
+
+        output:
+            True if log files were written
+        '''
+        try:
+            if header is not None and header.dataset is not None and \
+                    cmrr_physio.PHYSIO_DATA_TAG in header.dataset:
+                dataset = header.dataset
+            elif isinstance(filename, archive_stream.ArchiveMember):
+                dataset = cmrr_physio.read_physio_dataset(
+                    str(filename), self._archive_reader.open(filename))
+            else:
+                # the scan's header record has no dataset, only the physio tags are read
+                dataset = cmrr_physio.read_physio_dataset(filename)
+
+            log_filenames = cmrr_physio.unwrap(dataset, output_directory)
+        except Exception as e:
+            self.logger.warning('{}: physio not extracted in process, {}: {}'.format(
+                filename, type(e).__name__, e))
+            return False
+
+        return bool(log_filenames)
+
+    def _run_unwrap_command(self, cmd):
+        '''
+        run an unwrapper as an argument list, without a shell. kill it after unwrap_timeout seconds
+
+        input:
+            cmd: argument list
+
+        raise:
+            subprocess.CalledProcessError if it fails, RuntimeError if it times out
+        '''
+        process = subprocess.Popen(cmd)
+
+        # threading.Timer instead of wait(timeout=...): compatible with python 2
+        timed_out = []
+
+        def kill():
+            timed_out.append(True)
+            process.kill()
+
+        timer = None
+        if self.unwrap_timeout:
+            timer = threading.Timer(self.unwrap_timeout, kill)
+            timer.start()
+        try:
+            returncode = process.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        if timed_out:
+            raise RuntimeError('{} timed out after {} seconds'.format(
+                ' '.join(cmd), self.unwrap_timeout))
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
     def sort(self):
         '''
-        copy(organizing and renaming) dicom files into hierarchical directories
+        place(copy, hardlink, symlink, reflink or move, see placement) dicom files into hierarchical
+        directories, organizing and renaming them
 
         output:
             tar_full_filename_list: list of resulted tar filenames
@@ -172,69 +523,96 @@ class DicomSorter():
 
         '''
         ######
-        # extract compressed files if any
-        ######
-        self._walk_and_extract(
-            self.dicom_dir, self._compressed_exts, self._extract_to_dir_uniq)
-
-        # add _extract_to_dir_uniq directory in the search directories
-        dicom_dirs = [self.dicom_dir, self._extract_to_dir_uniq]
-
-        ######
-        # walk and apply sort rule
+        # extract(or stream) compressed files if any, walk and apply sort rule
         ######
         # return value is a list of list:
-        #   [ [original_full_filename1, path/to/new-filename1],# [original_full_filename1, path/to/new-filename1],... ]
-        before_after_sort_rule_list = self._walk_and_apply_sort_rule(
-            dicom_dirs, self.sort_rule_function)
+        #   [ [original_full_filename1, path/to/new-filename1, header1],# [original_full_filename1, path/to/new-filename1, header1],... ]
+        before_after_sort_rule_list = self._deduplicate(self._scan())
+
+        # check non-image diom and unwrap, before placing: 'move' takes the originals away
+        unwraped_list = self._unwrap_non_imaging(before_after_sort_rule_list)
 
         # for logging
         sorted_dirs = []
 
-        # copy: organizing and renaming original dicom files
+        # destination directories, created once
+        dest_dirs = set()
         for item in before_after_sort_rule_list:
-
-            # example: c:\\users\\user\\appdata\\local\\temp\\DicomSorter_8a46b089-fe90-4ee7-90fe-3cd9fc443d09\\0003.tar.gz816c904c-8e3e-4cff-8624-9fe4efd66815\\0003\\00001.dcm'
-            original_full_filename = item[0]
             # example: PI\\Project\\19700101\\1970_01_01_T2\\1.9AC66A0D\\0003\\1970_01_01_T2.MR.PI_project.0003.0194.19700101.D6C44EC8.dcm
             relative_path_new_filename = item[1]
 
             # only the first element, example: PI
             sorted_dir = os.path.join(
                 self.output_dir, relative_path_new_filename.split(os.sep)[0])
-            if sorted_dir not in sorted_dirs:
+            if sorted_dir not in dest_dirs:
                 sorted_dirs.append(sorted_dir)
+                dest_dirs.add(sorted_dir)
 
-            full_path_new_full_filename = os.path.join(
-                self.output_dir, relative_path_new_filename)
-            dest_dir = os.path.dirname(full_path_new_full_filename)
-            if not os.path.exists(dest_dir):
-                os.makedirs(dest_dir)
+            dest_dirs.add(os.path.dirname(os.path.join(
+                self.output_dir, relative_path_new_filename)))
 
-            # copy imaging dicom
-            shutil.copy(original_full_filename, full_path_new_full_filename)
+        for dest_dir in sorted(dest_dirs):
+            if not os.path.isdir(dest_dir):
+                os.makedirs(dest_dir)
 
-            # check non-image diom and unwrap
-            unwraped_dir = self._check_non_imaging_and_unwrap(
-                original_full_filename)
+        # place: organizing and renaming original dicom files
+        with self.stats.stage('place'):
+            fallback_count = 0
+            for item in before_after_sort_rule_list:
+
+                # example: c:\\users\\user\\appdata\\local\\temp\\DicomSorter_8a46b089-fe90-4ee7-90fe-3cd9fc443d09\\0003.tar.gz816c904c-8e3e-4cff-8624-9fe4efd66815\\0003\\00001.dcm'
+                original_full_filename = item[0]
+                full_path_new_full_filename = os.path.join(
+                    self.output_dir, item[1])
+                size = self._group_size([item])
+
+                if isinstance(original_full_filename, archive_stream.ArchiveMember):
+                    # streamed member: no file to link to
+                    with open(full_path_new_full_filename, 'wb') as f:
+                        f.write(self._archive_reader.read(original_full_filename))
+                    placed = 'copy'
+                else:
+                    placement = self.placement
+                    # extracted files are removed at exit, a symlink to them would dangle
+                    if placement == 'symlink' and \
+                            original_full_filename.startswith(self._extract_to_dir_uniq):
+                        placement = 'hardlink'
+                    placed = place(original_full_filename,
+                                   full_path_new_full_filename, placement)
+                    if placed != placement:
+                        fallback_count += 1
+
+                self.stats.add('place', files=1, bytes_read=size if placed == 'copy' else 0,
+                               bytes_written=size if placed == 'copy' else 0)
+
+            if fallback_count:
+                self.logger.warning('{} files copied, {} not possible'.format(
+                    fallback_count, self.placement))
+
+        # place unwraped dirs
+        for item, unwraped_dir in unwraped_list:
+            full_path_new_full_filename = os.path.join(
+                self.output_dir, item[1])
 
-            # copy unwraped dir
             if unwraped_dir:
-                # create dir
                 dest_unwraped_dir = full_path_new_full_filename+"_unwraped"
 
                 # copytree's dst must not already exist
                 if os.path.exists(dest_unwraped_dir):
                     shutil.rmtree(dest_unwraped_dir)
 
-                # copy dir
-                shutil.copytree(unwraped_dir, dest_unwraped_dir)
+                # unwraped dirs are in a temp dir removed at exit, move or copy them
+                if self.placement == 'move':
+                    shutil.move(unwraped_dir, dest_unwraped_dir)
+                else:
+                    shutil.copytree(unwraped_dir, dest_unwraped_dir)
 
         return sorted_dirs
 
     def tar(self, depth, tar_filename_sep='_'):
         '''
-        extract, apply sort rule, unwrap non-imaging dicom files, and create tar files(imaging->*.tar,non-imaging->*.attached.tar)
+        extract, apply sort rule, unwrap non-imaging dicom files, and create tar files(imaging->*.tar,non-imaging->*.attached.tar,
+        with compression: *.tar.gz/*.attached.tar.gz or *.tar.bz2/*.attached.tar.bz2)
 
         input:
             depth: tar filename is named according to 'depth'.
@@ -245,28 +623,31 @@ class DicomSorter():
             tar_filename_sep: seprator of the tar file name elements
 
         output:
-            tar_full_filename_list: list of resulted tar filenames
+            tar_full_filename_list: list of resulted tar filenames, followed by a TarError for each tar failed to write
 
         note:
             write tar files on disk
 
         '''
-        ######
-        # extract compressed files if any
-        ######
-        self._walk_and_extract(
-            self.dicom_dir, self._compressed_exts, self._extract_to_dir_uniq)
+        if self.group_memory_limit is not None:
+            return self._tar_grouped(depth, tar_filename_sep)
 
-        # add _extract_to_dir_uniq directory in the search directories
-        dicom_dirs = [self.dicom_dir, self._extract_to_dir_uniq]
+        if self.stream_tar:
+            return self._tar_streaming(depth, tar_filename_sep)
 
         ######
-        # walk and apply sort rule
+        # extract(or stream) compressed files if any, walk and apply sort rule
         ######
         # return value is a list of list:
-        #   [[original_full_filename1, path/to/new-filename1],[original_full_filename2, path/to/new-filename2],...]
-        before_after_sort_rule_list = self._walk_and_apply_sort_rule(
-            dicom_dirs, self.sort_rule_function)
+        #   [[original_full_filename1, path/to/new-filename1, header1],[original_full_filename2, path/to/new-filename2, header2],...]
+        if self.manifest is not None:
+            with self.stats.stage('scan'):
+                before_after_sort_rule_list = self._scan_incremental()
+        else:
+            before_after_sort_rule_list = self._scan()
+
+        before_after_sort_rule_list = self._deduplicate(
+            before_after_sort_rule_list)
 
         if not before_after_sort_rule_list:
             self.logger.info('dicom files no found!')
@@ -288,101 +669,1085 @@ class DicomSorter():
             # 'PI\\Project\\19700101\\1970_01_01_T2\\1.9AC66A0D\\0003\\1970_01_01_T2.MR.PI_project.0003.0194.19700101.D6C44EC8.dcm'
             relative_path_new_filename = item[1]
 
-            # get tar file name
-            # dir_split: ['PI','Project','19700101','1970_01_01_T2','1.9AC66A0D','0003','1970_01_01_T2.MR.PI_project.0003.0194.19700101.D6C44EC8.dcm']
-            dir_split = relative_path_new_filename.split(os.sep)
-
-            tar_filename = tar_filename_sep.join(dir_split[:depth])+".tar"
-            tar_full_filename = os.path.join(self.output_dir, tar_filename)
+            tar_full_filename = self._tar_full_filename(
+                relative_path_new_filename, depth, tar_filename_sep)
             tar_full_filename_dict[tar_full_filename].append(item)
 
-        for tar_full_filename, items in tar_full_filename_dict.items():
-            with tarfile.open(tar_full_filename, "w") as tar:
+        # sharding: only this shard's tars
+        if self.shard is not None:
+            tar_full_filename_dict = dict(
+                (tar_full_filename, items) for tar_full_filename, items in tar_full_filename_dict.items()
+                if self._in_shard(items[0][1], depth, tar_filename_sep))
+            before_after_sort_rule_list = [
+                item for items in tar_full_filename_dict.values() for item in items]
+            self._log_shard(len(tar_full_filename_dict))
+
+        # incremental: only tars whose files changed are written
+        written_tar_full_filename_dict = tar_full_filename_dict
+        if self.manifest is not None:
+            stale_tars = self._stale_tars(tar_full_filename_dict)
+            self.logger.info('{} tar files unchanged'.format(
+                len(tar_full_filename_dict) - len(stale_tars)))
+
+            written_tar_full_filename_dict = dict(
+                (tar_full_filename, items) for tar_full_filename, items in tar_full_filename_dict.items()
+                if tar_full_filename in stale_tars)
+            before_after_sort_rule_list = [
+                item for items in written_tar_full_filename_dict.values() for item in items]
+
+        tar_full_filenames, tar_errors = self._write_tars(
+            written_tar_full_filename_dict)
+
+        # tar non-imaging
+        attached_tar_full_filenames, attached_tar_errors = self._tar_non_imaging(
+            before_after_sort_rule_list, depth, tar_filename_sep)
+
+        if self.manifest is not None:
+            with self.stats.stage('manifest'):
+                self._update_manifest(tar_full_filename_dict,
+                                      tar_errors + attached_tar_errors)
+
+        return tar_full_filenames + attached_tar_full_filenames + tar_errors + attached_tar_errors
+
+    def plan(self, depth, tar_filename_sep='_'):
+        '''
+        tar()'s scan, sort rule and dedup only: which file goes to which tar, nothing is written.
+        compressed files are read in memory(stream_archives), their members are recorded as
+        (compressed file, member name), so the plan doesn't point into a temp directory
+
+        input:
+            see tar()
+
+        output:
+            the plan, see sort_plan. None if no dicom files found
+        '''
+        # members of compressed files, not files extracted to a temp directory removed at exit
+        before_after_sort_rule_list = self._deduplicate(
+            self._scan(stream_archives=True))
+        if not before_after_sort_rule_list:
+            self.logger.info('dicom files no found!')
+            return None
+
+        tars = OrderedDict()
+        with self.stats.stage('plan'):
+            for item in before_after_sort_rule_list:
+                tar_full_filename = self._tar_full_filename(
+                    item[1], depth, tar_filename_sep)
+                tar_name = os.path.basename(tar_full_filename)[
+                    :-len(self._tar_ext)]
+                tars.setdefault(tar_name, []).append(
+                    sort_plan.item_row(item, self._group_size([item])))
+            self.stats.add('plan', files=len(before_after_sort_rule_list))
+
+        self.logger.info('planned {} files into {} tar files'.format(
+            len(before_after_sort_rule_list), len(tars)))
+
+        return OrderedDict([('version', sort_plan.PLAN_VERSION),
+                            ('dicom_dir', self.dicom_dir),
+                            ('depth', depth),
+                            ('tar_filename_sep', tar_filename_sep),
+                            ('tars', tars)])
+
+    def execute(self, plan, tar_names=None):
+        '''
+        write the tars of a plan(see plan()), no header is read, the sort rule isn't called
+
+        input:
+            plan: plan()'s output, or sort_plan.read_plan()'s
+            tar_names: write only these tars(names without extension, the plan's keys), e.g. the ones failed
+                       before. None: all
+
+        output:
+            see tar()
+        '''
+        tar_full_filename_dict = OrderedDict()
+        for tar_name, rows in plan['tars'].items():
+            if tar_names is not None and tar_name not in tar_names:
+                continue
+            if self.shard is not None and shards.shard_of(tar_name, self.shard[1]) != self.shard[0]:
+                continue
+            tar_full_filename = os.path.join(
+                self.output_dir, tar_name + self._tar_ext)
+            tar_full_filename_dict[tar_full_filename] = [
+                sort_plan.row_item(row) for row in rows]
+
+        if self.shard is not None:
+            self._log_shard(len(tar_full_filename_dict))
+
+        if not tar_full_filename_dict:
+            self.logger.info('no tar files to write')
+            # a shard owning none of the plan's tars is done
+            return [] if self.shard is not None else None
+
+        tar_full_filenames, tar_errors = self._write_tars(
+            tar_full_filename_dict)
+
+        # tar non-imaging
+        attached_tar_full_filenames, attached_tar_errors = self._tar_non_imaging(
+            [item for items in tar_full_filename_dict.values() for item in items],
+            plan['depth'], plan['tar_filename_sep'])
+
+        return tar_full_filenames + attached_tar_full_filenames + tar_errors + attached_tar_errors
+
+    def _tar_grouped(self, depth, tar_filename_sep):
+        '''
+        tar() with memory-bounded grouping: scan results are grouped as they come into a group_store.GroupStore,
+        spilled to disk past group_memory_limit, and a tar's files are read back only when it is written,
+        tar_jobs tars at a time. duplicates are dropped within each tar
+
+        output:
+            see tar()
+        '''
+        # non-imaging files are few, kept with their headers for unwrapping
+        non_imaging_list = []
+
+        with group_store.GroupStore(self.group_memory_limit, self.extract_to_dir) as store:
+            dicom_dirs = self._scan_dirs()
+            with self.stats.stage('scan'):
+                for item in self._iter_scan(dicom_dirs):
+                    if not self._in_shard(item[1], depth, tar_filename_sep):
+                        continue
+                    tar_full_filename = self._tar_full_filename(
+                        item[1], depth, tar_filename_sep)
+                    key = self._dedup_key(item) if self.dedup else None
+                    store.add(tar_full_filename, item[0], item[1], key)
+
+                    if item[2] is not None and item[2].is_non_imaging:
+                        non_imaging_list.append(item)
+
+            if store.spill_count:
+                self.logger.info('scan results spilled to disk {} times'.format(
+                    store.spill_count))
+
+            tar_keys = store.keys()
+            if self.shard is not None:
+                self._log_shard(len(tar_keys))
+                # a shard owning no tar is done
+                if not tar_keys:
+                    return []
+            if not tar_keys:
+                self.logger.info('dicom files no found!')
+                return None
+
+            # tar imaging
+            non_imaging_originals = set(str(item[0])
+                                        for item in non_imaging_list)
+            kept_non_imaging = set()
+            tar_full_filenames = []
+            tar_errors = []
+            for i in range(0, len(tar_keys), self.tar_jobs):
+                tar_full_filename_dict = dict(
+                    (tar_full_filename, self._group_items(store, tar_full_filename))
+                    for tar_full_filename in tar_keys[i:i + self.tar_jobs])
+
+                for items in tar_full_filename_dict.values():
+                    kept_non_imaging.update(str(item[0]) for item in items
+                                            if str(item[0]) in non_imaging_originals)
+
+                written, errors = self._write_tars(tar_full_filename_dict)
+                tar_full_filenames += written
+                tar_errors += errors
+
+        self._log_duplicates()
+
+        # tar non-imaging, the ones kept by dedup
+        non_imaging_list = [item for item in non_imaging_list
+                            if str(item[0]) in kept_non_imaging]
+        attached_tar_full_filenames, attached_tar_errors = self._tar_non_imaging(
+            non_imaging_list, depth, tar_filename_sep)
+
+        return tar_full_filenames + attached_tar_full_filenames + tar_errors + attached_tar_errors
+
+    def _tar_streaming(self, depth, tar_filename_sep):
+        '''
+        tar() writing as it scans: each file is queued to a writer thread right after the sort rule, and appended
+        to its tar, kept open in a tar_writers.TarWriterCache. so the scan and the writing overlap
+
+        output:
+            see tar()
+        '''
+        # tar_full_filename -> error, of tars failed to write
+        tar_errors_dict = OrderedDict()
+        # tars in the order first seen
+        tar_order = OrderedDict()
+        tar_stats = defaultdict(lambda: [0, 0])
+
+        # bounded: the scan can't run ahead of the writer by more than this
+        tasks = queue.Queue(maxsize=self.chunksize * 16)
+
+        writers = tar_writers.TarWriterCache(self.max_open_tars)
+
+        def write():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    break
+
+                tar_full_filename, item = task
+                if tar_full_filename in tar_errors_dict:
+                    continue
+                try:
+                    self._tar_add(writers.get(tar_full_filename), item[0], item[1])
+                    tar_stats[tar_full_filename][0] += 1
+                    tar_stats[tar_full_filename][1] += self._group_size([item])
+                except Exception as e:
+                    self.logger.exception(e)
+                    tar_errors_dict[tar_full_filename] = e
+                    writers.discard(tar_full_filename)
+
+        writer = threading.Thread(target=write)
+        writer.start()
+
+        # dedup: {key: (kept item, digest, conflicting digests)} of the items so far
+        kept = {}
+        non_imaging_list = []
+        try:
+            dicom_dirs = self._scan_dirs()
+            with self.stats.stage('scan'):
+                for item in self._iter_scan(dicom_dirs):
+                    if self.dedup is not None:
+                        keyed_items = self._deduplicate_list(
+                            [(self._dedup_key(item), item)], kept)
+                        if not keyed_items:
+                            continue
+                        # a conflicting duplicate is renamed
+                        item = keyed_items[0]
+
+                    # after dedup, so every shard keeps the same duplicate
+                    if not self._in_shard(item[1], depth, tar_filename_sep):
+                        continue
+
+                    tar_full_filename = self._tar_full_filename(
+                        item[1], depth, tar_filename_sep)
+                    tar_order[tar_full_filename] = None
+                    tasks.put((tar_full_filename, item))
+
+                    if item[2] is not None and item[2].is_non_imaging:
+                        non_imaging_list.append(item)
+        finally:
+            tasks.put(None)
+            writer.join()
+
+        with self.stats.stage('tar'):
+            tar_errors_dict.update(writers.close_all())
+        self.logger.info('{} tar files, {} reopened for appending'.format(
+            len(tar_order), writers.evictions))
+        self._log_duplicates()
+
+        if self.shard is not None:
+            self._log_shard(len(tar_order))
+            # a shard owning no tar is done
+            if not tar_order:
+                return []
+        if not tar_order:
+            self.logger.info('dicom files no found!')
+            return None
+
+        tar_full_filenames = []
+        for tar_full_filename in tar_order:
+            if tar_full_filename in tar_errors_dict:
+                if os.path.exists(tar_full_filename):
+                    os.remove(tar_full_filename)
+                continue
+            tar_full_filenames.append(tar_full_filename)
+            files, size = tar_stats[tar_full_filename]
+            self.stats.add('tar', files=files, bytes_read=size,
+                           bytes_written=os.path.getsize(tar_full_filename))
+
+        tar_errors = [TarError(tar_full_filename, error)
+                      for tar_full_filename, error in tar_errors_dict.items()]
+
+        # tar non-imaging
+        attached_tar_full_filenames, attached_tar_errors = self._tar_non_imaging(
+            non_imaging_list, depth, tar_filename_sep)
+
+        return tar_full_filenames + attached_tar_full_filenames + tar_errors + attached_tar_errors
+
+    def _group_items(self, store, tar_full_filename):
+        '''
+        a tar's items read back from a group_store.GroupStore, without duplicates
+
+        output:
+            [[original_full_filename1,/path/to/new_filename1,None],...]
+        '''
+        entries = store.entries(tar_full_filename)
+        if self.dedup is None:
+            return [[original_full_filename, relative_path_new_filename, None]
+                    for original_full_filename, relative_path_new_filename, key in entries]
+
+        with self.stats.stage('dedup'):
+            self.stats.add('dedup', files=store.count(tar_full_filename))
+            return self._deduplicate_list(
+                (key, [original_full_filename, relative_path_new_filename, None])
+                for original_full_filename, relative_path_new_filename, key in entries)
+
+    def _log_shard(self, tar_count):
+        self.logger.info('shard {}/{}: {} tar files'.format(
+            self.shard[0], self.shard[1], tar_count))
+
+    def _in_shard(self, relative_path_new_filename, depth, tar_filename_sep):
+        '''
+        whether a sorted file's tar belongs to this shard, True without sharding
+        '''
+        if self.shard is None:
+            return True
+        tar_group_key = tar_filename_sep.join(
+            relative_path_new_filename.split(os.sep)[:depth])
+        return shards.shard_of(tar_group_key, self.shard[1]) == self.shard[0]
+
+    def _tar_full_filename(self, relative_path_new_filename, depth, tar_filename_sep, attached=False):
+        '''
+        tar(or .attached.tar) a sorted file goes into, see tar()
+        '''
+        # get tar file name
+        # dir_split: ['PI','Project','19700101','1970_01_01_T2','1.9AC66A0D','0003','1970_01_01_T2.MR.PI_project.0003.0194.19700101.D6C44EC8.dcm']
+        dir_split = relative_path_new_filename.split(os.sep)
+
+        tar_filename = tar_filename_sep.join(dir_split[:depth])
+        if attached:
+            tar_filename += ".attached"
+        return os.path.join(self.output_dir, tar_filename + self._tar_ext)
+
+    def _tar_non_imaging(self, before_after_sort_rule_list, depth, tar_filename_sep):
+        '''
+        unwrap all non-imaging files first, then write each .attached.tar in one open
+
+        output:
+            (written attached_tar_full_filenames, [TarError, ...])
+        '''
+        # {attached_tar_full_filename1:[[unwraped_dir1,/path/to/new_filename1_unwraped,header1],...],...}
+        attached_tar_full_filename_dict = defaultdict(list)
+        for item, unwraped_dir in self._unwrap_non_imaging(before_after_sort_rule_list):
+            relative_path_new_filename = item[1]
+
+            if unwraped_dir:
+                attached_tar_full_filename = self._tar_full_filename(
+                    relative_path_new_filename, depth, tar_filename_sep, attached=True)
+
+                tar_arcname = relative_path_new_filename + "_unwraped"
+
+                attached_tar_full_filename_dict[attached_tar_full_filename].append(
+                    [unwraped_dir, tar_arcname, item[2]])
+
+        return self._write_tars(attached_tar_full_filename_dict, 'attached_tar')
+
+    def _deduplicate(self, before_after_sort_rule_list):
+        '''
+        drop duplicate instances, keyed on SOPInstanceUID or sorted relative filename(see dedup).
+        the first in scan order is kept, loose files come before compressed files' members
+
+        output:
+            before_after_sort_rule_list without duplicates
+        '''
+        if self.dedup is None:
+            return before_after_sort_rule_list
+
+        with self.stats.stage('dedup'):
+            self.stats.add('dedup', files=len(before_after_sort_rule_list))
+            deduplicated_list = self._deduplicate_list(
+                (self._dedup_key(item), item) for item in before_after_sort_rule_list)
+
+        self._log_duplicates()
+
+        return deduplicated_list
+
+    def _dedup_key(self, item):
+        '''
+        item's dedup key: SOPInstanceUID(if dedup is 'SOPInstanceUID' and the header has it), or
+        sorted relative filename
+        '''
+        header = item[2]
+        if self.dedup == 'SOPInstanceUID' and header is not None and header.SOPInstanceUID:
+            return header.SOPInstanceUID
+        return item[1]
+
+    def _deduplicate_list(self, keyed_items, kept=None):
+        '''
+        see _deduplicate
+
+        input:
+            keyed_items: iterable of (dedup key, item)
+            kept: {key: (kept item, its digest or None, digests of its conflicting duplicates)} of earlier calls,
+                  updated, for deduplicating a stream
+
+        output:
+            the items kept, a conflicting duplicate(dedup_verify) renamed, see _conflict_filename
+        '''
+        if kept is None:
+            kept = {}
+        deduplicated_list = []
+        for key, item in keyed_items:
+            if key not in kept:
+                kept[key] = (item, None, set())
+                deduplicated_list.append(item)
+                continue
+
+            if self.dedup_verify:
+                kept_item, digest, conflict_digests = kept[key]
+                if digest is None:
+                    digest = self._digest(kept_item[0])
+                    kept[key] = (kept_item, digest, conflict_digests)
+                item_digest = self._digest(item[0])
+                # a copy of an earlier conflicting duplicate is a plain duplicate
+                if item_digest != digest and item_digest not in conflict_digests:
+                    conflict_digests.add(item_digest)
+                    item = [item[0], self._conflict_filename(
+                        item[1], item_digest)] + list(item[2:])
+                    self.logger.warning('conflicting duplicate {}: {} differs from {}, kept as {}'.format(
+                        key, item[0], kept_item[0], item[1]))
+                    self.duplicate_conflicts.append((kept_item[0], item[0]))
+                    deduplicated_list.append(item)
+                    continue
+
+            self.duplicate_count += 1
+
+        return deduplicated_list
+
+    def _conflict_filename(self, relative_path_new_filename, digest):
+        '''
+        a conflicting duplicate's sorted filename: name.dcm -> name.conflict_1a2b3c4d.dcm, same directory(so
+        same tar), not the kept file's name
+        '''
+        root, ext = os.path.splitext(relative_path_new_filename)
+        return '{}.conflict_{}{}'.format(root, digest[:8], ext)
+
+    def _log_duplicates(self):
+        if self.duplicate_count:
+            self.logger.info('{} duplicate files dropped'.format(
+                self.duplicate_count))
+
+    def _digest(self, original_full_filename):
+        '''
+        sha1 of a file, or of an archive_stream.ArchiveMember
+        '''
+        sha1 = hashlib.sha1()
+        if isinstance(original_full_filename, archive_stream.ArchiveMember):
+            sha1.update(self._archive_reader.read(original_full_filename))
+        else:
+            with open(original_full_filename, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha1.update(block)
+        return sha1.hexdigest()
+
+    def _unwrap_non_imaging(self, before_after_sort_rule_list):
+        '''
+        classify non-imaging dicom files from the scan results' headers, unwrap them, unwrap_jobs at the same time
+
+        input:
+            before_after_sort_rule_list: see _walk_and_apply_sort_rule
+
+        output:
+            list of (item, unwraped_dir), in scan order, for non-imaging items only.
+            unwraped_dir is None if unwrapping failed
+        '''
+        # no header: not readable by pydicom, can't be non-imaging
+        non_imaging_items = [item for item in before_after_sort_rule_list
+                             if item[2] is not None and item[2].is_non_imaging]
+
+        def unwrap(item):
+            return self._check_non_imaging_and_unwrap(item[0], item[2])
+
+        with self.stats.stage('unwrap'):
+            if self.unwrap_jobs > 1 and len(non_imaging_items) > 1:
+                # unwrapping is external processes, threads are enough to keep unwrap_jobs of them running
+                pool = ThreadPool(min(self.unwrap_jobs, len(non_imaging_items)))
+                try:
+                    unwraped_dirs = pool.map(unwrap, non_imaging_items, 1)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                unwraped_dirs = [unwrap(item) for item in non_imaging_items]
+
+        self.stats.add('unwrap', files=len(non_imaging_items), bytes_read=self._profiled_size(non_imaging_items),
+                       bytes_written=sum(self._tree_size(unwraped_dir) for unwraped_dir in unwraped_dirs if unwraped_dir))
+
+        return list(zip(non_imaging_items, unwraped_dirs))
+
+    def _write_tars(self, tar_full_filename_dict, stage='tar'):
+        '''
+        write each tar, tar_jobs tars at the same time, largest first
+
+        input:
+            tar_full_filename_dict: {tar_full_filename1:[[original_full_filename1,/path/to/new_filename1,header1],...],...}
+            stage: recorded in stats as
+
+        output:
+            (written tar_full_filenames, [TarError, ...])
+        '''
+        # list: compatible with python 3
+        groups = list(tar_full_filename_dict.items())
+        group_sizes = dict((tar_full_filename, self._group_size(items))
+                           for tar_full_filename, items in groups)
+
+        with self.stats.stage(stage):
+            if self.tar_jobs > 1 and len(groups) > 1:
+                # largest first, so the run isn't held up by one big tar at the end
+                groups.sort(
+                    key=lambda group: group_sizes[group[0]], reverse=True)
+
+                # the writer threads read members of a .tgz out of order, each backward seek would decompress
+                # it again from its start
+                self._archive_reader.decompress_tars(
+                    self._extract_to_dir_uniq)
+
+                pool = ThreadPool(min(self.tar_jobs, len(groups)))
+                try:
+                    errors = pool.map(self._write_tar, groups, 1)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                errors = [self._write_tar(group) for group in groups]
+
+        tar_full_filenames = []
+        tar_errors = []
+        for (tar_full_filename, items), error in zip(groups, errors):
+            if error is None:
+                tar_full_filenames.append(tar_full_filename)
+                self.stats.add(stage, files=len(items), bytes_read=group_sizes[tar_full_filename],
+                               bytes_written=os.path.getsize(tar_full_filename))
+            else:
+                tar_errors.append(TarError(tar_full_filename, error))
+
+        return tar_full_filenames, tar_errors
+
+    def _write_tar(self, group):
+        '''
+        write one tar
+
+        input:
+            group: (tar_full_filename, [[original_full_filename1,/path/to/new_filename1,header1],...])
+
+        output:
+            None, or the error if the tar failed to write, the partial tar is removed
+        '''
+        tar_full_filename, items = group
+        try:
+            with parallel_compress.open_tar(tar_full_filename, self.compression, self.compress_jobs) as tar:
                 for item in items:
                     original_full_filename = item[0]
                     relative_path_new_filename = item[1]
 
                     arcname = relative_path_new_filename
-                    tar.add(original_full_filename, arcname=arcname)
+                    self._tar_add(tar, original_full_filename, arcname)
+        except Exception as e:
+            self.logger.exception(e)
+            if os.path.exists(tar_full_filename):
+                os.remove(tar_full_filename)
+            return e
 
-        # tar non-imaging:
-        attached_tar_full_filenames = []
-        for item in before_after_sort_rule_list:
-            original_full_filename = item[0]
-            relative_path_new_filename = item[1]
+        return None
 
-            unwraped_dir = self._check_non_imaging_and_unwrap(
-                original_full_filename)
+    def _group_size(self, items):
+        '''
+        total bytes of a tar group's original files(or unwraped directories)
+        '''
+        size = 0
+        for item in items:
+            if isinstance(item[0], archive_stream.ArchiveMember):
+                size += item[0].size
+            else:
+                try:
+                    file_stat = os.stat(item[0])
+                except OSError:
+                    continue
+                if stat.S_ISDIR(file_stat.st_mode):
+                    size += self._tree_size(item[0])
+                else:
+                    size += file_stat.st_size
+        return size
 
-            if unwraped_dir:
-                dir_split = relative_path_new_filename.split(os.sep)
-                attached_tar_filename = tar_filename_sep.join(
-                    dir_split[:depth])+".attached.tar"
-                attached_tar_full_filename = os.path.join(
-                    self.output_dir, attached_tar_filename)
+    def _profiled_size(self, items):
+        '''
+        _group_size of items read by a stage that doesn't stat them otherwise, 0 unless profiling
+        '''
+        if not self.stats.profile_filename:
+            return 0
+        return self._group_size(items)
 
-                tar_arcname = relative_path_new_filename + "_unwraped"
+    def _tree_size(self, directory):
+        '''
+        total bytes of the files under directory
+        '''
+        size = 0
+        for root, directories, filenames in os.walk(directory):
+            for filename in filenames:
+                try:
+                    size += os.path.getsize(os.path.join(root, filename))
+                except OSError:
+                    pass
+        return size
 
-                if attached_tar_full_filename not in attached_tar_full_filenames:
-                    with tarfile.open(attached_tar_full_filename, "w") as tar:
-                        tar.add(unwraped_dir, arcname=tar_arcname)
+    def _scan(self, stream_archives=False):
+        '''
+        extract compressed files(or read them in memory, with stream_archives), walk and apply sort rule
 
-                    attached_tar_full_filenames.append(
-                        attached_tar_full_filename)
+        input:
+            stream_archives: read compressed files in memory even if self.stream_archives isn't set, see plan()
 
-                else:
-                    with tarfile.open(attached_tar_full_filename, "a") as tar:
-                        tar.add(unwraped_dir, arcname=tar_arcname)
+        output:
+            before_after_sort_rule_list: see _walk_and_apply_sort_rule
+        '''
+        stream_archives = stream_archives or self.stream_archives
+        dicom_dirs = self._scan_dirs(stream_archives)
 
-        # for logging
-        # list: compatible with python 3
-        tar_full_filenames = list(tar_full_filename_dict.keys())
+        ######
+        # walk and apply sort rule
+        ######
+        with self.stats.stage('scan'):
+            before_after_sort_rule_list = self._walk_and_apply_sort_rule(
+                dicom_dirs, self.sort_rule_function)
 
-        return tar_full_filenames + attached_tar_full_filenames
+            # stream_archives: loose files first, then each compressed file's members
+            if stream_archives:
+                before_after_sort_rule_list += self._walk_archives_and_apply_sort_rule(
+                    self.dicom_dir, self.sort_rule_function)
+
+        return before_after_sort_rule_list
+
+    def _scan_dirs(self, stream_archives=False):
+        '''
+        extract compressed files if any, unless stream_archives(or self.stream_archives)
+
+        output:
+            directories to walk
+        '''
+        if stream_archives or self.stream_archives:
+            return [self.dicom_dir]
+
+        ######
+        # extract compressed files if any
+        ######
+        with self.stats.stage('extract'):
+            self._walk_and_extract(
+                self.dicom_dir, self._compressed_exts, self._extract_to_dir_uniq)
+
+        # add _extract_to_dir_uniq directory in the search directories
+        return [self.dicom_dir, self._extract_to_dir_uniq]
+
+    def _iter_scan(self, dicom_dirs):
+        '''
+        like _scan's walk and apply sort rule, one item at a time, for memory-bounded tar()
+
+        input:
+            dicom_dirs: see _scan_dirs
+
+        output:
+            generator of before_after_sort_rule_list's items, see _walk_and_apply_sort_rule
+        '''
+        non_dicom_count = 0
+        for item in self._iter_apply_sort_rule_to_files(self._iter_files(dicom_dirs), self.sort_rule_function):
+            if item:
+                yield item
+            elif item is False:
+                non_dicom_count += 1
+
+        if self.stream_archives:
+            for archive_filename in self._iter_files([self.dicom_dir], compressed=True):
+                for member, item in self._apply_sort_rule_to_archive(archive_filename, self.sort_rule_function):
+                    if item:
+                        yield item
+                    elif item is False:
+                        non_dicom_count += 1
+
+        self._add_non_dicom(non_dicom_count)
+
+    def _scan_incremental(self):
+        '''
+        like _scan with stream_archives, but only files changed since the manifest was recorded are
+        parsed. unchanged files reuse the manifest's sorted filename and header, an unchanged compressed
+        file isn't read at all.
+
+        output:
+            before_after_sort_rule_list: see _walk_and_apply_sort_rule
+
+        note:
+            keep this run's manifest rows in _manifest_rows/_manifest_archive_rows, the directory they replace
+            the manifest's rows of in _manifest_root, and the paths changed(new, modified or removed) since last
+            run in _changed_paths
+        '''
+        # [(path, archive, member, size, mtime, item or None), ...]
+        self._manifest_rows = []
+        # [(archive_filename, size, mtime), ...]
+        self._manifest_archive_rows = []
+        self._changed_paths = set()
+
+        before_after_sort_rule_list = []
+
+        # absolute paths in the manifest: a relative and an absolute run of the same tree match.
+        # the manifest may hold other dicom_dirs' files too(runs on them into the same output_dir),
+        # only dicom_dir's are this run's
+        dicom_dir = os.path.abspath(self.dicom_dir)
+        self._manifest_root = dicom_dir
+
+        # loose files: parse new or modified files only
+        entries = []
+        to_parse = []
+        for full_filename in self._walk_files([dicom_dir]):
+            file_stat = os.stat(full_filename)
+            reused = self.manifest.lookup(
+                full_filename, file_stat.st_size, file_stat.st_mtime)
+            if reused is None:
+                to_parse.append(full_filename)
+            entries.append((full_filename, file_stat.st_size, file_stat.st_mtime, reused))
+
+        results = self._apply_sort_rule_to_files(
+            to_parse, self.sort_rule_function)
+        self._count_non_dicom(results)
+        parsed = dict(zip(to_parse, results))
+
+        for full_filename, size, mtime, reused in entries:
+            if reused is None:
+                item = parsed[full_filename] or None
+                self._changed_paths.add(full_filename)
+            else:
+                sorted_relative_path_filename, header = reused
+                item = [full_filename, sorted_relative_path_filename,
+                        header] if sorted_relative_path_filename else None
+
+            self._manifest_rows.append(
+                (full_filename, None, None, size, mtime, item))
+            if item:
+                before_after_sort_rule_list.append(item)
+
+        # compressed files: read a new or modified compressed file only
+        for archive_filename in self._walk_files([dicom_dir], compressed=True):
+            file_stat = os.stat(archive_filename)
+            self._manifest_archive_rows.append(
+                (archive_filename, file_stat.st_size, file_stat.st_mtime))
+
+            reused = self.manifest.lookup_archive(
+                archive_filename, file_stat.st_size, file_stat.st_mtime)
+            if reused is None:
+                results = self._apply_sort_rule_to_archive(
+                    archive_filename, self.sort_rule_function)
+                self._count_non_dicom([result for member, result in results])
+                self._changed_paths.update(
+                    str(member) for member, result in results)
+                members = [(member, result or None)
+                           for member, result in results]
+            else:
+                members = []
+                for name, size, mtime, sorted_relative_path_filename, header in reused:
+                    member = archive_stream.ArchiveMember(
+                        archive_filename, name, size, mtime)
+                    item = [member, sorted_relative_path_filename,
+                            header] if sorted_relative_path_filename else None
+                    members.append((member, item))
+
+            for member, item in members:
+                self._manifest_rows.append(
+                    (str(member), member.archive, member.name, member.size, member.mtime, item))
+                if item:
+                    before_after_sort_rule_list.append(item)
+
+        # removed since last run
+        self._changed_paths.update(
+            self.manifest.paths(dicom_dir) - set(row[0] for row in self._manifest_rows))
+
+        return before_after_sort_rule_list
+
+    def _stale_tars(self, tar_full_filename_dict):
+        '''
+        tars to (re)write in an incremental run: tars missing on disk, tars with new or modified files,
+        and tars whose files differ from the manifest's(moved or removed files)
+
+        output:
+            set of tar_full_filename
+        '''
+        stale_tars = set()
+        for tar_full_filename, items in tar_full_filename_dict.items():
+            paths = set(str(item[0]) for item in items)
+            if not os.path.exists(tar_full_filename) or \
+                    paths & self._changed_paths or \
+                    paths != self.manifest.tar_paths(tar_full_filename):
+                stale_tars.add(tar_full_filename)
+
+        for tar_full_filename in self.manifest.tars_of(self._changed_paths) - set(tar_full_filename_dict):
+            self.logger.warning(
+                '{} has no input files left, not updated'.format(tar_full_filename))
+
+        return stale_tars
+
+    def _update_manifest(self, tar_full_filename_dict, tar_errors):
+        '''
+        record this run's files, and the tar each went into, in the manifest.
+        files of a failed tar(or failed .attached.tar) are recorded without tar, so it is rewritten next run
+        '''
+        failed_tars = set(error.tar_full_filename.replace('.attached.tar', '.tar')
+                          for error in tar_errors)
+
+        tar_of = {}
+        for tar_full_filename, items in tar_full_filename_dict.items():
+            if tar_full_filename not in failed_tars:
+                for item in items:
+                    tar_of[str(item[0])] = tar_full_filename
+
+        file_rows = []
+        for path, archive, member, size, mtime, item in self._manifest_rows:
+            sorted_relative_path_filename = item[1] if item else None
+            header = item[2] if item else None
+            sop_instance_uid = header.SOPInstanceUID if header else None
+            file_rows.append((path, archive, member, size, mtime, sop_instance_uid,
+                              sorted_relative_path_filename, tar_of.get(path), header))
+
+        self.manifest.update(
+            file_rows, self._manifest_archive_rows, self._manifest_root)
 
     def _walk_and_apply_sort_rule(self, dicom_dirs, sort_rule_function):
         '''
-        find each dicom files, apply sort rule
+        find each dicom files, read its header once, apply sort rule
 
         input:
             dicom_dirs
-            sort_rule_function:
+            sort_rule_function: called with the file's dicom_header.DicomHeader, or its filename if
+                the header can't be read. 'sort_rule_function.read_header_kwargs', if any, is passed
+                to dicom_header.read_header
 
         output:
-            before_after_sort_rule_list: a list of list.
+            before_after_sort_rule_list: a list of list, in sorted walk order, whatever self.jobs is.
                 sub_list[0]: original dicom-file's full path filename
                 sub_list[1]: sorted-dicom-file's relative path filename: e.g. /pi/study_date/new-filename.dcm
+                sub_list[2]: original dicom-file's dicom_header.DicomHeader(without dataset), or None
+        '''
+        full_filenames = self._walk_files(dicom_dirs)
+
+        results = self._apply_sort_rule_to_files(
+            full_filenames, sort_rule_function)
+
+        self._count_non_dicom(results)
+
+        before_after_sort_rule_list = [
+            item for item in results if item]
+
+        return before_after_sort_rule_list
+
+    def _apply_sort_rule_to_files(self, full_filenames, sort_rule_function):
+        '''
+        apply sort rule on each file, on a process pool if self.jobs > 1
+
+        output:
+            _apply_sort_rule's result for each file, in full_filenames' order
+        '''
+        return list(self._iter_apply_sort_rule_to_files(full_filenames, sort_rule_function))
+
+    def _iter_apply_sort_rule_to_files(self, full_filenames, sort_rule_function):
+        '''
+        apply sort rule on each file, on a process pool if self.jobs > 1.
+        full_filenames(any iterable) is read in batches, only a batch of filenames and results is in memory
+
+        output:
+            generator of _apply_sort_rule's result for each file, in full_filenames' order
+        '''
+        apply_sort_rule = functools.partial(
+            _apply_sort_rule, sort_rule_function=sort_rule_function, args=self.args,
+            preambleless=self.preambleless)
+        collector = getattr(sort_rule_function, 'collector', None)
+        apply_sort_rule_collecting = functools.partial(
+            _apply_sort_rule_collecting, sort_rule_function=sort_rule_function, args=self.args,
+            preambleless=self.preambleless)
+
+        full_filenames = iter(full_filenames)
+        batch_size = self.chunksize * self.jobs * 16
+        pool = None
+        while True:
+            batch = list(itertools.islice(full_filenames, batch_size))
+            if not batch:
+                break
+
+            # bytes_read: the files' size, headers are read up to the pixel data only
+            self.stats.add('scan', files=len(batch),
+                           bytes_read=self._profiled_size([[full_filename] for full_filename in batch]))
+
+            if pool is None and self.jobs > 1 and len(batch) > self.chunksize:
+                pool = self._scan_pool()
+
+            if pool is not None and collector is not None:
+                # rows the sort rule collected in the worker processes
+                for result, rows in pool.imap(apply_sort_rule_collecting, batch, self.chunksize):
+                    collector.update(rows)
+                    yield result
+            elif pool is not None:
+                # parse headers on a process pool, imap keeps the input order
+                for result in pool.imap(apply_sort_rule, batch, self.chunksize):
+                    yield result
+            else:
+                for full_filename in batch:
+                    yield apply_sort_rule(full_filename)
+
+    def _scan_pool(self):
+        '''
+        the process pool parsing headers: the caller's pool, or one of jobs processes created on first use
+        '''
+        if self.pool is not None:
+            return self.pool
+        if self._own_pool is None:
+            self._own_pool = multiprocessing.Pool(self.jobs)
+        return self._own_pool
+
+    def _walk_archives_and_apply_sort_rule(self, dicom_dir, sort_rule_function):
+        '''
+        find each compressed files, apply sort rule on their members read in memory
+
+        input:
+            dicom_dir
+            sort_rule_function: see _walk_and_apply_sort_rule
+
+        output:
+            before_after_sort_rule_list: see _walk_and_apply_sort_rule.
+                sub_list[0] is an archive_stream.ArchiveMember
         '''
         before_after_sort_rule_list = []
+        for archive_filename in self._walk_files([dicom_dir], compressed=True):
+            results = [result for member, result in self._apply_sort_rule_to_archive(
+                archive_filename, sort_rule_function)]
+
+            self._count_non_dicom(results)
+            before_after_sort_rule_list += [item for item in results if item]
+
+        return before_after_sort_rule_list
+
+    def _apply_sort_rule_to_archive(self, archive_filename, sort_rule_function):
+        '''
+        apply sort rule on each member of a compressed file, read in memory
+
+        output:
+            [(archive_stream.ArchiveMember, _apply_sort_rule's result), ...], in archive order
+
+        note:
+            jobs > 1: the compressed file is decompressed in this process, the dicom members(after the preamble
+            check) are read whole and their headers parsed on the process pool, MEMBER_BATCH_BYTES at a time
+        '''
+        results = []
+        try:
+            if self.jobs > 1:
+                results = self._apply_sort_rule_to_archive_on_pool(
+                    archive_filename, sort_rule_function)
+            else:
+                for member, fileobj in archive_stream.iter_members(archive_filename, self._compressed_exts):
+                    results.append((member, _apply_sort_rule(
+                        member, sort_rule_function, self.args, fileobj, self.preambleless)))
+        except Exception as e:
+            self.logger.exception(e)
+
+        self.stats.add('scan', files=len(results),
+                       bytes_read=sum(member.size for member, result in results))
+
+        return results
+
+    def _apply_sort_rule_to_archive_on_pool(self, archive_filename, sort_rule_function):
+        '''
+        see _apply_sort_rule_to_archive, jobs > 1
+
+        raise:
+            whatever reading the compressed file raises, the members done so far are lost
+        '''
+        collector = getattr(sort_rule_function, 'collector', None)
+        apply_sort_rule = functools.partial(
+            _apply_sort_rule_to_member, sort_rule_function=sort_rule_function, args=self.args,
+            preambleless=self.preambleless, collecting=collector is not None)
+
+        members = []
+        # {index in members: _apply_sort_rule's result} of the members rejected before the pool
+        rejected = {}
+        results = []
+        batch = []
+        batch_bytes = 0
+
+        def parse(batch):
+            for result in self._scan_pool().imap(apply_sort_rule, batch, self.chunksize):
+                if collector is not None:
+                    result, rows = result
+                    collector.update(rows)
+                results.append(result)
+
+        for member, fileobj in archive_stream.iter_members(archive_filename, self._compressed_exts):
+            members.append(member)
+            # clear non-dicom: not read whole, not sent to the pool
+            try:
+                is_dicom = dicom_header.is_dicom(
+                    str(member), fileobj, self.preambleless)
+            except (IOError, OSError):
+                is_dicom = False
+            if not is_dicom:
+                rejected[len(members) - 1] = False
+                continue
+
+            data = fileobj.read()
+            batch.append((member, data))
+            batch_bytes += len(data)
+            if batch_bytes >= MEMBER_BATCH_BYTES or len(batch) >= self.chunksize * self.jobs * 16:
+                parse(batch)
+                batch = []
+                batch_bytes = 0
+
+        if batch:
+            parse(batch)
+
+        # merge back in archive order
+        parsed = iter(results)
+        return [(member, rejected[index] if index in rejected else next(parsed))
+                for index, member in enumerate(members)]
+
+    def _count_non_dicom(self, results):
+        '''
+        count _apply_sort_rule's results rejected as non-dicom
+        '''
+        self._add_non_dicom(sum(1 for item in results if item is False))
+
+    def _add_non_dicom(self, non_dicom_count):
+        if non_dicom_count:
+            self.logger.info(
+                '{} non-dicom files skipped'.format(non_dicom_count))
+        self.non_dicom_count += non_dicom_count
+
+    def _walk_files(self, dicom_dirs, compressed=False):
+        '''
+        find each non-compressed(or compressed) files, sorted, so results are reproducible
+        '''
+        return list(self._iter_files(dicom_dirs, compressed))
+
+    def _iter_files(self, dicom_dirs, compressed=False):
+        '''
+        generator version of _walk_files, one directory's filenames in memory at a time
+        '''
         for dicom_dir in dicom_dirs:
             for root, directories, filenames in os.walk(dicom_dir):
-                for filename in filenames:
+                directories.sort()
+                for filename in sorted(filenames):
                     full_filename = os.path.join(root, filename)
-                    if not full_filename.endswith(self._compressed_exts):
-                        try:
-                            sorted_relative_path_filename = sort_rule_function(
-                                full_filename, self.args)
-                            # apply sort_rule_function on non-dicom or bad dicom return None
-                            if sorted_relative_path_filename is not None:
-                                before_after_sort_rule_list.append(
-                                    [full_filename, sorted_relative_path_filename])
-                        except Exception as e:
-                            self.logger.exception(e)
+                    if full_filename.endswith(self._compressed_exts) == compressed:
+                        yield full_filename
 
-        return before_after_sort_rule_list
+    def _tar_add(self, tar, original_full_filename, arcname):
+        '''
+        add a file, or an archive_stream.ArchiveMember, to tar
+        '''
+        if isinstance(original_full_filename, archive_stream.ArchiveMember):
+            tar.addfile(archive_stream.member_tarinfo(original_full_filename, arcname),
+                        self._archive_reader.open(original_full_filename))
+        else:
+            tar.add(original_full_filename, arcname=arcname)
+
+    def _extract_member(self, member):
+        '''
+        write an archive_stream.ArchiveMember to _extract_to_dir_uniq, return the full path filename
+        '''
+        # archive filename+uniq_string: avoid same file names overwrite
+        output_dir = os.path.join(self._extract_to_dir_uniq, os.path.basename(
+            member.archive) + self._generate_uniq_string())
+
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        return self._archive_reader.extract(member, output_dir)
 
     def _extract(self, filename, to_dir):
         '''
         extract compressed files
         '''
-        if (filename.endswith(".tar")):
-            c_file = tarfile.open(filename, "r:")
-        elif (filename.endswith(".tar.gz")) or (filename.endswith(".tgz")):
-            c_file = tarfile.open(filename, "r:gz")
-        elif (filename.endswith(".tar.bz2")):
-            c_file = tarfile.open(filename, "r:bz2")
-        elif (filename.endswith(".zip")):
-            c_file = zipfile.ZipFile(filename)
+        c_file = archive_stream.open_archive(filename)
 
         c_file.extractall(to_dir)
         c_file.close()
@@ -409,13 +1774,26 @@ class DicomSorter():
                     except Exception as e:
                         self.logger.exception(e)
 
+                    self.stats.add('extract', files=1, bytes_read=os.path.getsize(full_filename),
+                                   bytes_written=self._tree_size(output_dir))
+
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
         '''
-        remove temp directories
+        close compressed files and the scan's process pool, remove temp directories
         '''
+        self._archive_reader.close()
+
+        if self._own_pool is not None:
+            self._own_pool.close()
+            self._own_pool.join()
+            self._own_pool = None
+
+        if self.manifest is not None:
+            self.manifest.close()
+
         if os.path.exists(self._extract_to_dir_uniq):
             shutil.rmtree(self._extract_to_dir_uniq)
 
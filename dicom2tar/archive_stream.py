@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+'''
+read dicom files directly from compressed files(.zip/.tgz/.tar.gz/.tar.bz2/.tar), without extracting them to disk
+
+    ArchiveMember: a file inside a compressed file, used in place of a full path filename
+    open_archive: open a compressed file for reading
+    iter_members: walk the regular files of a compressed file, in archive order, a member is read only as far
+                  as asked
+    member_tarinfo: tarfile.TarInfo to add a member to a tar
+    ArchiveReader: keep compressed files open while their members are read
+'''
+
+import os
+import io
+import bz2
+import gzip
+import time
+import uuid
+import shutil
+import tarfile
+import zipfile
+import threading
+from collections import namedtuple
+
+# bytes read before a member is known to be wanted: dicom_header.is_dicom's 128 bytes preamble and 'DICM'
+PEEK_LENGTH = 132
+
+
+class ArchiveMember(namedtuple('ArchiveMember', ['archive', 'name', 'size', 'mtime'])):
+    '''
+    a file inside a compressed file
+
+    attributes:
+        archive: full path of the compressed file
+        name: member name inside archive
+        size: uncompressed size in bytes
+        mtime: modification time, seconds since epoch
+    '''
+    __slots__ = ()
+
+    def __str__(self):
+        # /path/to/study.zip/inner/dir/00001.dcm
+        return os.path.join(self.archive, self.name)
+
+    @property
+    def basename(self):
+        return os.path.basename(self.name)
+
+
+def open_archive(filename):
+    '''
+    open compressed file for reading, tarfile.TarFile or zipfile.ZipFile
+    '''
+    if (filename.endswith(".tar")):
+        return tarfile.open(filename, "r:")
+    elif (filename.endswith(".tar.gz")) or (filename.endswith(".tgz")):
+        return tarfile.open(filename, "r:gz")
+    elif (filename.endswith(".tar.bz2")):
+        return tarfile.open(filename, "r:bz2")
+    elif (filename.endswith(".zip")):
+        return zipfile.ZipFile(filename)
+
+    raise ValueError('not a supported compressed file: {}'.format(filename))
+
+
+def is_compressed_tar(filename):
+    '''
+    .tgz/.tar.gz/.tar.bz2: a tar that can't be seeked backward without decompressing it again from the start
+    '''
+    return filename.endswith(('.tar.gz', '.tgz', '.tar.bz2'))
+
+
+def decompress_tar(filename, to_dir):
+    '''
+    decompress a .tgz/.tar.gz/.tar.bz2 to a plain tar in to_dir, return its full path filename
+    '''
+    decompressed_filename = os.path.join(to_dir, str(uuid.uuid4()) + '.tar')
+    c_file = bz2.BZ2File(filename) if filename.endswith(
+        '.tar.bz2') else gzip.GzipFile(filename)
+    try:
+        with open(decompressed_filename, 'wb') as f:
+            shutil.copyfileobj(c_file, f, 1024 * 1024)
+    finally:
+        c_file.close()
+    return decompressed_filename
+
+
+class PeekedFile(object):
+    '''
+    a member's content as a file object, read from the compressed file only as far as asked: the dicom check
+    reads PEEK_LENGTH bytes, a header read stops before the pixel data. a non-dicom member is rejected
+    without being read whole.
+
+    only valid until the next member of the same compressed file is read
+    '''
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._file = io.BytesIO()
+        self._length = 0
+        self._complete = False
+        self._fill(PEEK_LENGTH)
+
+    def _fill(self, end=None):
+        '''
+        read the member up to end, None: to its end
+        '''
+        if self._complete or (end is not None and end <= self._length):
+            return
+
+        if end is None:
+            data = self._stream.read()
+        else:
+            data = self._stream.read(end - self._length)
+
+        position = self._file.tell()
+        self._file.seek(0, io.SEEK_END)
+        self._file.write(data)
+        self._file.seek(position)
+
+        self._complete = end is None or len(data) < end - self._length
+        self._length += len(data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            self._fill()
+        else:
+            self._fill(self._file.tell() + size)
+        return self._file.read(size)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._fill(offset)
+        elif whence == io.SEEK_CUR:
+            self._fill(self._file.tell() + offset)
+        else:
+            self._fill()
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def __getattr__(self, name):
+        # pydicom probes for attributes(name, filename, ...) a BytesIO doesn't have
+        if not hasattr(io.BytesIO, name):
+            raise AttributeError(name)
+        # other BytesIO methods(readinto, getvalue, ...) need the whole member
+        self._fill()
+        return getattr(self._file, name)
+
+
+def iter_members(archive_filename, skip_exts=()):
+    '''
+    walk the regular files of a compressed file, in archive order
+
+    input:
+        archive_filename: full path of compressed file
+        skip_exts: member names ending with these are not read, e.g. nested compressed files
+
+    output:
+        generator of (ArchiveMember, PeekedFile), the PeekedFile is only valid until the next one is generated
+    '''
+    c_file = open_archive(archive_filename)
+    try:
+        if isinstance(c_file, zipfile.ZipFile):
+            for info in c_file.infolist():
+                if info.filename.endswith('/') or info.filename.endswith(skip_exts):
+                    continue
+                member = ArchiveMember(archive_filename, info.filename, info.file_size,
+                                       time.mktime(info.date_time + (0, 0, -1)))
+                stream = c_file.open(info)
+                try:
+                    yield member, PeekedFile(stream)
+                finally:
+                    stream.close()
+        else:
+            # iterate the tar sequentially, a compressed tar is decompressed once,
+            # the unread part of a member is skipped over by the next header's seek
+            for info in c_file:
+                if not info.isfile() or info.name.endswith(skip_exts):
+                    continue
+                member = ArchiveMember(
+                    archive_filename, info.name, info.size, info.mtime)
+                yield member, PeekedFile(c_file.extractfile(info))
+    finally:
+        c_file.close()
+
+
+def member_tarinfo(member, arcname):
+    '''
+    tarfile.TarInfo to add member to a tar under arcname
+    '''
+    info = tarfile.TarInfo(arcname)
+    info.size = member.size
+    info.mtime = member.mtime
+    info.mode = 0o644
+    return info
+
+
+class ArchiveReader(object):
+    '''
+    keep compressed files open while members are read, one open per compressed file.
+    reads of a compressed file are serialized(one lock per compressed file), so a reader can be shared by the
+    tar writer threads. a tar is scanned in archive order only as far as the member read, members read in
+    archive order decompress a compressed tar once. members read out of order(e.g. by several tar writer
+    threads) would decompress a .tgz from its start on each backward seek, see decompress_tars
+
+    Usage:
+        with ArchiveReader() as reader:
+            data = reader.read(member)
+    '''
+
+    def __init__(self):
+        self._archives = {}
+        # compressed tars are read from a plain tar decompressed once to this directory, see decompress_tars
+        self._decompress_dir = None
+        # archive_filename -> {member name: TarInfo}, of the members scanned so far
+        self._tar_infos = {}
+        # archive_filename -> lock of its reads
+        self._locks = {}
+        # guards _locks
+        self._lock = threading.Lock()
+
+    def _archive_lock(self, archive_filename):
+        with self._lock:
+            if archive_filename not in self._locks:
+                self._locks[archive_filename] = threading.Lock()
+            return self._locks[archive_filename]
+
+    def _open(self, archive_filename):
+        '''
+        called with archive_filename's lock held
+        '''
+        if archive_filename not in self._archives:
+            self._tar_infos[archive_filename] = {}
+            if self._decompress_dir is not None and is_compressed_tar(archive_filename):
+                self._archives[archive_filename] = open_archive(
+                    decompress_tar(archive_filename, self._decompress_dir))
+            else:
+                self._archives[archive_filename] = open_archive(
+                    archive_filename)
+        return self._archives[archive_filename]
+
+    def decompress_tars(self, to_dir):
+        '''
+        from now on, read each .tgz/.tar.gz/.tar.bz2 from a plain tar decompressed once to to_dir, where any
+        member can be read without decompressing the ones before it. to_dir is not cleaned up
+
+        call before the members are read out of order, not while they are being read
+        '''
+        with self._lock:
+            self._decompress_dir = to_dir
+            # compressed tars already open are reopened decompressed
+            for archive_filename in list(self._archives):
+                if is_compressed_tar(archive_filename):
+                    self._archives.pop(archive_filename).close()
+                    self._tar_infos.pop(archive_filename)
+
+    def _tar_info(self, c_file, archive_filename, name):
+        '''
+        name's TarInfo, scan the tar's headers only as far as name, instead of all of them up front
+        '''
+        tar_infos = self._tar_infos[archive_filename]
+        while name not in tar_infos:
+            info = c_file.next()
+            if info is None:
+                raise KeyError('{} not found in {}'.format(
+                    name, archive_filename))
+            tar_infos[info.name] = info
+        return tar_infos[name]
+
+    def read(self, member):
+        '''
+        member's content, bytes
+        '''
+        with self._archive_lock(member.archive):
+            c_file = self._open(member.archive)
+            if isinstance(c_file, zipfile.ZipFile):
+                return c_file.read(member.name)
+
+            info = self._tar_info(c_file, member.archive, member.name)
+            return c_file.extractfile(info).read()
+
+    def open(self, member):
+        '''
+        member's content, file object
+        '''
+        return io.BytesIO(self.read(member))
+
+    def extract(self, member, to_dir):
+        '''
+        write member to to_dir/basename, return the full path filename
+        '''
+        full_filename = os.path.join(to_dir, member.basename)
+        with open(full_filename, 'wb') as f:
+            f.write(self.read(member))
+        return full_filename
+
+    def close(self):
+        with self._lock:
+            for c_file in self._archives.values():
+                c_file.close()
+            self._archives = {}
+            self._tar_infos = {}
+            self._locks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
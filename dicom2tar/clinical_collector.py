@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+'''
+rows sort_rule_clinical flags while sorting, for errorInfo.tsv and OR_dates.tsv
+
+    ClinicalCollector: error and OR date rows, deduplicated in memory, written once per run by
+                       clinical_helpers.combine_error_info_tsv/combine_or_dates
+'''
+
+
+class ClinicalCollector(object):
+    '''
+    errorInfo rows(subject, date, series, issue) and OR date rows(subject, or_date), as sets of tuples.
+
+    rows added in a worker process reach the main process through drain()/update():
+    DicomSorter drains the worker's collector after each file and updates the sort rule's collector
+    with the rows. drain() forgets the rows, a worker outlives a run(main's --watch keeps its pool warm), a row
+    seen in an earlier run is drained again.
+
+    attributes:
+        error_rows: set of errorInfo rows
+        or_date_rows: set of OR date rows
+
+    Usage:
+        collector = ClinicalCollector()
+        collector.add_error(['P001', '2019_01_02', '0003', 'SR'])
+        collector.add_or_date(['P001', '2019_01_02'])
+    '''
+
+    def __init__(self):
+        self.error_rows = set()
+        self.or_date_rows = set()
+        # rows added since the last drain()
+        self._new_error_rows = []
+        self._new_or_date_rows = []
+
+    def add_error(self, row):
+        row = tuple(row)
+        if row not in self.error_rows:
+            self.error_rows.add(row)
+            self._new_error_rows.append(row)
+
+    def add_or_date(self, row):
+        row = tuple(row)
+        if row not in self.or_date_rows:
+            self.or_date_rows.add(row)
+            self._new_or_date_rows.append(row)
+
+    def drain(self):
+        '''
+        output:
+            (error rows, OR date rows) added since the last drain(), for update() of another collector
+        '''
+        rows = (self._new_error_rows, self._new_or_date_rows)
+        self.clear()
+        return rows
+
+    def update(self, rows):
+        '''
+        input:
+            rows: drain()'s output
+        '''
+        error_rows, or_date_rows = rows
+        for row in error_rows:
+            self.add_error(row)
+        for row in or_date_rows:
+            self.add_or_date(row)
+
+    def clear(self):
+        self.__init__()
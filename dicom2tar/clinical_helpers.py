@@ -6,97 +6,101 @@ Created on Mon May 13 14:03:24 2019
 """
 import os
 import numpy as np
-import pandas as pd
-from tempfile import mkdtemp
 import  tarfile
-import shutil
 import csv
+import functools
+from collections import OrderedDict
 
-def tarSession(tar_dir, source_dir, modality_sep):
+def tarSession(tar_dir, source_dir, modality_sep, sessions=None):
+    # sessions: assign_sessions' output for the tars of this run, None: every .tar in tar_dir
+    if sessions is None:
+        sessions = assign_sessions([os.path.join(tar_dir, f) for f in os.listdir(tar_dir) if f.endswith('.tar')])
     
-    tar_files = [f for f in os.listdir(tar_dir) if f.endswith('.tar')]
-    subjects = np.unique([x.split('_')[0] for x in tar_files])
-    isub = 0
-    for isub in range(len(subjects)):
-        tar_files_sub = [f for f in os.listdir(tar_dir) if f.startswith(subjects[isub])]
-        tar_files_sub_check = tar_files_sub[0].split('_')
-        if len(tar_files_sub_check) > 7:
-            print('Incorrect .tar filname for subject ' + subjects[isub])
-            continue
-        else:
-            tar_files_dates = [x.split('_')[4] for x in tar_files_sub]
-            date_sort_idx = np.argsort(tar_files_dates)
-            
-            tar_files_sub = [tar_files_sub[i] for i in date_sort_idx]
-            tar_files_dates = [tar_files_dates[i] for i in date_sort_idx]
-            
-            sessionDates = {'date':[],'session':[]}
-            session = 1
-            for idate in range(len(tar_files_dates)):
-                if modality_sep:
-                    sessionDates['date'].append(tar_files_dates[idate])
-                    sessionDates['session'].append(str(session).zfill(3))
-                    session += 1
-                else:
-                    sessionDates['date'].append(tar_files_dates[idate])
-                    sessionDates['session'].append(str(session).zfill(3))
-                    session += 1
-                    
-            sessionDates = pd.DataFrame.from_dict(sessionDates)
-            
-            for i in range(len(tar_files_sub)):
-                
-                session = sessionDates.loc[i,'session']
-                tmpdir = mkdtemp(prefix='DCM')
-                
-                tf = tarfile.open(os.path.join(tar_dir,tar_files_sub[i]))
-                tmembers = tf.getmembers()
-                for tm in tmembers:
-                    tm.mode = 0o700
-                tf_content = [m.name for m in tmembers if m.isfile()]
-                fullTarPath = [os.path.join(tmpdir, f) for f in tf_content]
-                tf.extractall(path=tmpdir, members=tmembers)
-                tf.close()
-                
-                newName = tar_files_sub[i].split('_')
-                newName = os.path.join(tar_dir, '_'.join([newName[0], session] + newName[1:]))
-                
-                with tarfile.open(newName, "w") as tar:
-                    for filename in fullTarPath:
-                        original_full_filename = filename
-                        newName = filename.split('\\')[-1].split('/')
-                        firstPart = '_'.join([newName[0].split('_')[0], session, newName[0].split('_')[1], newName[0].split('_')[2], newName[0].split('_')[3]])
-                        lastPart = '_'.join([newName[-1].split('_')[0], session, newName[-1][5:]])
-                        newName[0] = firstPart
-                        newName[-1] = lastPart
-                        arcname = '/'.join(newName)
-                        tar.add(original_full_filename, arcname=arcname)
+    for tar_full_filename, session in sessions.items():
+        tar_file_dir, tar_filename = os.path.split(tar_full_filename)
+        
+        newName = tar_filename.split('_')
+        newName = os.path.join(tar_file_dir, '_'.join([newName[0], session] + newName[1:]))
         
-                shutil.rmtree(tmpdir)
-                os.remove(os.path.join(tar_dir, tar_files_sub[i]))    
-                
-                print('Finished subject ' + subjects[isub] + ' session ' + session)
+        rename_tar_members(tar_full_filename, newName,
+                           functools.partial(session_arcname, session=session))
+        os.remove(tar_full_filename)    
+        
+        print('Finished subject ' + tar_filename.split('_')[0] + ' session ' + session)
 
-def combine_or_dates(source_dir, tar_dir):
-    subs = [f for f in os.listdir(source_dir) if f.startswith('sub')]
-    masterList = []
-    for isub in range(len(subs)):
-        path_to_sub = os.path.join(source_dir, subs[isub])
-        my_file = os.path.join(path_to_sub, 'OR_dates.tsv')
-        if os.path.exists(my_file):
-            with open(my_file, 'r') as readFile:
-                reader = csv.reader(readFile, delimiter='\t')
-                next(reader, None)
-                lines = list(reader)
-            if len(lines)>1:
-                sortedDates = [x[1] for x in lines]
-                dateSort = np.argsort(sortedDates)
-                for isort in range(len(dateSort)):
-                    masterList.append(lines[dateSort[isort]])
-            else:
-                masterList.append(lines[0])
-            
-            os.remove(my_file) 
+def assign_sessions(tar_full_filenames):
+    '''
+    session number of each clinical tar: a subject's tars numbered in date order, in one pass.
+    an .attached.tar(non-imaging) isn't a session of its own, it gets its imaging tar's number
+
+    input:
+        tar_full_filenames: DicomSorter.tar()'s tar files(subject_yyyy_mm_dd_date_..._.tar), TarErrors are skipped
+    output:
+        OrderedDict {tar_full_filename: '001', ...}, by subject then date, an .attached.tar after its imaging tar
+    '''
+    # subject -> {(date, imaging tar_full_filename): [tar_full_filename, ...]}
+    subjects = OrderedDict()
+    incorrect = set()
+    for tar_full_filename in tar_full_filenames:
+        if not isinstance(tar_full_filename, str) or not tar_full_filename.endswith('.tar'):
+            continue
+        parts = os.path.basename(tar_full_filename).split('_')
+        if len(parts) > 7:
+            incorrect.add(parts[0])
+            continue
+        # an .attached.tar without its imaging tar(e.g. the imaging tar failed) is numbered in its place
+        imaging_tar_full_filename = tar_full_filename.replace('.attached.tar', '.tar')
+        subjects.setdefault(parts[0], {}).setdefault(
+            (parts[4], imaging_tar_full_filename), []).append(tar_full_filename)
+
+    sessions = OrderedDict()
+    for subject in sorted(set(subjects) | incorrect):
+        if subject in incorrect:
+            print('Incorrect .tar filname for subject ' + subject)
+            continue
+        for session, key in enumerate(sorted(subjects[subject]), 1):
+            # the imaging tar first
+            for tar_full_filename in sorted(subjects[subject][key], key=lambda name: name.endswith('.attached.tar')):
+                sessions[tar_full_filename] = str(session).zfill(3)
+
+    return sessions
+
+def session_arcname(name, session):
+    # subject_date/.../subject_rest -> subject_session_date/.../subject_session_rest
+    newName = name.split('/')
+    firstPart = '_'.join([newName[0].split('_')[0], session, newName[0].split('_')[1], newName[0].split('_')[2], newName[0].split('_')[3]])
+    lastPart = '_'.join([newName[-1].split('_')[0], session, newName[-1][5:]])
+    newName[0] = firstPart
+    newName[-1] = lastPart
+    return '/'.join(newName)
+
+def rename_tar_members(tar_filename, new_tar_filename, rename):
+    '''
+    copy tar_filename's files to new_tar_filename, renamed, streamed member by member:
+    the data is copied from one tar to the other, nothing is extracted
+
+    input:
+        tar_filename: tar file to read
+        new_tar_filename: tar file to write
+        rename: function, member name -> new member name
+    '''
+    with tarfile.open(tar_filename) as tf:
+        with tarfile.open(new_tar_filename, "w") as tar:
+            for tm in tf:
+                if not tm.isfile():
+                    continue
+                fileobj = tf.extractfile(tm)
+                tm.name = rename(tm.name)
+                # a long name read from a pax header would be written back instead of the new one
+                tm.pax_headers.pop('path', None)
+                tar.addfile(tm, fileobj)
+
+def combine_or_dates(source_dir, tar_dir, collector=None):
+    # collector: clinical_collector.ClinicalCollector of the run, None: read the per subject OR_dates.tsv files
+    if collector is not None:
+        masterList = [list(x) for x in sorted(collector.or_date_rows)]
+    else:
+        masterList = read_or_dates(source_dir)
             
     if not masterList: 
         if os.path.exists(os.path.join(source_dir, 'or_dates.tsv')):
@@ -111,7 +115,8 @@ def combine_or_dates(source_dir, tar_dir):
             reader = csv.reader(readFile, delimiter='\t')
             next(reader, None)
             lines = list(reader)
-        masterList = lines + [x for x in masterList if x not in lines]
+        existing = set(tuple(x) for x in lines)
+        masterList = lines + [x for x in masterList if tuple(x) not in existing]
         finalList = sorted(masterList, key=lambda x: (x[0], x[1]))
     else:
         finalList = masterList
@@ -122,20 +127,52 @@ def combine_or_dates(source_dir, tar_dir):
         for i in range(len(finalList)):
             writeFile.write("\t".join(finalList[i]))
             writeFile.write( "\n" )
+
+def read_or_dates(source_dir):
+    # OR_dates.tsv of each subject directory, written by earlier versions, removed once read
+    subs = [f for f in os.listdir(source_dir) if f.startswith('sub')]
+    masterList = []
+    for isub in range(len(subs)):
+        path_to_sub = os.path.join(source_dir, subs[isub])
+        my_file = os.path.join(path_to_sub, 'OR_dates.tsv')
+        if os.path.exists(my_file):
+            with open(my_file, 'r') as readFile:
+                reader = csv.reader(readFile, delimiter='\t')
+                next(reader, None)
+                lines = list(reader)
+            if len(lines)>1:
+                sortedDates = [x[1] for x in lines]
+                dateSort = np.argsort(sortedDates)
+                for isort in range(len(dateSort)):
+                    masterList.append(lines[dateSort[isort]])
+            else:
+                masterList.append(lines[0])
             
-def combine_error_info_tsv(source_dir, tar_dir):
-    if os.path.exists(os.path.join(source_dir, 'errorInfo.tsv')):
-        with open(os.path.join(source_dir, 'errorInfo.tsv'), 'r') as readFile:
+            os.remove(my_file) 
+    return masterList
+            
+def combine_error_info_tsv(source_dir, tar_dir, collector=None):
+    # collector: clinical_collector.ClinicalCollector of the run, None: read source_dir's errorInfo.tsv
+    source_file = os.path.join(source_dir, 'errorInfo.tsv')
+    if collector is not None:
+        masterList = [list(x) for x in sorted(collector.error_rows)]
+    elif os.path.exists(source_file):
+        with open(source_file, 'r') as readFile:
             reader = csv.reader(readFile, delimiter='\t')
             next(reader, None)
             masterList = list(reader)
+    else:
+        masterList = []
+
+    if masterList:
         final_file = os.path.join("\\".join(tar_dir.split('\\')[:-1]), 'errorInfo.tsv')
         if os.path.exists(final_file):
             with open(final_file, 'r') as readFile:
                 reader = csv.reader(readFile, delimiter='\t')
                 next(reader, None)
                 lines = list(reader)
-            masterList = lines + [x for x in masterList if x not in lines]
+            existing = set(tuple(x) for x in lines)
+            masterList = lines + [x for x in masterList if tuple(x) not in existing]
             finalList = sorted(masterList, key=lambda x: (x[0], x[1], x[2]))
         else:
             finalList = masterList
@@ -147,4 +184,5 @@ def combine_error_info_tsv(source_dir, tar_dir):
                 writeFile.write("\t".join(finalList[i]))
                 writeFile.write( "\n" )
         
-        os.remove(os.path.join(source_dir, 'errorInfo.tsv')) 
\ No newline at end of file
+        if collector is None:
+            os.remove(source_file)
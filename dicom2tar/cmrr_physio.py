@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+'''
+extract siemens CMRR MB physio log files in this process, on python 2 and 3
+
+a port of extractCMRRPhysio's Unwrapper(https://github.com/CMRR-C2P/MB extractCMRRPhysio.m), working on a
+parsed dataset instead of a filename, so a dataset already read isn't read again
+
+    PHYSIO_TAGS: the tags unwrap needs
+    read_physio_dataset: parse only PHYSIO_TAGS of a dicom file
+    unwrap: write a physio dataset's log files
+
+Note:
+    (0x7fe1,0x1010) is AcquisitionNumber(rows) x columns bytes, columns a multiple of 1024, one log file per
+    1024 columns: [data length, filename length](little endian uint32), filename, at 1024: data
+'''
+
+import os
+import struct
+
+import pydicom
+
+import dicom_header
+
+PHYSIO_DATA_TAG = (0x7fe1, 0x1010)
+PHYSIO_TAGS = ['ImageType', 'AcquisitionNumber',
+               dicom_header.SIEMENS_CSA_NON_IMAGE_TAG, PHYSIO_DATA_TAG]
+
+# a log file's data starts at this offset of its part
+LOG_DATA_OFFSET = 1024
+
+
+def read_physio_dataset(filename, fileobj=None):
+    '''
+    input:
+        filename: full path of dicom file
+        fileobj: read from this file object instead, e.g. a member of a compressed file
+
+    output:
+        pydicom dataset with PHYSIO_TAGS only
+    '''
+    return pydicom.read_file(filename if fileobj is None else fileobj,
+                             specific_tags=PHYSIO_TAGS)
+
+
+def unwrap(dataset, output_directory):
+    '''
+    write the log files(*_ECG.log, *_RESP.log, *_PULS.log, *_EXT.log, *_Info.log) encoded in a CMRR MB
+    physio dataset
+
+    input:
+        dataset: pydicom dataset with PHYSIO_TAGS
+        output_directory: write *.log files to it
+
+    output:
+        list of log files written
+
+    raise:
+        KeyError if a tag is missing, ValueError if (0x7fe1,0x1010) isn't a valid encoding
+    '''
+    data = dataset[PHYSIO_DATA_TAG].value
+    rows = int(dataset.AcquisitionNumber)
+
+    if rows < 1 or len(data) % rows != 0 or (len(data) // rows) % LOG_DATA_OFFSET != 0:
+        raise ValueError('invalid physio data size {} bytes, {} rows'.format(
+            len(data), rows))
+
+    file_count = len(data) // rows // LOG_DATA_OFFSET
+    part_length = len(data) // file_count
+
+    log_filenames = []
+    for start in range(0, len(data), part_length):
+        part = data[start:start + part_length]
+        data_length, filename_length = struct.unpack('<II', part[:8])
+
+        # basename: a log file can't be written outside output_directory
+        log_filename = os.path.basename(
+            part[8:8 + filename_length].decode('utf-8'))
+        if not log_filename:
+            raise ValueError('physio log file {} has no name'.format(
+                len(log_filenames) + 1))
+
+        full_log_filename = os.path.join(output_directory, log_filename)
+        with open(full_log_filename, 'wb') as f:
+            f.write(part[LOG_DATA_OFFSET:LOG_DATA_OFFSET + data_length])
+
+        log_filenames.append(full_log_filename)
+
+    return log_filenames
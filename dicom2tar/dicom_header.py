@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+'''
+read a dicom file's header once, and keep the few tags dicom2tar needs in a small record
+
+    DicomHeader: the record, shared by the sort rules and the non-imaging check
+    read_header: parse a dicom file into a DicomHeader
+    as_header: accept a filename or a DicomHeader, return a DicomHeader
+    filename_of: accept a filename or a DicomHeader, return the filename
+    is_dicom: cheap check of the 'DICM' magic, before pydicom is called
+'''
+
+from collections import namedtuple
+
+import pydicom
+
+# the tags the sort rules and the non-imaging check read.
+# a missing tag is None in the record
+HEADER_TAGS = ('StudyDescription', 'StudyDate', 'PatientName', 'StudyID',
+               'StudyInstanceUID', 'SeriesNumber', 'SeriesDescription',
+               'InstanceNumber', 'SOPInstanceUID', 'Modality', 'Manufacturer',
+               'ImageType')
+
+# non-imaging markers
+DICOMRAW_WRAPPED_TAG = (0x0177, 0x0010)
+SIEMENS_CSA_NON_IMAGE_TAG = (0x7fe1, 0x0010)
+SIEMENS_PHYSIO_IMAGE_TYPE = ('ORIGINAL', 'PRIMARY', 'RAWDATA', 'PHYSIO')
+
+# read_header(tags=...) reads these too: text decoding, dedup/manifest and the non-imaging check
+ALWAYS_READ_TAGS = ('SpecificCharacterSet', 'SOPInstanceUID', 'ImageType',
+                    DICOMRAW_WRAPPED_TAG, SIEMENS_CSA_NON_IMAGE_TAG)
+
+# dicom file: 128 bytes preamble, then 'DICM'
+DICOM_PREAMBLE_LENGTH = 128
+DICOM_MAGIC = b'DICM'
+# a dataset without preamble starts with a file meta(0x0002) or identifying(0x0008) group tag, little endian
+PREAMBLELESS_FIRST_GROUPS = (b'\x02\x00', b'\x08\x00')
+PREAMBLELESS_MODES = ('reject', 'sniff', 'parse')
+
+
+class DicomHeader(namedtuple('DicomHeader',
+                             ('filename',) + HEADER_TAGS +
+                             ('is_dicomraw_wrapped', 'is_siemens_CMRR_MB_physio', 'dataset'))):
+    '''
+    header record of one dicom file
+
+    attributes:
+        filename: full path of the dicom file
+        StudyDescription ... ImageType: tag values as str/int/tuple, None if missing or empty
+        is_dicomraw_wrapped: wrapped by Igor's script (Robarts^CFMM in (0x0177,0x0010))
+        is_siemens_CMRR_MB_physio: siemens CMRR MB physio ('SIEMENS CSA NON-IMAGE' in (0x7fe1,0x0010))
+        dataset: the parsed pydicom dataset if read with keep_dataset=True, otherwise None
+    '''
+    __slots__ = ()
+
+    @property
+    def is_non_imaging(self):
+        return self.is_dicomraw_wrapped or self.is_siemens_CMRR_MB_physio
+
+
+def _text(value):
+    '''
+    private tags may come back as bytes on python 3
+    '''
+    if isinstance(value, bytes) and not isinstance(value, str):
+        value = value.decode('latin-1')
+    return str(value).strip()
+
+
+def _tag_value(dataset, keyword):
+    if keyword not in dataset:
+        return None
+
+    value = getattr(dataset, keyword)
+    if value is None or value == '':
+        return None
+
+    if keyword in ('SeriesNumber', 'InstanceNumber'):
+        return int(value)
+    if keyword == 'ImageType':
+        # single valued ImageType is a str, multi valued is a MultiValue
+        if isinstance(value, str):
+            value = [value]
+        return tuple(_text(v) for v in value)
+    return _text(value)
+
+
+def header_from_dataset(dataset, filename, keep_dataset=False):
+    '''
+    build a DicomHeader from an already parsed pydicom dataset
+    '''
+    values = dict((keyword, _tag_value(dataset, keyword))
+                  for keyword in HEADER_TAGS)
+
+    # dicomraw wrapped (wrapped by Igor's script)
+    is_dicomraw_wrapped = \
+        DICOMRAW_WRAPPED_TAG in dataset and \
+        _text(dataset[DICOMRAW_WRAPPED_TAG].value).startswith('Robarts^CFMM')
+
+    # siemens CMRR MB sequence
+    is_siemens_CMRR_MB_physio = \
+        values['ImageType'] == SIEMENS_PHYSIO_IMAGE_TYPE and \
+        SIEMENS_CSA_NON_IMAGE_TAG in dataset and \
+        _text(dataset[SIEMENS_CSA_NON_IMAGE_TAG].value) == 'SIEMENS CSA NON-IMAGE'
+
+    return DicomHeader(filename=filename,
+                       is_dicomraw_wrapped=is_dicomraw_wrapped,
+                       is_siemens_CMRR_MB_physio=is_siemens_CMRR_MB_physio,
+                       dataset=dataset if keep_dataset else None,
+                       **values)
+
+
+def read_header(filename, force=False, keep_dataset=False, fileobj=None, tags=None):
+    '''
+    read filename's header (pixel data skipped) once
+
+    input:
+        filename: full path of dicom file
+        force: passed to pydicom, read files without the 'DICM' preamble
+        keep_dataset: keep the parsed dataset in the record, for rules needing more than HEADER_TAGS
+        fileobj: read from this file object instead, e.g. a member of a compressed file, filename is only recorded
+        tags: keywords of HEADER_TAGS to read(and ALWAYS_READ_TAGS), the others' values are skipped and None
+              in the record. None: read all
+
+    output:
+        DicomHeader
+
+    raise:
+        whatever pydicom raises on non-dicom or bad dicom files
+    '''
+    if tags is not None:
+        tags = list(tags) + list(ALWAYS_READ_TAGS)
+    dataset = pydicom.read_file(
+        filename if fileobj is None else fileobj, stop_before_pixels=True, force=force,
+        specific_tags=tags)
+    return header_from_dataset(dataset, filename, keep_dataset)
+
+
+def as_header(filename_or_header, force=False, keep_dataset=False, tags=None):
+    '''
+    sort rules accept either a filename or a DicomHeader
+    '''
+    if isinstance(filename_or_header, DicomHeader):
+        if keep_dataset and filename_or_header.dataset is None:
+            return read_header(filename_or_header.filename, force, keep_dataset)
+        return filename_or_header
+
+    return read_header(filename_or_header, force, keep_dataset, tags=tags)
+
+
+def filename_of(filename_or_header):
+    '''
+    sort rules accept either a filename or a DicomHeader, for logging
+    '''
+    if isinstance(filename_or_header, DicomHeader):
+        return filename_or_header.filename
+
+    return filename_or_header
+
+
+def is_dicom(filename, fileobj=None, preambleless='reject'):
+    '''
+    cheap check before pydicom: 128 bytes preamble followed by 'DICM'
+
+    input:
+        filename: full path of the file
+        fileobj: check this file object instead, its position is kept
+        preambleless: what to do with files without 'DICM'
+            'reject': not dicom
+            'sniff': dicom if it starts with a group 0x0002/0x0008 tag
+            'parse': don't check, leave it to pydicom(read with force=True)
+
+    output:
+        True if the file should be read by pydicom
+    '''
+    if preambleless == 'parse':
+        return True
+
+    length = DICOM_PREAMBLE_LENGTH + len(DICOM_MAGIC)
+    if fileobj is None:
+        with open(filename, 'rb') as f:
+            head = f.read(length)
+    else:
+        position = fileobj.tell()
+        head = fileobj.read(length)
+        fileobj.seek(position)
+
+    if head[DICOM_PREAMBLE_LENGTH:] == DICOM_MAGIC:
+        return True
+
+    if preambleless == 'sniff':
+        return head[:2] in PREAMBLELESS_FIRST_GROUPS
+
+    return False
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+'''
+memory-bounded grouping of scan results, for DicomSorter.tar() on millions of files
+
+    GroupStore: scan results grouped by tar, held compactly(shared directory strings) and spilled
+                to disk once they take more than a memory limit
+'''
+
+import os
+import sys
+import pickle
+import shutil
+import tempfile
+from collections import OrderedDict
+
+try:
+    # python 2: str and unicode filenames
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+class GroupStore(object):
+    '''
+    entries(original, sorted relative filename, dedup key) grouped by tar_full_filename, in scan order.
+
+    an entry keeps the directory parts of its filenames as shared strings, one per directory, and
+    only its basenames as its own strings. once the entries take more than memory_limit bytes(estimated),
+    each group's entries are appended to the group's spill file and dropped from memory.
+
+    attributes:
+        memory_limit: bytes of entries held in memory
+        spill_dir: parent of the spill files' temp directory
+
+    Usage:
+        with GroupStore(512 * 1024 * 1024, '/tmp') as store:
+            store.add(tar_full_filename, original_full_filename, relative_path_new_filename, key)
+            for tar_full_filename in store.keys():
+                for original_full_filename, relative_path_new_filename, key in store.entries(tar_full_filename):
+                    ...
+    '''
+
+    def __init__(self, memory_limit, spill_dir=None):
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self._groups = OrderedDict()
+        self._counts = {}
+        self._strings = {}
+        self._bytes = 0
+        self._spill_dir_uniq = None
+        self._spill_filenames = {}
+        self.spill_count = 0
+
+    def _share(self, value):
+        shared = self._strings.get(value)
+        if shared is None:
+            shared = self._strings[value] = value
+            self._bytes += sys.getsizeof(value)
+        return shared
+
+    def add(self, group, original_full_filename, relative_path_new_filename, key=None):
+        '''
+        input:
+            group: tar_full_filename
+            original_full_filename: full path filename, or archive_stream.ArchiveMember
+            relative_path_new_filename: sort rule's relative path filename
+            key: dedup key, see DicomSorter.dedup
+        '''
+        if isinstance(original_full_filename, string_types):
+            original_dir, original_base = os.path.split(original_full_filename)
+            original_dir = self._share(original_dir)
+        else:
+            original_dir, original_base = None, original_full_filename
+
+        sorted_dir, sorted_base = os.path.split(relative_path_new_filename)
+        entry = (original_dir, original_base,
+                 self._share(sorted_dir), sorted_base, key)
+
+        if group not in self._groups:
+            self._groups[group] = []
+            self._counts[group] = 0
+        self._groups[group].append(entry)
+        self._counts[group] += 1
+
+        self._bytes += sys.getsizeof(entry) + sys.getsizeof(original_base) + \
+            sys.getsizeof(sorted_base) + (sys.getsizeof(key) if key is not None else 0)
+        if self._bytes > self.memory_limit:
+            self.spill()
+
+    def spill(self):
+        '''
+        append each group's in-memory entries to its spill file
+        '''
+        if self._spill_dir_uniq is None:
+            self._spill_dir_uniq = tempfile.mkdtemp(
+                prefix='DicomSorter_groups', dir=self.spill_dir)
+
+        for group, entries in self._groups.items():
+            if not entries:
+                continue
+
+            if group not in self._spill_filenames:
+                self._spill_filenames[group] = os.path.join(
+                    self._spill_dir_uniq, '{}.pickle'.format(len(self._spill_filenames)))
+
+            with open(self._spill_filenames[group], 'ab') as f:
+                pickle.dump([self._expand(entry)
+                             for entry in entries], f, 2)
+            del entries[:]
+
+        self._strings = {}
+        self._bytes = 0
+        self.spill_count += 1
+
+    def _expand(self, entry):
+        original_dir, original_base, sorted_dir, sorted_base, key = entry
+        if original_dir is None:
+            original_full_filename = original_base
+        else:
+            original_full_filename = os.path.join(original_dir, original_base)
+        return (original_full_filename, os.path.join(sorted_dir, sorted_base), key)
+
+    def keys(self):
+        '''
+        tar_full_filenames, in the order first added
+        '''
+        return list(self._groups.keys())
+
+    def count(self, group):
+        '''
+        number of entries of a group
+        '''
+        return self._counts[group]
+
+    def entries(self, group):
+        '''
+        a group's entries, in the order added
+
+        output:
+            generator of (original_full_filename, relative_path_new_filename, key)
+        '''
+        spill_filename = self._spill_filenames.get(group)
+        if spill_filename is not None:
+            with open(spill_filename, 'rb') as f:
+                while True:
+                    try:
+                        batch = pickle.load(f)
+                    except EOFError:
+                        break
+                    for entry in batch:
+                        yield entry
+
+        for entry in self._groups[group]:
+            yield self._expand(entry)
+
+    def close(self):
+        self._groups = OrderedDict()
+        self._strings = {}
+        if self._spill_dir_uniq is not None:
+            shutil.rmtree(self._spill_dir_uniq, ignore_errors=True)
+            self._spill_dir_uniq = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
@@ -21,43 +21,149 @@ Note:
 '''
 import sys
 import os
+import json
+import time
 import logging
 import argparse
+import multiprocessing
 
 import sort_rules
 import DicomSorter
 
 import clinical_helpers as ch
+import tree_watcher
+import sort_plan
+import shards
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s - %(levelname)s -%(message)s')
 
 
-def main(dicom_dir, output_dir, args):
+def log_tar_full_filenames(tar_full_filenames):
+    '''
+    log DicomSorter.tar()'s result: created tars, and tars failed to write
+    '''
+    logger = logging.getLogger(__name__)
+
+    for item in tar_full_filenames:
+        if isinstance(item, DicomSorter.TarError):
+            logger.error("tar file failed: {}, {}".format(
+                item.tar_full_filename, item.error))
+        else:
+            logger.info("tar file created: {}".format(item))
+
+
+def log_stage_report(stats, report_filename=None):
+    '''
+    log DicomSorter's per stage report(stage_stats.StageStats) as json, and write it to report_filename
+    '''
+    logger = logging.getLogger(__name__)
+
+    report = json.dumps(stats.report(), indent=4)
+    logger.info("stage report: {}".format(report))
+
+    if report_filename:
+        with open(report_filename, 'w') as f:
+            f.write(report)
+        logger.info("stage report written: {}".format(report_filename))
+
+
+def main(dicom_dir, output_dir, args, pool=None):
     '''
     use DicomSorter sort or tar CFMM's dicom data
 
     input:
         dicom_dir: folder contains dicom files(and/or compressed files:.zip/.tgz/.tar.gz/.tar.bz2)
         output_dir: output sorted or tar files to this folder
+        pool: multiprocessing.Pool kept across calls, see watch()
     '''
 
     logger = logging.getLogger(__name__)
 
-    if not os.path.exists(dicom_dir):
+    if dicom_dir is None:
+        # --execute reads the plan's files
+        if not args.execute:
+            logger.error("dicom_dir is required, except with --execute or --merge_shards")
+            return False
+    elif not os.path.exists(dicom_dir):
         logger.error("{} not exist!".format(dicom_dir))
         return False
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    # incremental re-runs: manifest of input files, next to the tar files
+    if args.incremental:
+        manifest_filename = os.path.join(
+            output_dir, '.dicom2tar_manifest.sqlite')
+    else:
+        manifest_filename = None
+
+    # profiling: json stage report and cProfile of the scan, next to the tar files
+    if args.profile:
+        report_filename = os.path.join(output_dir, 'dicom2tar_profile.json')
+        profile_filename = os.path.join(output_dir, 'dicom2tar_scan.prof')
+    else:
+        report_filename = None
+        profile_filename = None
+
+    # memory-bounded grouping, MB
+    if args.group_memory_limit:
+        group_memory_limit = args.group_memory_limit * 1024 * 1024
+    else:
+        group_memory_limit = None
+
+    # CFMM sort rule only: the clinical branch sorts with sort_rule_clinical and tars in one go
+    if args.clinical_scans:
+        cfmm_options = [option for option, value in (('--sort_template', args.sort_template),
+                                                     ('--plan', args.plan),
+                                                     ('--execute', args.execute),
+                                                     ('--execute_tars', args.execute_tars),
+                                                     ('--compression', args.compression),
+                                                     ('--compress_jobs', args.compress_jobs != 1)) if value]
+        if cfmm_options:
+            logger.error("{} not supported with --clinical_scans".format(
+                ', '.join(cfmm_options)))
+            return False
+
+    # sharding: this process writes only its share of the tars
+    shard = args.shard
+    if shard is not None and args.clinical_scans:
+        logger.error("--shard is not supported with --clinical_scans, "
+                     "a subject's sessions are numbered across all its tars")
+        return False
+
+    # DicomSorter's per stage report, logged even if the run fails
+    stats = None
+
     ######
     # CFMM sort rule
     ######
     try:
         if not args.clinical_scans:
 
-            with DicomSorter.DicomSorter(dicom_dir, sort_rules.sort_rule_CFMM, output_dir, args) as d:
+            # --sort_template: a compiled sort rule, missing tags fall back as in sort_rule_CFMM
+            if args.sort_template:
+                sort_rule = sort_rules.compile_sort_rule(
+                    args.sort_template, sort_rules.CFMM_DEFAULTS)
+            else:
+                sort_rule = sort_rules.sort_rule_CFMM
+
+            with DicomSorter.DicomSorter(dicom_dir, sort_rule, output_dir,
+                                         args, jobs=args.jobs, stream_archives=args.stream_archives,
+                                         tar_jobs=args.tar_jobs, unwrap_jobs=args.unwrap_jobs,
+                                         preambleless=args.preambleless,
+                                         manifest_filename=manifest_filename,
+                                         dedup=args.dedup, dedup_verify=args.dedup_verify,
+                                         unwrap_timeout=args.unwrap_timeout,
+                                         compression=args.compression,
+                                         compress_jobs=args.compress_jobs,
+                                         profile_filename=profile_filename,
+                                         group_memory_limit=group_memory_limit,
+                                         stream_tar=args.stream_tar,
+                                         max_open_tars=args.max_open_tars,
+                                         pool=pool, shard=shard) as d:
+                stats = d.stats
                 # #######
                 # # sort
                 # #######
@@ -70,10 +176,33 @@ def main(dicom_dir, output_dir, args):
                 # tar
                 #######
                 # pi/project/study_date/patient/studyID_and_hash_studyInstanceUID
-                tar_full_filenames = d.tar(5)
-                # logging
-                for item in tar_full_filenames:
-                    logger.info("tar file created: {}".format(item))
+                start = time.time()
+                tar_full_filenames = None
+                if args.plan:
+                    # which file goes to which tar, written later by --execute
+                    plan = d.plan(args.tar_depth)
+                    if plan is not None:
+                        sort_plan.write_plan(args.plan, plan)
+                        logger.info("plan written: {}".format(args.plan))
+                elif args.execute:
+                    tar_full_filenames = d.execute(
+                        sort_plan.read_plan(args.execute), args.execute_tars)
+                    log_tar_full_filenames(tar_full_filenames or [])
+                else:
+                    tar_full_filenames = d.tar(args.tar_depth)
+                    # logging, None: no dicom files
+                    log_tar_full_filenames(tar_full_filenames or [])
+
+                if shard is not None and not args.plan:
+                    tar_full_filenames = tar_full_filenames or []
+                    shard_report_filename = shards.write_shard_report(
+                        output_dir, shard,
+                        [item for item in tar_full_filenames if not isinstance(
+                            item, DicomSorter.TarError)],
+                        [item for item in tar_full_filenames if isinstance(
+                            item, DicomSorter.TarError)],
+                        time.time() - start)
+                    logger.info("shard report written: {}".format(shard_report_filename))
 
             # ######
             # # demo sort rule
@@ -98,44 +227,237 @@ def main(dicom_dir, output_dir, args):
             ######
             logger.info("These are clinical scans.")
 
-            with DicomSorter.DicomSorter(dicom_dir, sort_rules.sort_rule_clinical, output_dir, args) as d:
+            # errorInfo/OR date rows of this run only
+            collector = sort_rules.sort_rule_clinical.collector
+            collector.clear()
+
+            with DicomSorter.DicomSorter(dicom_dir, sort_rules.sort_rule_clinical, output_dir,
+                                         args, jobs=args.jobs, stream_archives=args.stream_archives,
+                                         tar_jobs=args.tar_jobs, unwrap_jobs=args.unwrap_jobs,
+                                         preambleless=args.preambleless,
+                                         manifest_filename=manifest_filename,
+                                         dedup=args.dedup, dedup_verify=args.dedup_verify,
+                                         unwrap_timeout=args.unwrap_timeout,
+                                         profile_filename=profile_filename,
+                                         group_memory_limit=group_memory_limit,
+                                         stream_tar=args.stream_tar,
+                                         max_open_tars=args.max_open_tars,
+                                         pool=pool, shard=shard) as d:
+                stats = d.stats
                 # tar
                 # study_date/patient/modality/series_number/new_filename.dcm
                 tar_full_filenames = d.tar(4)
 
-                # logging
-                for item in tar_full_filenames:
-                    logger.info("tar file created: {}".format(item))
+                # logging, None: no dicom files
+                log_tar_full_filenames(tar_full_filenames or [])
 
-            ch.tarSession(output_dir, dicom_dir, modality_sep=True)
-            ch.combine_or_dates(dicom_dir, output_dir)
-            ch.combine_error_info_tsv(dicom_dir, output_dir)
+            with stats.stage('tar_session'):
+                # session numbers of this run's tars
+                sessions = ch.assign_sessions(tar_full_filenames or [])
+                ch.tarSession(output_dir, dicom_dir, modality_sep=True, sessions=sessions)
+                ch.combine_or_dates(dicom_dir, output_dir, collector)
+                ch.combine_error_info_tsv(dicom_dir, output_dir, collector)
 
     except Exception as e:
         logger.exception(e)
 
+    if stats is not None:
+        log_stage_report(stats, report_filename)
 
-def run():
 
-    # arg parser
+# --watch: each study's tars, output_dir's are merged from them
+WATCH_PARTS_DIRNAME = '.dicom2tar_watch'
+
+
+def watch(dicom_dir, output_dir, args, polls=None):
+    '''
+    long-running: tar each study(subdirectory of dicom_dir) once it has been quiet for args.quiet_period
+    seconds, and again if it changes later. the process, its imports and its worker pool stay up between studies
+
+    each study is tarred to output_dir/WATCH_PARTS_DIRNAME/<study>/, output_dir's tars are merged from them by
+    tar name(see tree_watcher.merge_tar_groups): a study split over several subdirectories goes into one tar
+
+    input:
+        polls: stop after this many polls, None: run until interrupted
+    '''
+    logger = logging.getLogger(__name__)
+
+    if dicom_dir is None:
+        logger.error("dicom_dir is required with --watch")
+        return False
+    if not os.path.exists(dicom_dir):
+        logger.error("{} not exist!".format(dicom_dir))
+        return False
+
+    # like --shard, a subject's clinical sessions are numbered across all its tars
+    if args.clinical_scans:
+        logger.error("--watch is not supported with --clinical_scans")
+        return False
+
+    watcher = tree_watcher.TreeWatcher(dicom_dir, args.quiet_period)
+    loose_files = watcher.loose_files()
+    if loose_files:
+        logger.error("{} files in {} are not in a study subdirectory, move them into one: {}".format(
+            len(loose_files), dicom_dir, ', '.join(loose_files)))
+        return False
+
+    parts_dir = os.path.join(output_dir, WATCH_PARTS_DIRNAME)
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+    logger.info("watching {}, quiet period {}s".format(
+        dicom_dir, args.quiet_period))
+
+    try:
+        while polls is None or polls > 0:
+            for study_dir in watcher.poll():
+                logger.info("study complete: {}".format(study_dir))
+                study_parts_dir = os.path.join(
+                    parts_dir, os.path.basename(study_dir))
+                main(study_dir, study_parts_dir, args, pool)
+                if os.path.isdir(study_parts_dir):
+                    for tar_full_filename in tree_watcher.merge_tar_groups(
+                            parts_dir, output_dir, os.listdir(study_parts_dir)):
+                        logger.info("tar file updated: {}".format(tar_full_filename))
+                watcher.done(study_dir)
+
+            if polls is not None:
+                polls -= 1
+                if not polls:
+                    break
+            time.sleep(args.poll_interval)
+    except KeyboardInterrupt:
+        logger.info("stopped watching {}".format(dicom_dir))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return True
+
+
+def merge_shards(output_dir):
+    '''
+    merge the --shard runs' reports in output_dir, log missing shards, failed tars and tars written twice
+    '''
+    logger = logging.getLogger(__name__)
+
+    merged = shards.merge_shard_reports(output_dir)
+    logger.info("{} of {} shards done, {} tar files, {} failed".format(
+        len(merged['done']), merged['shards'], len(merged['tars']), len(merged['errors'])))
+    if merged['missing']:
+        logger.error("shards missing: {}".format(merged['missing']))
+    for tar_full_filename, error in merged['errors']:
+        logger.error("tar file failed: {}, {}".format(tar_full_filename, error))
+    if merged['overlapping']:
+        logger.error("tar files written by more than one shard: {}".format(
+            merged['overlapping']))
+    logger.info("merged report written: {}".format(
+        os.path.join(output_dir, shards.MERGED_REPORT_FILENAME)))
+
+    return merged
+
+
+def build_parser():
+    '''
+    dicom2tar's argument parser
+    '''
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("dicom_dir")
+    parser.add_argument("dicom_dir", nargs='?',
+                        help="not needed with --execute or --merge_shards")
     parser.add_argument('output_dir')
     parser.add_argument("--clinical_scans", action="store_true")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of processes reading dicom headers, 0: one per cpu")
+    parser.add_argument("--tar_jobs", type=int, default=1,
+                        help="number of tar files written at the same time")
+    parser.add_argument("--unwrap_jobs", type=int, default=1,
+                        help="number of non-imaging dicom files unwrapped at the same time")
+    parser.add_argument("--unwrap_timeout", type=float,
+                        help="seconds dicomunwrap/extractCMRRPhysio may run on one file")
+    parser.add_argument("--preambleless", choices=['reject', 'sniff', 'parse'],
+                        help="files without the dicom preamble and 'DICM': reject, sniff the first tag, or parse. "
+                             "default: parse for --clinical_scans, otherwise reject")
+    parser.add_argument("--incremental", action="store_true",
+                        help="keep a manifest of input files in output_dir, re-runs only parse changed files "
+                             "and only rewrite tar files whose files changed")
+    parser.add_argument("--dedup", choices=['SOPInstanceUID', 'sorted'],
+                        help="drop duplicate instances(same SOPInstanceUID, or same sorted filename) before writing")
+    parser.add_argument("--dedup_verify", action="store_true",
+                        help="compare duplicates' content, conflicting duplicates are kept, renamed "
+                             "name.conflict_<sha1>.dcm")
+    parser.add_argument("--stream_archives", action="store_true",
+                        help="read compressed files in memory instead of extracting them to a temp directory")
+    parser.add_argument("--compression", choices=['gz', 'bz2'],
+                        help="compress tar files(*.tar.gz/*.tar.bz2), not for --clinical_scans")
+    parser.add_argument("--compress_jobs", type=int, default=1,
+                        help="number of threads compressing one tar file, not for --clinical_scans")
+    parser.add_argument("--group_memory_limit", type=int,
+                        help="MB of scan results held in memory, more are spilled to disk, for millions of files. "
+                             "duplicates(--dedup) are dropped within each tar file. not with --incremental")
+    parser.add_argument("--stream_tar", action="store_true",
+                        help="write tar files while scanning, not with --incremental, --group_memory_limit "
+                             "or --compression")
+    parser.add_argument("--max_open_tars", type=int, default=64,
+                        help="--stream_tar: number of tar files kept open")
+    parser.add_argument("--profile", action="store_true",
+                        help="write a per stage report(dicom2tar_profile.json) and a cProfile of the scan"
+                             "(dicom2tar_scan.prof) to output_dir. bytes read by the scan and unwrap are only "
+                             "measured with --profile")
+    parser.add_argument("--sort_template",
+                        help="sort with a path template instead of CFMM's rule, e.g. "
+                             "'{pi}/{project}/{StudyDate}/{patient}/{StudyID}.{hash:StudyInstanceUID}/"
+                             "{SeriesNumber:04d}/{upper:patient}.{Modality}.{SeriesNumber:04d}.{InstanceNumber:04d}.dcm', "
+                             "see sort_rules.compile_sort_rule. not for --clinical_scans")
+    parser.add_argument("--tar_depth", type=int, default=5,
+                        help="number of leading directories of the sorted path naming a tar file")
+    parser.add_argument("--plan",
+                        help="scan and apply the sort rule only, write which file goes to which tar to this json "
+                             "file, see --execute. not for --clinical_scans")
+    parser.add_argument("--execute",
+                        help="write the tar files of a --plan json file, without reading dicom headers again. "
+                             "not for --clinical_scans")
+    parser.add_argument("--execute_tars", nargs='+',
+                        help="--execute: write only these tar files(names without extension), e.g. failed ones")
+    parser.add_argument("--shard", type=shards.parse_shard,
+                        help="i/N(0 <= i < N): write only shard i's tar files, e.g. --shard $SLURM_ARRAY_TASK_ID/8. "
+                             "each tar belongs to one shard, every shard scans all files(or use --execute). "
+                             "writes dicom2tar_shard_i_of_N.json to output_dir. not with --incremental")
+    parser.add_argument("--merge_shards", action="store_true",
+                        help="merge the shards' reports in output_dir into dicom2tar_shards.json, nothing is tarred")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running, tar each subdirectory(study) of dicom_dir once no file in it has changed "
+                             "for --quiet_period seconds, and again if it changes later. each study's tars are kept "
+                             "in output_dir/.dicom2tar_watch, tars of the same name are merged into output_dir. "
+                             "not with --clinical_scans")
+    parser.add_argument("--quiet_period", type=float, default=120,
+                        help="--watch: seconds a study must stay unchanged before it is tarred")
+    parser.add_argument("--poll_interval", type=float, default=10,
+                        help="--watch: seconds between polls of dicom_dir")
     parser.add_argument("--StudyDescription",
                         nargs='?', default='PI^Project')
     parser.add_argument("--StudyDate",
                         nargs='?', default='19000101')
     parser.add_argument("--PatientName",
                         nargs='?', default='Anonymous')
-    args = parser.parse_args()
+
+    return parser
+
+
+def run():
+
+    # arg parser
+    args = build_parser().parse_args()
 
     dicom_dir = args.dicom_dir
     output_dir = args.output_dir
 
     # main
-    main(dicom_dir, output_dir, args)
+    if args.merge_shards:
+        merge_shards(output_dir)
+    elif args.watch:
+        watch(dicom_dir, output_dir, args)
+    else:
+        main(dicom_dir, output_dir, args)
 
 
 if __name__ == "__main__":
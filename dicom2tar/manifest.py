@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+'''
+persistent manifest of input files, for incremental DicomSorter.tar() re-runs
+
+    Manifest: sqlite database of input files(path, size, mtime, SOPInstanceUID, sorted filename, tar)
+              and of input compressed files(path, size, mtime)
+
+Note:
+    the manifest doesn't record the sort rule or its args, remove it after changing them.
+    runs on different dicom_dirs may share a manifest(the same output_dir), each run only replaces the rows
+    under its dicom_dir
+'''
+
+import os
+import sqlite3
+import pickle
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    archive TEXT,
+    member TEXT,
+    size INTEGER,
+    mtime REAL,
+    sop_instance_uid TEXT,
+    sorted TEXT,
+    tar TEXT,
+    header BLOB
+);
+CREATE INDEX IF NOT EXISTS files_tar ON files (tar);
+CREATE INDEX IF NOT EXISTS files_archive ON files (archive);
+CREATE TABLE IF NOT EXISTS archives (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL
+);
+'''
+
+
+class Manifest(object):
+    '''
+    sqlite manifest of input files
+
+    a file row:
+        path: absolute full path filename, or str(archive_stream.ArchiveMember) of an absolute compressed file
+        archive, member: compressed file and member name, if the file is inside a compressed file
+        size, mtime: os.stat of the file, or the member's size and mtime
+        sop_instance_uid: SOPInstanceUID
+        sorted: sort rule's relative path filename, None if the sort rule skipped the file
+        tar: absolute full path of the tar the file went into, None if not written
+        header: pickled dicom_header.DicomHeader
+
+    Usage:
+        with Manifest('/path/to/output_dir/.dicom2tar_manifest.sqlite') as m:
+            row = m.lookup(path, size, mtime)
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._connection = sqlite3.connect(filename)
+        self._connection.executescript(SCHEMA)
+
+    def lookup(self, path, size, mtime):
+        '''
+        output:
+            (sorted, header) if path is unchanged since recorded, otherwise None
+        '''
+        row = self._connection.execute(
+            'SELECT sorted, header FROM files WHERE path = ? AND archive IS NULL AND size = ? AND mtime = ?',
+            (path, size, mtime)).fetchone()
+        if row is None:
+            return None
+
+        return row[0], self._loads(row[1])
+
+    def lookup_archive(self, path, size, mtime):
+        '''
+        output:
+            [(member, size, mtime, sorted, header), ...] if the compressed file is unchanged since recorded,
+            otherwise None
+        '''
+        row = self._connection.execute(
+            'SELECT 1 FROM archives WHERE path = ? AND size = ? AND mtime = ?',
+            (path, size, mtime)).fetchone()
+        if row is None:
+            return None
+
+        rows = self._connection.execute(
+            'SELECT member, size, mtime, sorted, header FROM files WHERE archive = ? ORDER BY rowid',
+            (path,)).fetchall()
+        return [(member, member_size, member_mtime, sorted_filename, self._loads(header))
+                for member, member_size, member_mtime, sorted_filename, header in rows]
+
+    def paths(self, root=None):
+        '''
+        recorded paths under root, all if root is None, set
+        '''
+        if root is None:
+            return set(row[0] for row in self._connection.execute('SELECT path FROM files'))
+
+        prefix = self._prefix(root)
+        return set(row[0] for row in self._connection.execute(
+            'SELECT path FROM files WHERE substr(path, 1, ?) = ?', (len(prefix), prefix)))
+
+    def tar_paths(self, tar):
+        '''
+        paths recorded as written into tar, set
+        '''
+        return set(row[0] for row in self._connection.execute(
+            'SELECT path FROM files WHERE tar = ?', (os.path.abspath(tar),)))
+
+    def tars_of(self, paths):
+        '''
+        tars the given paths were recorded in, set
+        '''
+        tars = set()
+        for path in paths:
+            row = self._connection.execute(
+                'SELECT tar FROM files WHERE path = ?', (path,)).fetchone()
+            if row is not None and row[0] is not None:
+                tars.add(row[0])
+        return tars
+
+    def update(self, file_rows, archive_rows, root=None):
+        '''
+        replace the manifest's rows under root(all rows if root is None) with a run's rows, in one transaction
+
+        input:
+            file_rows: [(path, archive, member, size, mtime, sop_instance_uid, sorted, tar, header), ...]
+            archive_rows: [(path, size, mtime), ...]
+            root: the run's absolute dicom_dir, rows of other dicom_dirs are kept
+        '''
+        # the same tar, whether output_dir was given relative or absolute
+        file_rows = [row[:7] + (os.path.abspath(row[7]) if row[7] else None,) + row[8:]
+                     for row in file_rows]
+
+        with self._connection:
+            if root is None:
+                self._connection.execute('DELETE FROM files')
+                self._connection.execute('DELETE FROM archives')
+            else:
+                # substr, not LIKE: LIKE is case insensitive and '_' is a wildcard
+                prefix = self._prefix(root)
+                for table in ('files', 'archives'):
+                    self._connection.execute(
+                        'DELETE FROM {} WHERE substr(path, 1, ?) = ?'.format(table), (len(prefix), prefix))
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [row[:8] + (self._dumps(row[8]),) for row in file_rows])
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO archives VALUES (?, ?, ?)', archive_rows)
+
+    def _prefix(self, root):
+        '''
+        path prefix of the files under root
+        '''
+        return os.path.join(os.path.abspath(root), '')
+
+    def _dumps(self, header):
+        if header is None:
+            return None
+        return sqlite3.Binary(pickle.dumps(header, 2))
+
+    def _loads(self, blob):
+        if blob is None:
+            return None
+        return pickle.loads(bytes(blob))
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+'''
+write gzip or bz2 compressed tar files, compressing independent blocks on a thread pool
+
+    ParallelCompressedFile: write-only file object, each block is compressed into its own gzip member(or bz2
+                            stream), concatenated in order, which is a valid multi-member .gz(or .bz2) file
+    open_tar: tarfile.TarFile for writing, uncompressed or compressed with ParallelCompressedFile
+
+Note:
+    zlib and bz2 release the GIL while compressing, threads are enough.
+    python 2's bz2 module reads only the first stream of a multi-stream .bz2 file, use gz there
+'''
+
+import bz2
+import zlib
+import tarfile
+import contextlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+COMPRESSIONS = ('gz', 'bz2')
+
+# tar filename extension of each compression
+COMPRESSION_EXTS = {None: '', 'gz': '.gz', 'bz2': '.bz2'}
+
+
+def _compress_gz(block, compresslevel):
+    # wbits 16+15: gzip header and trailer, a complete gzip member
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush()
+
+
+def _compress_bz2(block, compresslevel):
+    return bz2.compress(block, compresslevel)
+
+
+class ParallelCompressedFile(object):
+    '''
+    write-only compressed file, blocks compressed on a thread pool, written in order
+
+    attributes:
+        filename: output filename
+        compression: 'gz' or 'bz2'
+        jobs: number of compressing threads
+        block_size: uncompressed bytes per block
+        compresslevel: 1-9, default 9 as tarfile's
+
+    Usage:
+        f = ParallelCompressedFile('/path/to/file.tar.gz', 'gz', jobs=4)
+        f.write(data)
+        f.close()
+    '''
+
+    def __init__(self, filename, compression, jobs=1, block_size=4 * 1024 * 1024, compresslevel=9):
+        if compression == 'gz':
+            self._compress = _compress_gz
+        elif compression == 'bz2':
+            self._compress = _compress_bz2
+        else:
+            raise ValueError(
+                'compression must be one of {}'.format(COMPRESSIONS))
+
+        self.name = filename
+        self.mode = 'wb'
+        self.jobs = max(1, jobs)
+        self.block_size = block_size
+        self.compresslevel = compresslevel
+
+        self._file = open(filename, 'wb')
+        self._pool = ThreadPool(self.jobs) if self.jobs > 1 else None
+        self._buffer = []
+        self._buffer_size = 0
+        self._pending = deque()
+        self._offset = 0
+        self.closed = False
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        self._offset += len(data)
+        if self._buffer_size >= self.block_size:
+            self._submit()
+
+    def tell(self):
+        '''
+        uncompressed bytes written, tarfile keeps track of its offset with it
+        '''
+        return self._offset
+
+    def _submit(self):
+        block = b''.join(self._buffer)
+        self._buffer = []
+        self._buffer_size = 0
+        if not block:
+            return
+
+        if self._pool is None:
+            self._file.write(self._compress(block, self.compresslevel))
+            return
+
+        self._pending.append(self._pool.apply_async(
+            self._compress, (block, self.compresslevel)))
+
+        # bound memory: no more than 2 blocks per thread in flight
+        while len(self._pending) > 2 * self.jobs:
+            self._file.write(self._pending.popleft().get())
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._submit()
+            while self._pending:
+                self._file.write(self._pending.popleft().get())
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+@contextlib.contextmanager
+def open_tar(filename, compression=None, jobs=1):
+    '''
+    tarfile.TarFile for writing
+
+    input:
+        filename: tar filename, with its extension(.tar, .tar.gz, .tar.bz2)
+        compression: None, 'gz' or 'bz2'
+        jobs: number of compressing threads
+    '''
+    if compression is None:
+        with tarfile.open(filename, "w") as tar:
+            yield tar
+        return
+
+    fileobj = ParallelCompressedFile(filename, compression, jobs)
+    try:
+        with tarfile.open(fileobj=fileobj, mode="w") as tar:
+            yield tar
+    finally:
+        fileobj.close()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+'''
+place a sorted file at its destination, for DicomSorter.sort()
+
+    PLACEMENTS: 'copy', 'hardlink', 'symlink', 'reflink', 'move'
+    place: place one file, falling back to a copy where the placement isn't possible
+
+Note:
+    hardlink and move are metadata operations on the same filesystem only.
+    reflink(copy-on-write clone) is the FICLONE ioctl, linux on btrfs/xfs, a copy everywhere else.
+'''
+
+import os
+import errno
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    # windows
+    fcntl = None
+
+PLACEMENTS = ('copy', 'hardlink', 'symlink', 'reflink', 'move')
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# errors meaning "not possible here", the file is copied instead
+FALLBACK_ERRNOS = set(getattr(errno, name) for name in
+                      ('EXDEV', 'EOPNOTSUPP', 'ENOTSUP', 'ENOTTY', 'EINVAL', 'EPERM', 'EMLINK', 'ENOSYS')
+                      if hasattr(errno, name))
+
+
+def _reflink(src, dst):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflink not supported', dst)
+
+    with open(src, 'rb') as src_file:
+        with open(dst, 'wb') as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            except IOError as e:
+                # python 2's ioctl raises IOError
+                raise OSError(e.errno, e.strerror, dst)
+    shutil.copymode(src, dst)
+
+
+def place(src, dst, placement='copy'):
+    '''
+    place src at dst, dst is replaced if it exists
+
+    input:
+        src: full path filename
+        dst: full path filename, its directory must exist
+        placement: one of PLACEMENTS
+
+    output:
+        the placement done: placement, or 'copy' if placement isn't possible here(e.g. a hardlink across
+        filesystems, a reflink on ext4)
+    '''
+    if placement == 'copy':
+        shutil.copy(src, dst)
+        return 'copy'
+
+    if placement == 'move':
+        # os.rename on the same filesystem, copy and remove otherwise
+        shutil.move(src, dst)
+        return 'move'
+
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    try:
+        if placement == 'hardlink':
+            os.link(src, dst)
+        elif placement == 'symlink':
+            os.symlink(os.path.abspath(src), dst)
+        elif placement == 'reflink':
+            _reflink(src, dst)
+        else:
+            raise ValueError(
+                'placement must be one of {}'.format(PLACEMENTS))
+    except (OSError, AttributeError) as e:
+        # AttributeError: no os.link/os.symlink on this platform
+        if isinstance(e, OSError) and e.errno not in FALLBACK_ERRNOS:
+            raise
+        if os.path.lexists(dst):
+            os.remove(dst)
+        shutil.copy(src, dst)
+        return 'copy'
+
+    return placement
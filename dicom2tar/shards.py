@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+'''
+split one dicom_dir's tar files across processes(e.g. SLURM array tasks), each tar owned by one shard
+
+    parse_shard: '2/8' -> (2, 8)
+    shard_of: the shard owning a tar group key(tar filename without extension, see DicomSorter.tar())
+    write_shard_report/merge_shard_reports: each shard's result in output_dir, merged once all shards are done
+
+Note:
+    every shard scans all files, a tar's group is only known once its files' headers are read.
+    the writing is split. --plan once, then --execute with --shard splits the writing without scanning again
+'''
+
+import os
+import re
+import json
+import hashlib
+from collections import OrderedDict
+
+SHARD_REPORT_FORMAT = 'dicom2tar_shard_{}_of_{}.json'
+SHARD_REPORT_RE = re.compile(r'^dicom2tar_shard_(\d+)_of_(\d+)\.json$')
+MERGED_REPORT_FILENAME = 'dicom2tar_shards.json'
+
+
+def parse_shard(shard):
+    '''
+    input:
+        shard: 'i/N', 0 <= i < N
+
+    output:
+        (i, N)
+
+    raise:
+        ValueError
+    '''
+    try:
+        index, count = [int(part) for part in shard.split('/')]
+    except ValueError:
+        raise ValueError('shard must be i/N, got {}'.format(shard))
+
+    if not 0 <= index < count:
+        raise ValueError('shard i/N needs 0 <= i < N, got {}'.format(shard))
+
+    return index, count
+
+
+def shard_of(tar_group_key, count):
+    '''
+    the shard(0..count-1) owning a tar group, the same in every process and on every python version
+    '''
+    digest = hashlib.sha1(tar_group_key.encode('utf-8')).hexdigest()
+    return int(digest[:15], 16) % count
+
+
+def write_shard_report(output_dir, shard, tar_full_filenames, tar_errors, seconds=None):
+    '''
+    record a shard's result in output_dir
+
+    input:
+        shard: (i, N)
+        tar_full_filenames: tar files written
+        tar_errors: [(tar_full_filename, error), ...] of the tars failed to write
+
+    output:
+        the report's filename
+    '''
+    index, count = shard
+    report = OrderedDict([('shard', index),
+                          ('shards', count),
+                          ('seconds', seconds),
+                          ('tars', list(tar_full_filenames)),
+                          ('errors', [[tar_full_filename, str(error)] for tar_full_filename, error in tar_errors])])
+
+    report_filename = os.path.join(
+        output_dir, SHARD_REPORT_FORMAT.format(index, count))
+    with open(report_filename, 'w') as f:
+        json.dump(report, f, indent=4)
+
+    return report_filename
+
+
+def merge_shard_reports(output_dir, count=None):
+    '''
+    merge the shard reports in output_dir into MERGED_REPORT_FILENAME
+
+    input:
+        count: number of shards, None: taken from the reports
+
+    output:
+        the merged report: shards, missing shards, tars, errors, and tars written by more than one shard(should
+        be empty)
+    '''
+    reports = {}
+    for name in sorted(os.listdir(output_dir)):
+        match = SHARD_REPORT_RE.match(name)
+        if match is None:
+            continue
+        index, shards = int(match.group(1)), int(match.group(2))
+        if count is not None and shards != count:
+            continue
+        with open(os.path.join(output_dir, name)) as f:
+            reports[index] = json.load(f)
+        count = shards
+
+    owners = OrderedDict()
+    errors = []
+    for index in sorted(reports):
+        for tar_full_filename in reports[index]['tars']:
+            owners.setdefault(tar_full_filename, []).append(index)
+        errors.extend(reports[index]['errors'])
+
+    merged = OrderedDict([('shards', count),
+                          ('done', sorted(reports)),
+                          ('missing', [index for index in range(count or 0) if index not in reports]),
+                          ('tars', list(owners)),
+                          ('errors', errors),
+                          ('overlapping', [tar_full_filename for tar_full_filename, indexes in owners.items()
+                                           if len(indexes) > 1])])
+
+    with open(os.path.join(output_dir, MERGED_REPORT_FILENAME), 'w') as f:
+        json.dump(merged, f, indent=4)
+
+    return merged
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+'''
+a sort plan: DicomSorter.plan()'s scan results, as json, for DicomSorter.execute() to write the tars later,
+e.g. plan on a login node, execute on an I/O node, or rerun failed writes without parsing headers again
+
+    write_plan/read_plan: save/load a plan
+    item_row/row_item: one scan result <-> one compact row
+    PLAN_VERSION: format version, checked by read_plan
+
+plan format:
+    {"version": 1, "dicom_dir": ..., "depth": 5, "tar_filename_sep": "_",
+     "tars": {"PI_Project_19700101_1970_01_01_T2_1.9AC66A0D": [row, ...], ...}}
+
+    row: [original, sorted relative filename, size, non_imaging]
+        original: full path filename, or [compressed file, member name, size, mtime] for a member of a
+                  compressed file, see archive_stream.ArchiveMember
+        non_imaging: None, 'dicomraw'(wrapped by Igor's script) or 'cmrr_physio'(siemens CMRR MB physio)
+'''
+
+import json
+
+import dicom_header
+import archive_stream
+
+PLAN_VERSION = 1
+
+NON_IMAGING_KINDS = ('dicomraw', 'cmrr_physio')
+
+
+def item_row(item, size):
+    '''
+    input:
+        item: [original_full_filename, relative_path_new_filename, header], see DicomSorter._walk_and_apply_sort_rule
+        size: the original's size in bytes
+    '''
+    original, relative_path_new_filename, header = item[:3]
+
+    if isinstance(original, archive_stream.ArchiveMember):
+        original = list(original)
+
+    non_imaging = None
+    if header is not None and header.is_dicomraw_wrapped:
+        non_imaging = 'dicomraw'
+    elif header is not None and header.is_siemens_CMRR_MB_physio:
+        non_imaging = 'cmrr_physio'
+
+    return [original, relative_path_new_filename, size, non_imaging]
+
+
+def row_item(row):
+    '''
+    output:
+        [original_full_filename, relative_path_new_filename, header]. header only has the non-imaging flags,
+        None for imaging files, enough for unwrapping
+    '''
+    original, relative_path_new_filename, size, non_imaging = row
+
+    if isinstance(original, list):
+        original = archive_stream.ArchiveMember(*original)
+
+    header = None
+    if non_imaging is not None:
+        if isinstance(original, archive_stream.ArchiveMember):
+            filename = str(original)
+        else:
+            filename = original
+        tags = dict((keyword, None) for keyword in dicom_header.HEADER_TAGS)
+        header = dicom_header.DicomHeader(filename=filename,
+                                          is_dicomraw_wrapped=non_imaging == 'dicomraw',
+                                          is_siemens_CMRR_MB_physio=non_imaging == 'cmrr_physio',
+                                          dataset=None, **tags)
+
+    return [original, relative_path_new_filename, header]
+
+
+def write_plan(filename, plan):
+    with open(filename, 'w') as f:
+        json.dump(plan, f, separators=(',', ':'))
+
+
+def read_plan(filename):
+    '''
+    raise:
+        ValueError if the plan's version isn't PLAN_VERSION
+    '''
+    with open(filename) as f:
+        plan = json.load(f)
+
+    if plan.get('version') != PLAN_VERSION:
+        raise ValueError('{}: plan version {} not supported, expected {}'.format(
+            filename, plan.get('version'), PLAN_VERSION))
+
+    return plan
@@ -4,6 +4,10 @@ dicom sort rule functions:
 
     sort_rule_demo: a simple demo sort rule
     sort_rule_CFMM: CFMM's sort rule
+    sort_rule_clinical: clinical sort rule
+    compile_sort_rule: a sort rule from a path template, e.g. CFMM_TEMPLATE
+
+    each rule takes a dicom filename, or its dicom_header.DicomHeader already read by DicomSorter
 
 Author: YingLi Lu
 Email:  yinglilu@gmail.com
@@ -15,13 +19,18 @@ note:
 
 import os
 import re
+import string
 import pydicom
 import logging
-import csv
+import threading
+from collections import OrderedDict
 import dcmstack as ds
 
+import dicom_header
+import clinical_collector
+
 
-def sort_rule_demo(filename):
+def sort_rule_demo(filename, args=None):
     '''
     A simple sort rule:
 
@@ -34,7 +43,8 @@ def sort_rule_demo(filename):
         ...
 
     intput:
-        filename: dicom filename
+        filename: dicom filename, or its dicom_header.DicomHeader
+        args: unused, keep the same signature with sort_rule_CFMM
     output:
         a dictionary:
             key: filename
@@ -47,25 +57,26 @@ def sort_rule_demo(filename):
         return re.sub(r'[^a-zA-Z0-9.-]', '_', '{0}'.format(path))
 
     try:
-        dataset = pydicom.read_file(filename, stop_before_pixels=True)
+        header = dicom_header.as_header(filename)
 
-        patient_name = clean_path(dataset.PatientName.replace('^', '_'))
+        patient_name = clean_path(header.PatientName.replace('^', '_'))
         #print('patient_name', patient_name)
-        study_date = clean_path(dataset.StudyDate)
+        study_date = clean_path(header.StudyDate)
         series_number = clean_path(
-            '{series_number:04d}'.format(series_number=dataset.SeriesNumber))
+            '{series_number:04d}'.format(series_number=header.SeriesNumber))
 
         path = os.path.join(patient_name, study_date, series_number)
         sorted_filename = '{patient}.{study_date}.{series_number}.{image_instance_number:04d}.dcm'.format(
             patient=patient_name,
             study_date=study_date,
-            series_number=dataset.SeriesNumber,
-            image_instance_number=dataset.InstanceNumber,
+            series_number=header.SeriesNumber,
+            image_instance_number=header.InstanceNumber,
         )
         sorted_filename = clean_path(sorted_filename)
 
     except Exception as e:
-        logger.exception('something wrong with {}'.format(filename))
+        logger.exception('something wrong with {}'.format(
+            dicom_header.filename_of(filename)))
         logger.exception(e)
         return None
 
@@ -73,12 +84,98 @@ def sort_rule_demo(filename):
     return sorted_full_filename
 
 
+# sort_rule_CFMM's study and series parts, by raw tag values, least recently used dropped first
+CFMM_CACHE_SIZE = 1024
+_cfmm_study_cache = OrderedDict()
+_cfmm_series_cache = OrderedDict()
+_cache_lock = threading.RLock()
+
+_CLEAN_PATH_RE = re.compile(r'[^a-zA-Z0-9.-]')
+
+
+def _clean_path(path):
+    return _CLEAN_PATH_RE.sub('_', '{0}'.format(path))
+
+
+def _hashcode(value):
+    code = 0
+    for character in value:
+        code = (code * 31 + ord(character)) & 0xffffffff
+    return '{0:08X}'.format(code)
+
+
+def _cached(cache, key, compute):
+    '''
+    cache[key], compute() if missing. at most CFMM_CACHE_SIZE entries.
+    the caches are shared by storage_scp's association threads, _cfmm_series nests _cfmm_study's
+    '''
+    with _cache_lock:
+        value = cache.pop(key, None)
+        if value is None:
+            value = compute()
+        cache[key] = value
+        if len(cache) > CFMM_CACHE_SIZE:
+            cache.popitem(last=False)
+        return value
+
+
+def _cfmm_study(StudyDescription, StudyDate, PatientName, StudyID, StudyInstanceUID):
+    '''
+    output:
+        (pi, project, study_date, patient, studyID_and_hash_studyInstanceUID) of sort_rule_CFMM
+    '''
+    pi_project = StudyDescription.replace('^', ' ').split()
+    pi = _clean_path(pi_project[0])
+    project = _clean_path(pi_project[1])
+
+    study_date = _clean_path(StudyDate)
+
+    patient = _clean_path(PatientName.partition('^')[0])
+
+    if not StudyInstanceUID:
+        StudyInstanceUID = pydicom.uid.generate_uid()
+
+    studyID_and_hash_studyInstanceUID = _clean_path('.'.join([StudyID,
+                                                              _hashcode(StudyInstanceUID)]))
+
+    return pi, project, study_date, patient, studyID_and_hash_studyInstanceUID
+
+
+def _cfmm_series(StudyDescription, StudyDate, PatientName, StudyID, StudyInstanceUID, SeriesNumber, Modality):
+    '''
+    output:
+        (path, prefix) of sort_rule_CFMM: pi/project/study_date/patient/studyID_and_hash_studyInstanceUID/series_number,
+        and the sorted filename's clean '{patient}.{modality}.{study}.'
+    '''
+    study_key = (StudyDescription, StudyDate,
+                 PatientName, StudyID, StudyInstanceUID)
+    if StudyInstanceUID:
+        study = _cached(_cfmm_study_cache, study_key,
+                        lambda: _cfmm_study(*study_key))
+    else:
+        study = _cfmm_study(*study_key)
+    pi, project, study_date, patient, studyID_and_hash_studyInstanceUID = study
+
+    series_number = _clean_path(
+        '{series:04d}'.format(series=SeriesNumber))
+
+    path = os.path.join(pi, project, study_date, patient,
+                        studyID_and_hash_studyInstanceUID, series_number)
+    prefix = _clean_path('{patient}.{modality}.{study}.'.format(
+        patient=patient.upper(),
+        modality=Modality,
+        study=StudyDescription.upper()))
+
+    return path, prefix
+
+
 def sort_rule_CFMM(filename, args):
     '''
     CFMM's Dicom sort rule
 
     intput:
-        filename: dicom filename
+        filename: dicom filename, or its dicom_header.DicomHeader
+        args: argparse namespace, fallback StudyDescription/StudyDate/PatientName
     output:
         a dictionary:
             key: filename
@@ -109,81 +206,59 @@ def sort_rule_CFMM(filename, args):
 
     logger = logging.getLogger(__name__)
 
-    def clean_path(path):
-        return re.sub(r'[^a-zA-Z0-9.-]', '_', '{0}'.format(path))
-
-    def hashcode(value):
-        code = 0
-        for character in value:
-            code = (code * 31 + ord(character)) & 0xffffffff
-        return '{0:08X}'.format(code)
-
     try:
-        dataset = pydicom.read_file(filename, stop_before_pixels=True)
+        header = dicom_header.as_header(filename)
 
         # StudyDescription
         # CFMM's newer data:'PI^project'->['PI','project']
         # CFMM's older GE data:'PI project'->['PI','project']
-        if 'StudyDescription' in dataset and len(dataset.StudyDescription) > 0:
-            StudyDescription = dataset.StudyDescription
+        if header.StudyDescription:
+            StudyDescription = header.StudyDescription
         else:
             StudyDescription = args.StudyDescription
 
-        pi_project = StudyDescription.replace('^', ' ').split()
-        pi = clean_path(pi_project[0])
-        project = clean_path(pi_project[1])
-
         # StudyDate
-        if 'StudyDate' in dataset and len(dataset.StudyDate) > 0:
-            StudyDate = dataset.StudyDate
+        if header.StudyDate:
+            StudyDate = header.StudyDate
         else:
             StudyDate = args.StudyDate
 
-        study_date = clean_path(StudyDate)
-
         # PatientName
-        if 'PatientName' in dataset and len(dataset.PatientName) > 0:
-            PatientName = dataset.PatientName
+        if header.PatientName:
+            PatientName = header.PatientName
         else:
             PatientName = args.PatientName
 
-        patient = clean_path(PatientName.partition('^')[0])
-
-        # studyID_and_hash_studyInstanceUID
-
-        if 'StudyID' in dataset and len(dataset.StudyID) > 0:
-            StudyID = dataset.StudyID
+        if header.StudyID:
+            StudyID = header.StudyID
         else:
             StudyID = 'NA'
 
-        if 'StudyInstanceUID' in dataset and len(dataset.StudyInstanceUID) > 0:
-            StudyInstanceUID = dataset.StudyInstanceUID
-        else:
-            StudyInstanceUID = pydicom.uid.generate_uid()
-
-        studyID_and_hash_studyInstanceUID = clean_path('.'.join([StudyID,
-                                                                 hashcode(StudyInstanceUID)]))
+        if header.Modality is None:
+            raise ValueError('Modality missing')
 
-        # SeriesNumber
-        series_number = clean_path(
-            '{series:04d}'.format(series=dataset.SeriesNumber))
-
-        path = os.path.join(pi, project, study_date, patient,
-                            studyID_and_hash_studyInstanceUID, series_number)
-        sorted_filename = '{patient}.{modality}.{study}.{series:04d}.{image:04d}.{date}.{unique}.dcm'.format(
-            patient=patient.upper(),
-            modality=dataset.Modality,
-            study=StudyDescription.upper(),
-            series=dataset.SeriesNumber,
-            image=dataset.InstanceNumber,
-            date=StudyDate,
-            unique=hashcode(dataset.SOPInstanceUID),
+        # the study/series part of path and filename, the same for every file of a series
+        series_key = (StudyDescription, StudyDate, PatientName, StudyID,
+                      header.StudyInstanceUID, header.SeriesNumber, header.Modality)
+        if header.StudyInstanceUID:
+            path, prefix = _cached(_cfmm_series_cache, series_key,
+                                   lambda: _cfmm_series(*series_key))
+        else:
+            # a new StudyInstanceUID for each file, nothing to cache
+            path, prefix = _cfmm_series(*series_key)
+
+        # prefix and the numbers need no clean_path
+        sorted_filename = '{prefix}{series:04d}.{image:04d}.{date}.{unique}.dcm'.format(
+            prefix=prefix,
+            series=header.SeriesNumber,
+            image=header.InstanceNumber,
+            date=_clean_path(StudyDate),
+            unique=_hashcode(header.SOPInstanceUID),
         )
 
-        sorted_filename = clean_path(sorted_filename)
-
     except Exception as e:
-        logger.exception('something wrong with {}'.format(filename))
+        logger.exception('something wrong with {}'.format(
+            dicom_header.filename_of(filename)))
         logger.exception(e)
         return None
 
@@ -192,7 +267,7 @@ def sort_rule_CFMM(filename, args):
     return sorted_full_filename
 
 
-def sort_rule_clinical(filename):
+def sort_rule_clinical(filename, args=None):
     '''
     Clinical sort rule:
 
@@ -205,29 +280,16 @@ def sort_rule_clinical(filename):
                 |-series_number
                 ...
     intput:
-        filename: dicom filename
+        filename: dicom filename, or its dicom_header.DicomHeader
+        args: unused, keep the same signature with sort_rule_CFMM
     output:
         a dictionary:
             key: filename
             value: patient_name/study_date/modality/sereis_number/{patient}.{modality}.{series:04d}.{image:04d}.{study_date}.{unique}.dcm
 
     '''
-    def write_error_file(my_file, errorInfoTemp):
-        if os.path.exists(my_file):
-            with open(my_file, 'r') as readFile:
-                reader = csv.reader(readFile, delimiter='\t')
-                lines = list(reader)
-                if errorInfoTemp.split('\t') not in lines:
-                    with open(my_file, 'a') as writeFile:
-                        writeFile.write(errorInfoTemp)
-                        writeFile.write("\n")
-        else:
-            with open(my_file, 'w') as writeFile:
-                writeFile.write(
-                    "\t".join(['subject', 'date', 'series', 'issue']))
-                writeFile.write("\n")
-                writeFile.write(errorInfoTemp)
-                writeFile.write("\n")
+    def write_error_file(errorInfoTemp):
+        sort_rule_clinical.collector.add_error(errorInfoTemp.split('\t'))
 
     def clean_path(path):
         return re.sub(r'[^a-zA-Z0-9.-]', '_', '{0}'.format(path))
@@ -238,122 +300,100 @@ def sort_rule_clinical(filename):
             code = (code * 31 + ord(character)) & 0xffffffff
         return '{0:08X}'.format(code)
 
+    filename_or_header = filename
+    filename = dicom_header.filename_of(filename_or_header)
+
     # This will ignore any dicomdir present in the folder
     if all(['DICOMDIR' not in filename, not filename.endswith('OR_dates.tsv')]):
         logger = logging.getLogger(__name__)
 
         try:
-            dataset = pydicom.read_file(
-                filename, stop_before_pixels=True, force=True)
-            study_date = dataset.StudyDate[0:4] + '_' + \
-                dataset.StudyDate[4:6] + '_' + dataset.StudyDate[6:8]
+            header = dicom_header.as_header(
+                filename_or_header, force=True, keep_dataset=True)
+            study_date = header.StudyDate[0:4] + '_' + \
+                header.StudyDate[4:6] + '_' + header.StudyDate[6:8]
 
             # This will skip any order sheets
-            if dataset.Modality in {'SR', 'PR'}:
+            if header.Modality in {'SR', 'PR'}:
                 errorInfoTemp = "\t".join(['P' + [s for s in filename.split('\\') if 'sub' in s][0].split('-')[1], study_date,
-                                           clean_path('{series:04d}'.format(series=dataset.SeriesNumber)), dataset.Modality])
-                my_file = os.path.join("\\".join(filename.split('\\')[:[i for i, s in enumerate(
-                    filename.split('\\')) if 'sub' in s][0]]), 'errorInfo.tsv')
-                write_error_file(my_file, errorInfoTemp)
+                                           clean_path('{series:04d}'.format(series=header.SeriesNumber)), header.Modality])
+                write_error_file(errorInfoTemp)
                 return None
 
             # This will skip any order sheets and localizers
-            elif [x for x in dataset.ImageType if x in {'SECONDARY', 'LOCALIZER'}]:
+            elif [x for x in header.ImageType if x in {'SECONDARY', 'LOCALIZER'}]:
                 return None
             else:
-                if 'SIEMENS' in dataset.Manufacturer:
+                if 'SIEMENS' in header.Manufacturer:
                     errorInfoTemp = "\t".join(['P' + [s for s in filename.split('\\') if 'sub' in s][0].split('-')[1], study_date,
-                                               clean_path('{series:04d}'.format(series=dataset.SeriesNumber)), 'SIEMENS'])
-                    my_file = os.path.join("\\".join(filename.split('\\')[:[i for i, s in enumerate(
-                        filename.split('\\')) if 'sub' in s][0]]), 'errorInfo.tsv')
-                    write_error_file(my_file, errorInfoTemp)
+                                               clean_path('{series:04d}'.format(series=header.SeriesNumber)), 'SIEMENS'])
+                    write_error_file(errorInfoTemp)
                     return None
                 else:
                     try:
-                        csaReader = ds.wrapper_from_data(dataset)
-                        modality = dataset.Modality
+                        csaReader = ds.wrapper_from_data(header.dataset)
+                        modality = header.Modality
 
                         # --- INTRAOP X-RAY determination
                         if any(substring in modality for substring in {'Intraoperative', 'Skull', 'OT', 'XA', 'RF'}):
-                            if 'CR' not in dataset.Modality:
-                                or_date = dataset.StudyDate[0:4] + '_' + \
-                                    dataset.StudyDate[4:6] + \
-                                    '_' + dataset.StudyDate[6:8]
+                            if 'CR' not in header.Modality:
+                                or_date = header.StudyDate[0:4] + '_' + \
+                                    header.StudyDate[4:6] + \
+                                    '_' + header.StudyDate[6:8]
                                 orDateTemp = "\t".join(
                                     ['P' + [s for s in filename.split('\\') if 'sub' in s][0].split('-')[1], or_date])
-                                my_file = os.path.join("\\".join(filename.split('\\')[:[i for i, s in enumerate(
-                                    filename.split('\\')) if 'sub' in s][0]+1]), 'OR_dates.tsv')
-
-                                if os.path.exists(my_file):
-                                    with open(my_file, 'r') as readFile:
-                                        reader = csv.reader(
-                                            readFile, delimiter='\t')
-                                        lines = list(reader)
-                                        if orDateTemp.split('\t') not in lines:
-                                            with open(my_file, 'a') as writeFile:
-                                                writeFile.write(orDateTemp)
-                                                writeFile.write("\n")
-                                else:
-                                    with open(my_file, 'w') as writeFile:
-                                        writeFile.write(
-                                            "\t".join(['subject', 'or_date']))
-                                        writeFile.write("\n")
-                                        writeFile.write(orDateTemp)
-                                        writeFile.write("\n")
+                                sort_rule_clinical.collector.add_or_date(
+                                    orDateTemp.split('\t'))
                                 return None
 
-                            elif all(['CR' in dataset.Modality, 'Skull Routine Portable' in dataset.StudyDescription]):
+                            elif all(['CR' in header.Modality, 'Skull Routine Portable' in header.StudyDescription]):
                                 errorInfoTemp = "\t".join(['P' + [s for s in filename.split('\\') if 'sub' in s][0].split('-')[1], study_date,
-                                                           clean_path('{series:04d}'.format(series=dataset.SeriesNumber)), dataset.StudyDescription])
-                                my_file = os.path.join("\\".join(filename.split('\\')[:[i for i, s in enumerate(
-                                    filename.split('\\')) if 'sub' in s][0]]), 'errorInfo.tsv')
-                                write_error_file(my_file, errorInfoTemp)
+                                                           clean_path('{series:04d}'.format(series=header.SeriesNumber)), header.StudyDescription])
+                                write_error_file(errorInfoTemp)
                                 return None
                             else:
                                 patient = 'P' + \
                                     [s for s in filename.split('\\') if 'sub' in s][0].split(
                                         '-')[1] + '_' + study_date
                                 series_number = clean_path(
-                                    '{series:04d}'.format(series=dataset.SeriesNumber))
-                                studyID_and_hash_studyInstanceUID = clean_path('.'.join([dataset.StudyID or 'NA',
-                                                                                         hashcode(dataset.StudyInstanceUID)]))
+                                    '{series:04d}'.format(series=header.SeriesNumber))
+                                studyID_and_hash_studyInstanceUID = clean_path('.'.join([header.StudyID or 'NA',
+                                                                                         hashcode(header.StudyInstanceUID)]))
 
                                 path = os.path.join(
-                                    patient, dataset.StudyDate, studyID_and_hash_studyInstanceUID, modality, series_number)
+                                    patient, header.StudyDate, studyID_and_hash_studyInstanceUID, modality, series_number)
                                 sorted_filename = '{patient}.{modality}.{series:04d}.{image:04d}.{study_date}.{unique}.dcm'.format(
                                     patient=patient.upper(),
                                     modality=modality,
-                                    series=dataset.SeriesNumber,
-                                    image=dataset.InstanceNumber,
-                                    study_date=dataset.StudyDate,
-                                    unique=hashcode(dataset.SOPInstanceUID),
+                                    series=header.SeriesNumber,
+                                    image=header.InstanceNumber,
+                                    study_date=header.StudyDate,
+                                    unique=hashcode(header.SOPInstanceUID),
                                 )
                         else:
-                            if dataset.SeriesDescription.lower() not in {'loc', 'dose report'}:
+                            if header.SeriesDescription.lower() not in {'loc', 'dose report'}:
                                 patient = 'P' + \
                                     [s for s in filename.split('\\') if 'sub' in s][0].split(
                                         '-')[1] + '_' + study_date
                                 series_number = clean_path(
-                                    '{series:04d}'.format(series=dataset.SeriesNumber))
-                                studyID_and_hash_studyInstanceUID = clean_path('.'.join([dataset.StudyID or 'NA',
-                                                                                         hashcode(dataset.StudyInstanceUID)]))
+                                    '{series:04d}'.format(series=header.SeriesNumber))
+                                studyID_and_hash_studyInstanceUID = clean_path('.'.join([header.StudyID or 'NA',
+                                                                                         hashcode(header.StudyInstanceUID)]))
 
                                 path = os.path.join(
-                                    patient, dataset.StudyDate, studyID_and_hash_studyInstanceUID, modality, series_number)
+                                    patient, header.StudyDate, studyID_and_hash_studyInstanceUID, modality, series_number)
                                 sorted_filename = '{patient}.{modality}.{series:04d}.{image:04d}.{study_date}.{unique}.dcm'.format(
                                     patient=patient.upper(),
                                     modality=modality,
-                                    series=dataset.SeriesNumber,
-                                    image=dataset.InstanceNumber,
-                                    study_date=dataset.StudyDate,
-                                    unique=hashcode(dataset.SOPInstanceUID),
+                                    series=header.SeriesNumber,
+                                    image=header.InstanceNumber,
+                                    study_date=header.StudyDate,
+                                    unique=hashcode(header.SOPInstanceUID),
                                 )
                     except Exception as e:
                         errorInfoTemp = "\t".join(['P' + [s for s in filename.split('\\') if 'sub' in s][0].split('-')[1], study_date,
-                                                   clean_path('{series:04d}'.format(series=dataset.SeriesNumber)), 'csaReader'])
-                        my_file = os.path.join("\\".join(filename.split('\\')[:[i for i, s in enumerate(
-                            filename.split('\\')) if 'sub' in s][0]]), 'errorInfo.tsv')
-                        write_error_file(my_file, errorInfoTemp)
+                                                   clean_path('{series:04d}'.format(series=header.SeriesNumber)), 'csaReader'])
+                        write_error_file(errorInfoTemp)
                         return None
 
         except Exception as e:
@@ -366,3 +406,191 @@ def sort_rule_clinical(filename):
             return sorted_full_filename
         else:
             return None
+
+
+# sort_rule_clinical reads files without the 'DICM' preamble, and needs the
+# whole dataset for dcmstack. DicomSorter reads the header with these options
+sort_rule_clinical.read_header_kwargs = {'force': True, 'keep_dataset': True}
+
+# errorInfo/OR date rows the rule flags, written once by clinical_helpers.combine_error_info_tsv/combine_or_dates.
+# DicomSorter collects the rows from its worker processes into it, see DicomSorter._apply_sort_rule_collecting
+sort_rule_clinical.collector = clinical_collector.ClinicalCollector()
+
+
+# compile_sort_rule's template functions, {function:name}
+TEMPLATE_FUNCTIONS = {'hash': _hashcode,
+                      'upper': lambda value: '{0}'.format(value).upper()}
+
+
+def _pi(StudyDescription):
+    # 'PI^project' or 'PI project'
+    return StudyDescription.replace('^', ' ').split()[0]
+
+
+def _project(StudyDescription):
+    return StudyDescription.replace('^', ' ').split()[1]
+
+
+def _patient(PatientName):
+    return PatientName.partition('^')[0]
+
+
+# compile_sort_rule's names derived from a tag: name -> (tag keyword, function)
+TEMPLATE_DERIVED = {'pi': ('StudyDescription', _pi),
+                    'project': ('StudyDescription', _project),
+                    'patient': ('PatientName', _patient)}
+
+# sort_rule_CFMM as a template
+CFMM_TEMPLATE = ('{pi}/{project}/{StudyDate}/{patient}/{StudyID}.{hash:StudyInstanceUID}/{SeriesNumber:04d}/'
+                 '{upper:patient}.{Modality}.{upper:StudyDescription}.{SeriesNumber:04d}.{InstanceNumber:04d}.'
+                 '{StudyDate}.{hash:SOPInstanceUID}.dcm')
+CFMM_DEFAULTS = {'StudyID': 'NA', 'StudyInstanceUID': pydicom.uid.generate_uid}
+
+
+class TemplateSortRule(object):
+    '''
+    a sort rule compiled from a template, see compile_sort_rule
+
+    attributes:
+        template: the template
+        tags: the tag keywords the template reads, read_header_kwargs reads only these(see dicom_header.read_header)
+        read_header_kwargs: see DicomSorter
+    '''
+
+    def __init__(self, template, defaults=None, clean=r'[^a-zA-Z0-9.-]'):
+        self.template = template
+        self.defaults = dict(defaults or {})
+        self.clean = clean
+        self._clean_re = re.compile(clean)
+
+        formatter = string.Formatter()
+        # each path component: [(literal, (function, name) or None, format_spec), ...]
+        self._components = []
+        # the tag keywords of each component
+        component_keywords = []
+        for component in template.split('/'):
+            pieces = []
+            keywords = set()
+            for literal, field, format_spec, conversion in formatter.parse(component):
+                if field is None:
+                    pieces.append((literal, None, ''))
+                    continue
+                if field in TEMPLATE_FUNCTIONS:
+                    function, name, format_spec = field, format_spec, ''
+                else:
+                    function, name = None, field
+                if name in TEMPLATE_DERIVED:
+                    keywords.add(TEMPLATE_DERIVED[name][0])
+                elif name in dicom_header.HEADER_TAGS:
+                    keywords.add(name)
+                else:
+                    raise ValueError('unknown template field {} in {}, must be one of {}'.format(
+                        name, template, sorted(dicom_header.HEADER_TAGS + tuple(TEMPLATE_DERIVED))))
+                pieces.append((literal, (function, name), format_spec))
+            self._components.append(pieces)
+            component_keywords.append(keywords)
+
+        self.tags = tuple(sorted(set().union(*component_keywords)))
+        self.read_header_kwargs = {'tags': self.tags}
+        # the directories are cached by their tags' values
+        self._directory_tags = tuple(
+            sorted(set().union(set(), *component_keywords[:-1])))
+        self._directory_cache = OrderedDict()
+
+    def __getstate__(self):
+        # sent to each worker process, without the cache
+        state = self.__dict__.copy()
+        state['_directory_cache'] = OrderedDict()
+        return state
+
+    def _tag(self, header, keyword, args, fallbacks):
+        value = getattr(header, keyword)
+        if value is None and args is not None:
+            # e.g. main's --StudyDescription
+            value = getattr(args, keyword, None)
+        if value is None and keyword in self.defaults:
+            value = self.defaults[keyword]
+            if callable(value):
+                value = value()
+                fallbacks.append(keyword)
+        if value is None:
+            raise ValueError('{} missing'.format(keyword))
+        return value
+
+    def _format(self, pieces, values):
+        parts = []
+        for literal, field, format_spec in pieces:
+            parts.append(literal)
+            if field is None:
+                continue
+            function, name = field
+            if name in TEMPLATE_DERIVED:
+                keyword, derive = TEMPLATE_DERIVED[name]
+                value = derive(values[keyword])
+            else:
+                value = values[name]
+            if function is not None:
+                value = TEMPLATE_FUNCTIONS[function](value)
+            parts.append(format(value, format_spec))
+        return self._clean_re.sub('_', ''.join(parts))
+
+    def _directories(self, values):
+        return os.path.join(*[self._format(pieces, values) for pieces in self._components[:-1]])
+
+    def __call__(self, filename, args=None):
+        logger = logging.getLogger(__name__)
+
+        try:
+            header = dicom_header.as_header(filename, tags=self.tags)
+
+            # tags replaced by a generated value(e.g. a new StudyInstanceUID) aren't cached
+            fallbacks = []
+            values = dict((keyword, self._tag(header, keyword, args, fallbacks))
+                          for keyword in self.tags)
+
+            if len(self._components) > 1:
+                if fallbacks:
+                    path = self._directories(values)
+                else:
+                    path = _cached(self._directory_cache,
+                                   tuple(values[keyword]
+                                         for keyword in self._directory_tags),
+                                   lambda: self._directories(values))
+                sorted_filename = os.path.join(
+                    path, self._format(self._components[-1], values))
+            else:
+                sorted_filename = self._format(self._components[-1], values)
+
+        except Exception as e:
+            logger.exception('something wrong with {}'.format(
+                dicom_header.filename_of(filename)))
+            logger.exception(e)
+            return None
+
+        return sorted_filename
+
+
+def compile_sort_rule(template, defaults=None, clean=r'[^a-zA-Z0-9.-]'):
+    '''
+    compile a sort rule from a template of the sorted relative path filename, e.g. CFMM_TEMPLATE:
+
+        {pi}/{project}/{StudyDate}/{patient}/{StudyID}.{hash:StudyInstanceUID}/{SeriesNumber:04d}/...dcm
+
+    fields:
+        {keyword}, {keyword:format_spec}: a dicom_header.HEADER_TAGS tag, e.g. {SeriesNumber:04d}
+        {pi}, {project}: first/second part of StudyDescription('PI^project' or 'PI project')
+        {patient}: PatientName before '^'
+        {hash:name}: 8 hex digits hash of a field, {upper:name}: upper case of a field
+
+    a missing tag is taken from args(the rule's second argument, e.g. main's --StudyDate) if it has
+    an attribute of the same name, then from defaults, otherwise the file is not sorted(None).
+
+    input:
+        template: '/' separated path components, each is cleaned(clean's matches replaced by '_')
+        defaults: {keyword: value, or function returning a value}, e.g. CFMM_DEFAULTS
+        clean: regex of the characters replaced in each path component
+
+    output:
+        TemplateSortRule, a sort rule function. the header reader reads only the tags the template uses
+    '''
+    return TemplateSortRule(template, defaults, clean)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+'''
+per stage instrumentation of a DicomSorter run
+
+    StageStats: wall time, file count, bytes read and bytes written of each stage(extract, scan, dedup,
+                unwrap, tar, ...), and an optional cProfile of one stage
+'''
+
+import time
+import cProfile
+import threading
+import contextlib
+from collections import OrderedDict
+
+STAGE_FIELDS = ('seconds', 'files', 'bytes_read', 'bytes_written')
+
+
+class StageStats(object):
+    '''
+    stage records, in the order stages first ran. a stage run more than once is accumulated
+
+    attributes:
+        profile_stage: stage run under cProfile, None: no profiling
+        profile_filename: pstats file the profile is dumped to, after each run of profile_stage
+
+    Usage:
+        stats = StageStats()
+        with stats.stage('scan'):
+            ...
+            stats.add('scan', files=10, bytes_read=1024)
+        report = stats.report()
+    '''
+
+    def __init__(self, profile_stage=None, profile_filename=None):
+        self.profile_stage = profile_stage
+        self.profile_filename = profile_filename
+        self._stages = OrderedDict()
+        self._lock = threading.Lock()
+        self._profile = None
+
+    def _record(self, name):
+        if name not in self._stages:
+            self._stages[name] = dict((field, 0) for field in STAGE_FIELDS)
+        return self._stages[name]
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        time the block as stage name, under cProfile if name is profile_stage
+        '''
+        profile = None
+        if name == self.profile_stage and self.profile_filename:
+            if self._profile is None:
+                self._profile = cProfile.Profile()
+            profile = self._profile
+            profile.enable()
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(self.profile_filename)
+            with self._lock:
+                self._record(name)['seconds'] += seconds
+
+    def add(self, name, files=0, bytes_read=0, bytes_written=0):
+        with self._lock:
+            record = self._record(name)
+            record['files'] += files
+            record['bytes_read'] += bytes_read
+            record['bytes_written'] += bytes_written
+
+    def report(self):
+        '''
+        output:
+            {'stages': [{'stage': name, 'seconds':..., 'files':..., 'bytes_read':..., 'bytes_written':...}, ...],
+             'seconds': total of the stages}
+        '''
+        with self._lock:
+            stages = []
+            for name, record in self._stages.items():
+                stage = OrderedDict([('stage', name)])
+                stage.update((field, record[field]) for field in STAGE_FIELDS)
+                stages.append(stage)
+
+        return OrderedDict([('stages', stages),
+                            ('seconds', sum(stage['seconds'] for stage in stages))])
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+'''
+a DICOM storage SCP(C-STORE receiver) writing received instances straight into tar files:
+each dataset goes through the sort rule and is appended to its study's tar, nothing is written to a
+dicom_dir first
+
+    StorageReceiver: the SCP, on pynetdicom(optional dependency: pip install pynetdicom)
+    run: command line
+
+Usage:
+    python storage_scp.py output_dir --port 11112 --ae_title DICOM2TAR
+
+    then push with any storage SCU, e.g. pynetdicom's: python -m pynetdicom storescu localhost 11112 dicom_dir -r
+
+Note:
+    non-imaging instances(physio, dicomraw wrapped) are tarred but not unwrapped, there is no .attached.tar
+'''
+
+import os
+import io
+import time
+import tarfile
+import logging
+import argparse
+import threading
+
+import pydicom
+
+try:
+    import pynetdicom
+except ImportError:
+    pynetdicom = None
+
+import dicom_header
+import sort_rules
+import tar_writers
+
+# C-STORE statuses
+STATUS_SUCCESS = 0x0000
+STATUS_CANNOT_UNDERSTAND = 0xC000
+STATUS_OUT_OF_RESOURCES = 0xA700
+
+
+class StorageReceiver(object):
+    '''
+    receive instances, sort and tar them as they arrive
+
+    attributes:
+        output_dir: tar files' directory
+        sort_rule_function: called with each instance's dicom_header.DicomHeader
+        args: sort_rule_function's args, see sort_rule_CFMM
+        depth: leading directories of the sorted path naming a tar file, see DicomSorter.tar()
+        tar_filename_sep: see DicomSorter.tar()
+        ae_title, port: the SCP's AE title and port
+        received: number of instances stored
+        duplicates: number of instances already in their tar(re-sent, or pushed again), skipped
+        tar_full_filenames: tar files written to, in the order first written
+
+    Usage:
+        receiver = StorageReceiver(output_dir, sort_rules.sort_rule_CFMM, args, port=11112)
+        receiver.start(block=False)
+        ...
+        receiver.stop()
+    '''
+
+    def __init__(self, output_dir, sort_rule_function, args, depth=5, tar_filename_sep='_',
+                 ae_title='DICOM2TAR', port=11112, max_open_tars=64):
+        if pynetdicom is None:
+            raise ImportError(
+                'StorageReceiver needs pynetdicom: pip install pynetdicom')
+
+        self.logger = logging.getLogger(__name__)
+        self.output_dir = output_dir
+        self.sort_rule_function = sort_rule_function
+        self.args = args
+        self.depth = depth
+        self.tar_filename_sep = tar_filename_sep
+        self.ae_title = ae_title
+        self.port = port
+        self.received = 0
+        self.duplicates = 0
+        self.tar_full_filenames = []
+
+        # a tar from an earlier run or association is appended to
+        self._writers = tar_writers.TarWriterCache(
+            max_open_tars, append_existing=True)
+        # associations are handled on their own threads
+        self._lock = threading.Lock()
+        self._server = None
+        # association -> tars it wrote to, finalized when it is released
+        self._association_tars = {}
+        # tar -> SOPInstanceUIDs in it
+        self._instances = {}
+
+    def _tar_full_filename(self, relative_path_new_filename):
+        dir_split = relative_path_new_filename.split(os.sep)
+        tar_filename = self.tar_filename_sep.join(dir_split[:self.depth])
+        return os.path.join(self.output_dir, tar_filename + '.tar')
+
+    def _stored_instances(self, tar_full_filename):
+        '''
+        the set of SOPInstanceUIDs in tar_full_filename, read from the tar on disk(an earlier run's) the first
+        time, called with self._lock held
+        '''
+        instances = self._instances.get(tar_full_filename)
+        if instances is not None:
+            return instances
+
+        instances = set()
+        if os.path.exists(tar_full_filename):
+            try:
+                with tarfile.open(tar_full_filename) as tar:
+                    for info in tar:
+                        if not info.isfile():
+                            continue
+                        try:
+                            member = pydicom.dcmread(tar.extractfile(info), stop_before_pixels=True,
+                                                     specific_tags=['SOPInstanceUID'])
+                        except Exception:
+                            continue
+                        if 'SOPInstanceUID' in member:
+                            instances.add(str(member.SOPInstanceUID))
+            except Exception as e:
+                self.logger.warning('{} not read, its instances may be stored twice: {}'.format(
+                    tar_full_filename, e))
+
+        self._instances[tar_full_filename] = instances
+        return instances
+
+    def store(self, dataset, file_meta=None, association=None):
+        '''
+        sort a received dataset and append it to its tar
+
+        input:
+            association: the association it came on, its tars are finalized when it is released
+
+        output:
+            C-STORE status
+        '''
+        if file_meta is not None:
+            dataset.file_meta = file_meta
+        name = dataset.get('SOPInstanceUID', 'unknown')
+
+        try:
+            header = dicom_header.header_from_dataset(dataset, name)
+        except Exception as e:
+            self.logger.exception(e)
+            return STATUS_CANNOT_UNDERSTAND
+
+        relative_path_new_filename = self.sort_rule_function(header, self.args)
+        if relative_path_new_filename is None:
+            self.logger.warning('{} not sorted, rejected'.format(name))
+            return STATUS_CANNOT_UNDERSTAND
+        if header.is_non_imaging:
+            self.logger.info(
+                '{} is non-imaging, tarred without unwrapping'.format(name))
+
+        # the instance as a dicom file, in memory
+        fileobj = io.BytesIO()
+        pydicom.dcmwrite(fileobj, dataset, write_like_original=False)
+        tarinfo = tarfile.TarInfo(relative_path_new_filename)
+        tarinfo.size = fileobj.tell()
+        tarinfo.mtime = time.time()
+        fileobj.seek(0)
+
+        tar_full_filename = self._tar_full_filename(relative_path_new_filename)
+        sop_instance_uid = str(dataset.get('SOPInstanceUID', ''))
+        with self._lock:
+            instances = self._stored_instances(tar_full_filename)
+            if sop_instance_uid and sop_instance_uid in instances:
+                # re-sent(e.g. a retried association), or the study pushed again
+                self.logger.info('{} already in {}, skipped'.format(
+                    name, tar_full_filename))
+                self.duplicates += 1
+                return STATUS_SUCCESS
+
+            try:
+                self._writers.get(tar_full_filename).addfile(tarinfo, fileobj)
+            except Exception as e:
+                self.logger.exception(e)
+                return STATUS_OUT_OF_RESOURCES
+            if sop_instance_uid:
+                instances.add(sop_instance_uid)
+            if tar_full_filename not in self.tar_full_filenames:
+                self.tar_full_filenames.append(tar_full_filename)
+            if association is not None:
+                self._association_tars.setdefault(
+                    association, set()).add(tar_full_filename)
+            self.received += 1
+
+        return STATUS_SUCCESS
+
+    def _handle_store(self, event):
+        return self.store(event.dataset, event.file_meta, event.assoc)
+
+    def _handle_released(self, event):
+        # an association's studies are complete as far as it knows, finalize its tars.
+        # other associations' tars stay open
+        with self._lock:
+            tar_full_filenames = self._association_tars.pop(event.assoc, set())
+        self.flush(tar_full_filenames)
+
+    def flush(self, tar_full_filenames=None):
+        '''
+        finalize open tars, the next instance of a study reopens its tar for appending
+
+        input:
+            tar_full_filenames: the tars to finalize, None: all
+        '''
+        with self._lock:
+            if tar_full_filenames is None:
+                errors = self._writers.close_all()
+                self._association_tars = {}
+            else:
+                errors = {}
+                for tar_full_filename in sorted(tar_full_filenames):
+                    try:
+                        self._writers.close(tar_full_filename)
+                    except Exception as e:
+                        errors[tar_full_filename] = e
+
+            for tar_full_filename, error in errors.items():
+                self.logger.error("tar file failed: {}, {}".format(
+                    tar_full_filename, error))
+
+    def start(self, block=True):
+        '''
+        listen on port, block: serve until interrupted, otherwise serve on a thread until stop()
+        '''
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        ae = pynetdicom.AE(ae_title=self.ae_title)
+        ae.supported_contexts = pynetdicom.AllStoragePresentationContexts + \
+            pynetdicom.VerificationPresentationContexts
+        handlers = [(pynetdicom.evt.EVT_C_STORE, self._handle_store),
+                    (pynetdicom.evt.EVT_RELEASED, self._handle_released),
+                    (pynetdicom.evt.EVT_ABORTED, self._handle_released)]
+
+        self.logger.info('{} listening on port {}'.format(
+            self.ae_title, self.port))
+        try:
+            self._server = ae.start_server(
+                ('', self.port), block=block, evt_handlers=handlers)
+        finally:
+            if block:
+                self.flush()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+        self.flush()
+        self.logger.info('{} instances received into {} tar files, {} duplicates skipped'.format(
+            self.received, len(self.tar_full_filenames), self.duplicates))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="receive dicom instances(C-STORE) into CFMM's tar files")
+    parser.add_argument("output_dir")
+    parser.add_argument("--port", type=int, default=11112)
+    parser.add_argument("--ae_title", default='DICOM2TAR')
+    parser.add_argument("--sort_template",
+                        help="sort with a path template instead of CFMM's rule, see sort_rules.compile_sort_rule")
+    parser.add_argument("--tar_depth", type=int, default=5,
+                        help="number of leading directories of the sorted path naming a tar file")
+    parser.add_argument("--max_open_tars", type=int, default=64)
+    parser.add_argument("--StudyDescription",
+                        nargs='?', default='PI^Project')
+    parser.add_argument("--StudyDate",
+                        nargs='?', default='19000101')
+    parser.add_argument("--PatientName",
+                        nargs='?', default='Anonymous')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s -%(message)s')
+
+    if args.sort_template:
+        sort_rule = sort_rules.compile_sort_rule(
+            args.sort_template, sort_rules.CFMM_DEFAULTS)
+    else:
+        sort_rule = sort_rules.sort_rule_CFMM
+
+    receiver = StorageReceiver(args.output_dir, sort_rule, args, depth=args.tar_depth,
+                               ae_title=args.ae_title, port=args.port, max_open_tars=args.max_open_tars)
+    try:
+        receiver.start(block=True)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+'''
+keep tar files open for writing across many groups, for DicomSorter.tar(stream_tar)
+
+    TarWriterCache: open tar files, at most max_open at a time, the least recently used is closed first
+                    and reopened for appending when needed again
+'''
+
+import os
+import tarfile
+from collections import OrderedDict
+
+
+class TarWriterCache(object):
+    '''
+    open tar files for writing, LRU bounded so file descriptors don't run out across hundreds of tars.
+    a tar is created on its first get(), an evicted tar is reopened in append mode
+
+    attributes:
+        max_open: maximum number of open tar files
+        append_existing: a tar already on disk is appended to, otherwise it is overwritten on its first get()
+        evictions: number of tars closed to make room, each is reopened once used again
+
+    Usage:
+        with TarWriterCache(64) as writers:
+            writers.get('/path/to/a.tar').add(filename, arcname)
+    '''
+
+    def __init__(self, max_open=64, append_existing=False):
+        self.max_open = max(1, max_open)
+        self.append_existing = append_existing
+        self.evictions = 0
+        self._open = OrderedDict()
+        self._created = set()
+
+    def get(self, tar_full_filename):
+        '''
+        the open tarfile.TarFile of tar_full_filename, most recently used
+        '''
+        tar = self._open.pop(tar_full_filename, None)
+        if tar is None:
+            while len(self._open) >= self.max_open:
+                oldest, oldest_tar = self._open.popitem(last=False)
+                oldest_tar.close()
+                self.evictions += 1
+
+            if tar_full_filename in self._created or \
+                    (self.append_existing and os.path.exists(tar_full_filename)):
+                mode = "a"
+            else:
+                mode = "w"
+            tar = tarfile.open(tar_full_filename, mode)
+            self._created.add(tar_full_filename)
+
+        self._open[tar_full_filename] = tar
+        return tar
+
+    def discard(self, tar_full_filename):
+        '''
+        close and remove a tar that failed to write
+        '''
+        tar = self._open.pop(tar_full_filename, None)
+        if tar is not None:
+            try:
+                tar.close()
+            except Exception:
+                pass
+        self._created.discard(tar_full_filename)
+        if os.path.exists(tar_full_filename):
+            os.remove(tar_full_filename)
+
+    def close(self, tar_full_filename):
+        '''
+        finalize a tar
+        '''
+        tar = self._open.pop(tar_full_filename, None)
+        if tar is not None:
+            tar.close()
+
+    def close_all(self):
+        '''
+        finalize every open tar
+
+        output:
+            {tar_full_filename: error} of the tars that failed to close
+        '''
+        errors = OrderedDict()
+        for tar_full_filename in list(self._open):
+            try:
+                self.close(tar_full_filename)
+            except Exception as e:
+                errors[tar_full_filename] = e
+        return errors
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close_all()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+'''
+detect studies that stopped changing in a drop folder, for main's --watch
+
+    TreeWatcher: poll a directory, each subdirectory is a study, complete once it has been quiet
+                 (no file added, removed or modified) for a quiet period
+    merge_tar_groups: each tar of the output directory from the tars of the same name of every study, a study
+                      split over several subdirectories goes into one tar
+'''
+
+import os
+import time
+import shutil
+import logging
+import tarfile
+
+import placement
+
+try:
+    from os import scandir
+except ImportError:
+    # python 2, the scandir package if installed
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def tree_signature(directory):
+    '''
+    (number of files, total size, latest mtime) of the files under directory, changes when a file is
+    added, removed, grows or is rewritten
+
+    a directory vanishing while it is walked counts as empty
+    '''
+    count = 0
+    size = 0
+    mtime = 0
+
+    if scandir is None:
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                try:
+                    file_stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                count += 1
+                size += file_stat.st_size
+                mtime = max(mtime, file_stat.st_mtime)
+        return (count, size, mtime)
+
+    directories = [directory]
+    while directories:
+        try:
+            entries = list(scandir(directories.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                    continue
+                file_stat = entry.stat()
+            except OSError:
+                continue
+            count += 1
+            size += file_stat.st_size
+            mtime = max(mtime, file_stat.st_mtime)
+
+    return (count, size, mtime)
+
+
+def directory_signature(directory):
+    '''
+    (number of directories, number of entries, latest directory mtime) under directory, changes when a file
+    is added, removed or renamed, without a stat of each file. a file rewritten in place doesn't change it
+
+    a directory vanishing while it is walked counts as empty
+    '''
+    count = 0
+    entry_count = 0
+    mtime = 0
+
+    if scandir is None:
+        for root, dirs, files in os.walk(directory):
+            try:
+                mtime = max(mtime, os.stat(root).st_mtime)
+            except OSError:
+                continue
+            count += 1
+            entry_count += len(dirs) + len(files)
+        return (count, entry_count, mtime)
+
+    directories = [directory]
+    while directories:
+        path = directories.pop()
+        try:
+            mtime = max(mtime, os.stat(path).st_mtime)
+            entries = list(scandir(path))
+        except OSError:
+            continue
+        count += 1
+        entry_count += len(entries)
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+            except OSError:
+                continue
+
+    return (count, entry_count, mtime)
+
+
+class TreeWatcher(object):
+    '''
+    studies(subdirectories of dicom_dir) ready to tar: quiet for quiet_period seconds, and changed since
+    they were last done(). a study changing again after done() is reported again once quiet.
+
+    a done study's files aren't stat'ed again until its directory_signature changes(a file added, removed or
+    renamed). files directly in dicom_dir belong to no study, they are logged once and not reported
+
+    attributes:
+        dicom_dir: the drop folder
+        quiet_period: seconds a study must stay unchanged
+
+    Usage:
+        watcher = TreeWatcher('/path/to/dicom_dir', 120)
+        while True:
+            for study_dir in watcher.poll():
+                ...
+                watcher.done(study_dir)
+            time.sleep(10)
+    '''
+
+    def __init__(self, dicom_dir, quiet_period=120):
+        self.logger = logging.getLogger(__name__)
+        self.dicom_dir = dicom_dir
+        self.quiet_period = quiet_period
+        # study_dir -> (signature, time the signature was first seen)
+        self._seen = {}
+        # study_dir -> signature when done()
+        self._done = {}
+        # study_dir -> directory_signature at its last poll(), and when done()
+        self._directories = {}
+        self._done_directories = {}
+        # files directly in dicom_dir already logged
+        self._loose_files = set()
+
+    def _study_dirs(self):
+        study_dirs = []
+        for name in sorted(os.listdir(self.dicom_dir)):
+            full_name = os.path.join(self.dicom_dir, name)
+            if os.path.isdir(full_name):
+                study_dirs.append(full_name)
+        return study_dirs
+
+    def loose_files(self):
+        '''
+        files directly in dicom_dir(dicom or compressed files outside any study), hidden files aside, in name order
+        '''
+        return [os.path.join(self.dicom_dir, name) for name in sorted(os.listdir(self.dicom_dir))
+                if not name.startswith('.') and not os.path.isdir(os.path.join(self.dicom_dir, name))]
+
+    def _log_loose_files(self):
+        loose_files = set(self.loose_files())
+        for full_name in sorted(loose_files - self._loose_files):
+            self.logger.warning(
+                '{} is not in a study subdirectory, not tarred'.format(full_name))
+        self._loose_files = loose_files
+
+    def poll(self, now=None):
+        '''
+        output:
+            the study directories complete since the last poll, in name order
+        '''
+        if now is None:
+            now = time.time()
+
+        study_dirs = self._study_dirs()
+        self._log_loose_files()
+
+        # forget removed studies
+        for study_dir in set(self._seen) - set(study_dirs):
+            del self._seen[study_dir]
+            self._done.pop(study_dir, None)
+            self._directories.pop(study_dir, None)
+            self._done_directories.pop(study_dir, None)
+
+        complete = []
+        for study_dir in study_dirs:
+            directories = directory_signature(study_dir)
+            # done and no file added or removed since: not walked
+            if study_dir in self._done and self._done_directories.get(study_dir) == directories:
+                continue
+            self._directories[study_dir] = directories
+
+            signature = tree_signature(study_dir)
+            if signature[0] == 0:
+                continue
+
+            seen = self._seen.get(study_dir)
+            if seen is None or seen[0] != signature:
+                self._seen[study_dir] = (signature, now)
+                continue
+
+            if now - seen[1] >= self.quiet_period and self._done.get(study_dir) != signature:
+                complete.append(study_dir)
+
+        return complete
+
+    def done(self, study_dir):
+        '''
+        study_dir is tarred as of its last poll()
+        '''
+        self._done[study_dir] = self._seen[study_dir][0]
+        self._done_directories[study_dir] = self._directories[study_dir]
+
+
+# tar file extensions DicomSorter writes, see DicomSorter's compression
+TAR_EXTS = ('.tar', '.tar.gz', '.tar.bz2')
+
+
+def _tar_write_mode(tar_filename):
+    if tar_filename.endswith('.tar.gz'):
+        return 'w:gz'
+    if tar_filename.endswith('.tar.bz2'):
+        return 'w:bz2'
+    return 'w'
+
+
+def merge_tar_groups(parts_dir, output_dir, tar_filenames=None):
+    '''
+    write each tar of output_dir from its parts: the tars of the same name in the study directories of
+    parts_dir(parts_dir/<study>/<tar filename>), so a tar of a study split over several subdirectories holds
+    all of them, and no study overwrites another's tar
+
+    a tar with one part is a hard link to it(a copy where not possible). the parts of a tar with several are
+    copied member by member, in study name order, a member name already written is skipped.
+    a tar is only rewritten if a part changed since
+
+    input:
+        tar_filenames: merge only these tar filenames(no directory), None: all
+
+    output:
+        the tar full filenames written
+    '''
+    logger = logging.getLogger(__name__)
+
+    # tar filename -> its parts, in study name order
+    groups = {}
+    for study in sorted(os.listdir(parts_dir)):
+        study_parts_dir = os.path.join(parts_dir, study)
+        if not os.path.isdir(study_parts_dir):
+            continue
+        for tar_filename in sorted(os.listdir(study_parts_dir)):
+            if tar_filename.endswith(TAR_EXTS) and (tar_filenames is None or tar_filename in tar_filenames):
+                groups.setdefault(tar_filename, []).append(
+                    os.path.join(study_parts_dir, tar_filename))
+
+    written = []
+    for tar_filename in sorted(groups):
+        parts = groups[tar_filename]
+        tar_full_filename = os.path.join(output_dir, tar_filename)
+
+        if len(parts) == 1:
+            if not os.path.exists(tar_full_filename) or not os.path.samefile(parts[0], tar_full_filename):
+                placement.place(parts[0], tar_full_filename, 'hardlink')
+                written.append(tar_full_filename)
+            continue
+
+        if os.path.exists(tar_full_filename) and \
+                not any(os.path.samefile(part, tar_full_filename) for part in parts) and \
+                all(os.path.getmtime(part) <= os.path.getmtime(tar_full_filename) for part in parts):
+            continue
+
+        logger.info('{} holds {} studies: {}'.format(
+            tar_filename, len(parts), ', '.join(os.path.basename(os.path.dirname(part)) for part in parts)))
+        temp_full_filename = tar_full_filename + '.merging'
+        names = set()
+        with tarfile.open(temp_full_filename, _tar_write_mode(tar_filename)) as tar:
+            for part in parts:
+                with tarfile.open(part) as part_tar:
+                    for info in part_tar:
+                        if info.name in names:
+                            continue
+                        names.add(info.name)
+                        tar.addfile(info, part_tar.extractfile(info) if info.isfile() else None)
+        # replace a hard link to a part, not the part
+        if os.path.exists(tar_full_filename):
+            os.remove(tar_full_filename)
+        shutil.move(temp_full_filename, tar_full_filename)
+        written.append(tar_full_filename)
+
+    return written
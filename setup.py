@@ -15,11 +15,13 @@ setuptools.setup(name='dicom2tar',
                  license='GNU General Public License v3.0',
                  entry_points={
                      'console_scripts': [
-                         'dicom2tar = dicom2tar.main:run']},
+                         'dicom2tar = dicom2tar.main:run',
+                         'dicom2tar_scp = dicom2tar.storage_scp:run']},
                  packages=setuptools.find_packages(),
                  install_requires=['pydicom==1.1.0',
                                    'extractCMRRPhysio',
                                    'DicomRaw',
                                    'dcmstack==0.7.0',
                                    'pandas==0.24.1'],
+                 extras_require={'scp': ['pynetdicom']},
                  zip_safe=False)
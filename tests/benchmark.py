@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+'''
+benchmark dicom2tar on synthetic sessions(see synthetic_session.py):
+DicomSorter.tar(), DicomSorter.sort() and the clinical path(main.main --clinical_scans) end to end
+
+each stage runs in its own process, on its own copy of the input, and reports:
+    files: dicom files in the input
+    seconds: wall time of the stage
+    files_per_sec: files / seconds
+    peak_rss_mb: peak resident memory of the stage's process, or of its largest worker process
+
+Usage:
+    python benchmark.py --series 20 --instances 200 --archive zip --non_imaging_fraction 0.1
+    python benchmark.py --stages tar --report tar.json -- --jobs 4 --tar_jobs 2
+
+    options after '--' are passed to dicom2tar, see main.py
+
+    a stage fails if dicom2tar logs an exception or its output is missing(a tar per session for tar and
+    clinical, a sorted file per input file for sort), the benchmark then exits with status 1
+
+Note:
+    the clinical sort rule takes the subject from a 'sub-XXX' directory in the file's path, it skips files
+    extracted from compressed files(--archive).
+    the clinical path splits paths on '\\', it runs on windows only, the clinical stage is skipped elsewhere
+'''
+
+import os
+import sys
+import json
+import time
+import logging
+import shutil
+import inspect
+import argparse
+import tempfile
+import subprocess
+
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+current_dir = os.path.dirname(os.path.abspath(
+    inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.join(os.path.dirname(current_dir), 'dicom2tar'))
+
+import main
+import DicomSorter
+import sort_rules
+import synthetic_session
+
+STAGES = ('tar', 'sort', 'clinical')
+
+
+def peak_rss_mb():
+    '''
+    peak resident memory of this process, or of its largest waited-for child, in MB
+    '''
+    if resource is None:
+        return None
+
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    # bytes on macOS, kilobytes on linux
+    if sys.platform == 'darwin':
+        return rss / (1024.0 * 1024.0)
+    return rss / 1024.0
+
+
+class ExceptionRecords(logging.Handler):
+    '''
+    collect the exceptions logged while installed on the root logger, main.main logs instead of raising
+    '''
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.records = []
+
+    def emit(self, record):
+        if record.exc_info:
+            self.records.append(record.getMessage())
+
+
+def run_stage(stage, dicom_dir, output_dir, dicom2tar_args, placement='copy'):
+    '''
+    run one stage in this process, placement: see DicomSorter's, for the sort stage
+
+    output:
+        {'seconds': wall time, 'peak_rss_mb': see peak_rss_mb}
+
+    raise:
+        RuntimeError if the stage logged an exception
+    '''
+    args = main.build_parser().parse_args(
+        [dicom_dir, output_dir] + dicom2tar_args)
+
+    exceptions = ExceptionRecords()
+    logging.getLogger().addHandler(exceptions)
+
+    start = time.time()
+    if stage == 'tar':
+        main.main(dicom_dir, output_dir, args)
+    elif stage == 'clinical':
+        args.clinical_scans = True
+        main.main(dicom_dir, output_dir, args)
+    elif stage == 'sort':
+        with DicomSorter.DicomSorter(dicom_dir, sort_rules.sort_rule_CFMM, output_dir,
+                                     args, jobs=args.jobs, stream_archives=args.stream_archives,
+                                     unwrap_jobs=args.unwrap_jobs, preambleless=args.preambleless,
+                                     dedup=args.dedup, dedup_verify=args.dedup_verify,
+                                     unwrap_timeout=args.unwrap_timeout, placement=placement) as d:
+            d.sort()
+    else:
+        raise ValueError('stage must be one of {}'.format(STAGES))
+    seconds = time.time() - start
+
+    if exceptions.records:
+        raise RuntimeError('{} stage failed: {}'.format(
+            stage, '; '.join(exceptions.records)))
+
+    return {'seconds': seconds, 'peak_rss_mb': peak_rss_mb()}
+
+
+def check_output(stage, output_dir, generator_kwargs, files):
+    '''
+    output:
+        None if the stage's output is all there, otherwise what is missing
+    '''
+    if stage == 'sort':
+        sorted_files = sum(len(filenames)
+                           for root, dirs, filenames in os.walk(output_dir))
+        if sorted_files < files:
+            return '{} sorted files, expected {}'.format(sorted_files, files)
+        return None
+
+    # a tar per session at least, the clinical path may split a session by modality
+    sessions = generator_kwargs.get('subjects', 1) * generator_kwargs.get('sessions', 1)
+    tars = [name for name in os.listdir(output_dir)
+            if name.endswith('.tar') and not name.endswith('.attached.tar')] if os.path.isdir(output_dir) else []
+    if len(tars) < sessions:
+        return '{} tar files, expected {} at least'.format(len(tars), sessions)
+    return None
+
+
+def benchmark(stages, generator_kwargs, dicom2tar_args, work_dir, placement='copy'):
+    '''
+    generate the input once, run each stage in a child process on a copy of it
+
+    output:
+        list of dict: stage, files, seconds, files_per_sec, peak_rss_mb, log, and
+        error(why the stage failed) or skipped(why it didn't run) if so
+    '''
+    source_dir = os.path.join(work_dir, 'input')
+    files = synthetic_session.generate_sessions(source_dir, **generator_kwargs)
+
+    results = []
+    for stage in stages:
+        if stage == 'clinical' and os.name != 'nt':
+            results.append({'stage': stage, 'files': files,
+                            'skipped': "the clinical path splits paths on '\\', windows only"})
+            continue
+
+        stage_dir = os.path.join(work_dir, stage)
+        dicom_dir = os.path.join(stage_dir, 'input')
+        output_dir = os.path.join(stage_dir, 'output')
+        log_filename = os.path.join(stage_dir, 'log.txt')
+        shutil.copytree(source_dir, dicom_dir)
+
+        with open(log_filename, 'w') as log:
+            try:
+                output = subprocess.check_output(
+                    [sys.executable, os.path.abspath(__file__), '--run_stage', stage, dicom_dir, output_dir,
+                     placement, '--'] + dicom2tar_args, stderr=log)
+            except subprocess.CalledProcessError:
+                results.append({'stage': stage, 'files': files, 'log': log_filename,
+                                'error': 'failed, see {}'.format(log_filename)})
+                continue
+
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        result['stage'] = stage
+        result['files'] = files
+        result['files_per_sec'] = files / \
+            result['seconds'] if result['seconds'] else None
+        result['log'] = log_filename
+        error = check_output(stage, output_dir, generator_kwargs, files)
+        if error is not None:
+            result['error'] = error
+        results.append(result)
+
+    return results
+
+
+def print_results(results):
+    print('{:<10}{:>10}{:>10}{:>12}{:>14}'.format(
+        'stage', 'files', 'seconds', 'files/sec', 'peak_rss_mb'))
+    for result in results:
+        if 'skipped' in result:
+            print('{:<10}{:>10}  skipped: {}'.format(
+                result['stage'], result['files'], result['skipped']))
+            continue
+        if 'error' in result:
+            print('{:<10}{:>10}  FAILED: {}'.format(
+                result['stage'], result['files'], result['error']))
+            continue
+        print('{:<10}{:>10}{:>10.2f}{:>12.1f}{:>14}'.format(
+            result['stage'], result['files'], result['seconds'], result['files_per_sec'] or 0,
+            '{:.1f}'.format(result['peak_rss_mb']) if result['peak_rss_mb'] is not None else 'n/a'))
+
+
+def split_dicom2tar_args(argv):
+    '''
+    argv before '--' is the benchmark's, after is dicom2tar's
+    '''
+    if '--' in argv:
+        i = argv.index('--')
+        return argv[:i], argv[i + 1:]
+    return argv, []
+
+
+def run():
+    argv, dicom2tar_args = split_dicom2tar_args(sys.argv[1:])
+
+    # child process: one stage
+    if argv and argv[0] == '--run_stage':
+        stage, dicom_dir, output_dir, placement = argv[1:5]
+        print(json.dumps(run_stage(stage, dicom_dir,
+                                   output_dir, dicom2tar_args, placement)))
+        return
+
+    parser = argparse.ArgumentParser()
+    synthetic_session.add_arguments(parser)
+    parser.add_argument("--stages", nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument("--placement", choices=DicomSorter.PLACEMENTS, default='copy',
+                        help="how the sort stage places files")
+    parser.add_argument("--work_dir",
+                        help="generated input and outputs, default: a temp directory removed at the end")
+    parser.add_argument("--report", help="write the results to this json file")
+    args = parser.parse_args(argv)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='dicom2tar_benchmark')
+    try:
+        results = benchmark(args.stages, synthetic_session.generator_kwargs(args),
+                            dicom2tar_args, work_dir, args.placement)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+
+    print_results(results)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'generator': synthetic_session.generator_kwargs(args),
+                       'dicom2tar_args': dicom2tar_args,
+                       'results': results}, f, indent=4)
+
+    if any('error' in result for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()
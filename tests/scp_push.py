@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+'''
+test storage_scp.StorageReceiver on one machine: start it on a local port, push dicom files to it with a
+pynetdicom storage SCU, list the tar files it wrote
+
+the files pushed are the dicom files of the zips in tests/data(password protected, set TEST_DATA_ZIP_PASSWORD),
+synthetic instances(see synthetic_session) if none can be read, or the dicom files of --dicom_dir
+
+Usage:
+    python scp_push.py /path/to/output_dir
+    python scp_push.py /path/to/output_dir --dicom_dir /path/to/dicom_dir --port 11113
+
+Note:
+    needs pynetdicom: pip install pynetdicom
+'''
+
+import os
+import io
+import sys
+import inspect
+import logging
+import zipfile
+import argparse
+import tarfile
+
+import pydicom
+import pynetdicom
+
+current_dir = os.path.dirname(os.path.abspath(
+    inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.join(os.path.dirname(current_dir), 'dicom2tar'))
+
+import sort_rules
+import storage_scp
+import synthetic_session
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s -%(message)s')
+
+
+def synthetic_datasets(series=3, instances=5, data_dir=synthetic_session.DATA_DIR, password=None):
+    '''
+    one synthetic session: series x instances, and a siemens CMRR MB physio series
+
+    output:
+        generator of pydicom datasets
+    '''
+    templates = synthetic_session.template_datasets(data_dir, password)
+    for series_number in range(1, series + 1):
+        template = templates[series_number % len(templates)]
+        for instance in range(1, instances + 1):
+            yield synthetic_session.make_instance(template, '001', 1, series_number, instance)
+
+    yield synthetic_session.make_instance(templates[0], '001', 1, series + 1, 1, non_imaging=True)
+
+
+def iter_datasets(dicom_dir=None, data_dir=synthetic_session.DATA_DIR, password=None):
+    '''
+    dicom_dir's dicom files, or the dicom files of the zips in data_dir, or synthetic_datasets if none of
+    them can be read(encrypted, without the password)
+
+    output:
+        generator of pydicom datasets
+    '''
+    if dicom_dir is not None:
+        for root, dirs, files in os.walk(dicom_dir):
+            for name in sorted(files):
+                try:
+                    yield pydicom.read_file(os.path.join(root, name))
+                except Exception:
+                    continue
+        return
+
+    if password is None:
+        password = os.environ.get('TEST_DATA_ZIP_PASSWORD')
+
+    count = 0
+    for zip_filename in synthetic_session.SEED_ZIPS:
+        full_filename = os.path.join(data_dir, zip_filename)
+        if not os.path.exists(full_filename):
+            continue
+
+        with zipfile.ZipFile(full_filename) as z:
+            for info in z.infolist():
+                if info.filename.endswith('/'):
+                    continue
+                try:
+                    data = z.read(info, pwd=password.encode(
+                        'utf-8') if password else None)
+                    dataset = pydicom.read_file(io.BytesIO(data))
+                except Exception:
+                    # encrypted without(or with a wrong) password, or not dicom
+                    continue
+                count += 1
+                yield dataset
+
+    if not count:
+        for dataset in synthetic_datasets(data_dir=data_dir, password=password):
+            yield dataset
+
+
+def push(datasets, port, ae_title='DICOM2TAR'):
+    '''
+    send datasets to localhost:port, one association
+
+    output:
+        number of datasets stored
+    '''
+    ae = pynetdicom.AE(ae_title='SCP_PUSH')
+    datasets = list(datasets)
+    for sop_class_uid in sorted(set(ds.SOPClassUID for ds in datasets)):
+        ae.add_requested_context(sop_class_uid)
+
+    assoc = ae.associate('localhost', port, ae_title=ae_title)
+    if not assoc.is_established:
+        raise RuntimeError('association with localhost:{} failed'.format(port))
+
+    stored = 0
+    try:
+        for ds in datasets:
+            status = assoc.send_c_store(ds)
+            if status and status.Status == storage_scp.STATUS_SUCCESS:
+                stored += 1
+    finally:
+        assoc.release()
+
+    return stored
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_dir")
+    parser.add_argument("--dicom_dir", help="push these files instead of tests/data's")
+    parser.add_argument("--port", type=int, default=11113)
+    args = parser.parse_args()
+
+    # the sort rule's fallback tag values, see main.py
+    sort_args = argparse.Namespace(StudyDescription='PI^Project', StudyDate='19000101',
+                                   PatientName='Anonymous')
+
+    receiver = storage_scp.StorageReceiver(args.output_dir, sort_rules.sort_rule_CFMM, sort_args,
+                                           port=args.port)
+    receiver.start(block=False)
+    try:
+        stored = push(iter_datasets(args.dicom_dir), args.port)
+    finally:
+        receiver.stop()
+
+    print('{} instances stored'.format(stored))
+    for tar_full_filename in receiver.tar_full_filenames:
+        with tarfile.open(tar_full_filename) as tar:
+            print('{}: {} files'.format(tar_full_filename, len(tar.getmembers())))
+
+
+if __name__ == "__main__":
+    run()
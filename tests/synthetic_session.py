@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+'''
+generate synthetic CFMM-style dicom sessions, for benchmarking dicom2tar
+
+    template_datasets: seed datasets, the first dicom file of each anonymized zip in tests/data,
+                       or a small synthetic MR dataset if none can be read
+    generate_session: write one session(series x instances), loose or inside a .zip/.tgz
+    generate_sessions: write subjects x sessions sessions, under sub-XXX directories
+
+Note:
+    the zips in tests/data are password protected, set TEST_DATA_ZIP_PASSWORD to seed from them.
+    non-imaging series are siemens CMRR MB physio files, with a valid encoded log in (0x7fe1,0x1010),
+    so extractCMRRPhysio unwraps them.
+    dicom2tar doesn't look into compressed files inside compressed files, archive_nesting is the number
+    of directory levels above the dicom files, inside the compressed file if any.
+
+Usage:
+    python synthetic_session.py /path/to/output_dir --series 10 --instances 100 --archive zip
+'''
+
+import os
+import io
+import copy
+import struct
+import shutil
+import hashlib
+import tarfile
+import zipfile
+import argparse
+import tempfile
+
+import pydicom
+from pydicom.dataset import Dataset, FileDataset
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+SEED_ZIPS = ('anonymized_GE_data_from_suzanne.zip',
+             'anonymized_philips_data_from_suzanne.zip',
+             'cfmm_GE_older_dicom_tags.zip')
+
+MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+EXPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2.1'
+
+# FileMetaDataset is pydicom>=2.0, older pydicom uses a Dataset
+FileMetaDataset = getattr(pydicom.dataset, 'FileMetaDataset', Dataset)
+
+
+def uid(*values):
+    '''
+    deterministic UID under the 2.25(UUID derived) root
+    '''
+    digest = hashlib.md5('.'.join(str(v) for v in values).encode('utf-8'))
+    return '2.25.{}'.format(int(digest.hexdigest(), 16))
+
+
+def synthetic_dataset(rows=64, columns=64):
+    '''
+    minimal MR dataset with rows x columns 16 bits pixel data
+    '''
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = MR_IMAGE_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = uid('synthetic')
+    file_meta.TransferSyntaxUID = EXPLICIT_VR_LITTLE_ENDIAN
+
+    dataset = FileDataset('synthetic.dcm', {},
+                          file_meta=file_meta, preamble=b'\0' * 128)
+    dataset.is_little_endian = True
+    dataset.is_implicit_VR = False
+    dataset.SOPClassUID = MR_IMAGE_STORAGE
+    dataset.Manufacturer = 'GE MEDICAL SYSTEMS'
+    dataset.Modality = 'MR'
+    dataset.Rows = rows
+    dataset.Columns = columns
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = 'MONOCHROME2'
+    dataset.BitsAllocated = 16
+    dataset.BitsStored = 16
+    dataset.HighBit = 15
+    dataset.PixelRepresentation = 0
+    dataset.PixelData = os.urandom(rows * columns * 2)
+
+    return dataset
+
+
+def template_datasets(data_dir=DATA_DIR, password=None):
+    '''
+    seed datasets: the first dicom file of each anonymized zip in data_dir
+
+    input:
+        data_dir: directory of SEED_ZIPS
+        password: zips' password, default: $TEST_DATA_ZIP_PASSWORD
+
+    output:
+        list of pydicom datasets, [synthetic_dataset()] if no zip can be read
+    '''
+    if password is None:
+        password = os.environ.get('TEST_DATA_ZIP_PASSWORD')
+
+    templates = []
+    for zip_filename in SEED_ZIPS:
+        full_filename = os.path.join(data_dir, zip_filename)
+        if not os.path.exists(full_filename):
+            continue
+
+        try:
+            with zipfile.ZipFile(full_filename) as z:
+                for info in z.infolist():
+                    if info.filename.endswith('/'):
+                        continue
+                    data = z.read(info, pwd=password.encode(
+                        'utf-8') if password else None)
+                    try:
+                        templates.append(pydicom.read_file(io.BytesIO(data)))
+                        break
+                    except Exception:
+                        continue
+        except Exception:
+            # encrypted without(or with a wrong) password
+            continue
+
+    if not templates:
+        templates.append(synthetic_dataset())
+
+    return templates
+
+
+def physio_payload(log_filename, log_data):
+    '''
+    (0x7fe1,0x1010) value of a CMRR MB physio dicom, holding one log file, see extractCMRRPhysio
+    '''
+    log_filename = log_filename.encode('utf-8')
+    log_data = log_data.encode('utf-8')[:1024]
+    part = struct.pack('<II', len(log_data), len(log_filename)) + log_filename
+    part += b'\0' * (1024 - len(part)) + log_data
+    return part + b'\0' * (2048 - len(part))
+
+
+def make_instance(template, subject, session, series, instance, non_imaging=False):
+    '''
+    a copy of template, as one instance of subject's session
+
+    output:
+        pydicom dataset
+    '''
+    dataset = copy.deepcopy(template)
+
+    study_instance_uid = uid(subject, session)
+    sop_instance_uid = uid(subject, session, series, instance)
+
+    # one study date per session, CFMM's patient name: 2019_01_02_C001
+    study_date = '2019{:02d}{:02d}'.format(1 + session // 28 % 12, 1 + session % 28)
+    dataset.StudyDescription = 'Khan^NeuroAnalytics'
+    dataset.StudyDate = study_date
+    dataset.PatientName = '{}_{}_{}_C{}'.format(
+        study_date[:4], study_date[4:6], study_date[6:], subject)
+    dataset.StudyID = str(session)
+    dataset.StudyInstanceUID = study_instance_uid
+    dataset.SeriesInstanceUID = uid(subject, session, series)
+    dataset.SeriesNumber = series
+    dataset.SeriesDescription = 'series_{}'.format(series)
+    dataset.InstanceNumber = instance
+    dataset.SOPInstanceUID = sop_instance_uid
+    dataset.file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    dataset.ImageType = ['ORIGINAL', 'PRIMARY', 'M']
+
+    if non_imaging:
+        # siemens CMRR MB physio
+        dataset.ImageType = ['ORIGINAL', 'PRIMARY', 'RAWDATA', 'PHYSIO']
+        # payload is rows(AcquisitionNumber) x 1024 columns per log file
+        dataset.AcquisitionNumber = 2
+        dataset.add_new((0x7fe1, 0x0010), 'LO', 'SIEMENS CSA NON-IMAGE')
+        dataset.add_new((0x7fe1, 0x1010), 'OB', physio_payload(
+            'Physio_{}_{}_RESP.log'.format(series, instance), 'ACQ_TIME_TICS RESP\n0 2048\n'))
+        if 'PixelData' in dataset:
+            del dataset.PixelData
+
+    return dataset
+
+
+def generate_session(output_dir, subject='001', session=1, series=10, instances=100,
+                     non_imaging_fraction=0.0, archive=None, archive_nesting=0, templates=None):
+    '''
+    write one session
+
+    input:
+        output_dir: session is written under it
+        subject, session: subject label, session number
+        series, instances: number of series, instances per series
+        non_imaging_fraction: fraction of series that are CMRR MB physio
+        archive: None(loose files), 'zip' or 'tgz', the session in one compressed file
+        archive_nesting: directory levels above the dicom files
+        templates: see template_datasets, series i uses templates[i % len(templates)]
+
+    output:
+        number of dicom files written
+    '''
+    if templates is None:
+        templates = template_datasets()
+
+    non_imaging_series = int(round(series * non_imaging_fraction))
+
+    session_name = 'ses-{:03d}'.format(session)
+    if archive:
+        session_dir = tempfile.mkdtemp(prefix='synthetic_session')
+    else:
+        session_dir = os.path.join(output_dir, session_name)
+
+    nesting_dir = os.path.join(session_dir, *(['d{}'.format(i)
+                                               for i in range(archive_nesting)] or ['']))
+
+    count = 0
+    for series_number in range(1, series + 1):
+        # the last series are non-imaging
+        non_imaging = series_number > series - non_imaging_series
+        series_dir = os.path.join(nesting_dir, '{:04d}'.format(series_number))
+        if not os.path.exists(series_dir):
+            os.makedirs(series_dir)
+
+        template = templates[series_number % len(templates)]
+        for instance in range(1, (1 if non_imaging else instances) + 1):
+            dataset = make_instance(
+                template, subject, session, series_number, instance, non_imaging)
+            pydicom.write_file(os.path.join(series_dir, '{:05d}.dcm'.format(instance)),
+                               dataset, write_like_original=False)
+            count += 1
+
+    if archive == 'zip':
+        with zipfile.ZipFile(os.path.join(output_dir, session_name + '.zip'), 'w') as z:
+            for root, directories, filenames in os.walk(session_dir):
+                for filename in filenames:
+                    full_filename = os.path.join(root, filename)
+                    z.write(full_filename, os.path.join(session_name,
+                                                        os.path.relpath(full_filename, session_dir)))
+        shutil.rmtree(session_dir)
+    elif archive == 'tgz':
+        with tarfile.open(os.path.join(output_dir, session_name + '.tgz'), 'w:gz') as t:
+            t.add(session_dir, session_name)
+        shutil.rmtree(session_dir)
+
+    return count
+
+
+def generate_sessions(output_dir, subjects=1, sessions=1, **kwargs):
+    '''
+    write subjects x sessions sessions, to output_dir/sub-XXX/
+
+    input:
+        kwargs: see generate_session
+
+    output:
+        number of dicom files written
+    '''
+    if 'templates' not in kwargs or kwargs['templates'] is None:
+        kwargs['templates'] = template_datasets()
+
+    count = 0
+    for subject in range(1, subjects + 1):
+        subject_dir = os.path.join(output_dir, 'sub-{:03d}'.format(subject))
+        if not os.path.exists(subject_dir):
+            os.makedirs(subject_dir)
+        for session in range(1, sessions + 1):
+            count += generate_session(subject_dir, '{:03d}'.format(subject), session, **kwargs)
+
+    return count
+
+
+def add_arguments(parser):
+    '''
+    generator options, shared with benchmark.py
+    '''
+    parser.add_argument("--subjects", type=int, default=1)
+    parser.add_argument("--sessions", type=int, default=1,
+                        help="sessions per subject")
+    parser.add_argument("--series", type=int, default=10,
+                        help="series per session")
+    parser.add_argument("--instances", type=int, default=100,
+                        help="instances per imaging series")
+    parser.add_argument("--non_imaging_fraction", type=float, default=0.0,
+                        help="fraction of series that are CMRR MB physio")
+    parser.add_argument("--archive", choices=['zip', 'tgz'],
+                        help="write each session into a compressed file")
+    parser.add_argument("--archive_nesting", type=int, default=0,
+                        help="directory levels above the dicom files")
+
+
+def generator_kwargs(args):
+    return dict(subjects=args.subjects, sessions=args.sessions, series=args.series,
+                instances=args.instances, non_imaging_fraction=args.non_imaging_fraction,
+                archive=args.archive, archive_nesting=args.archive_nesting)
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_dir')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    count = generate_sessions(args.output_dir, **generator_kwargs(args))
+    print('{} dicom files written to {}'.format(count, args.output_dir))
+
+
+if __name__ == "__main__":
+    run()
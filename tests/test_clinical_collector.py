@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+'''
+test the rows a sort rule collects(clinical_collector.ClinicalCollector) in DicomSorter's worker processes:
+they reach clinical_helpers.combine_or_dates/combine_error_info_tsv, and a warm pool kept across runs(main's
+--watch) sends them again for a later run
+
+sort_rule_clinical only parses windows paths, a sort rule collecting the same kind of rows stands in for it.
+the dicom files are synthetic, see synthetic_session
+
+Usage:
+    python -m pytest test_clinical_collector.py
+    python test_clinical_collector.py
+'''
+
+import os
+import csv
+import sys
+import shutil
+import inspect
+import tempfile
+import multiprocessing
+
+current_dir = os.path.dirname(os.path.abspath(
+    inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.join(os.path.dirname(current_dir), 'dicom2tar'))
+
+import DicomSorter
+import clinical_helpers
+import clinical_collector
+import synthetic_session
+
+SUBJECTS = 2
+SERIES = 2
+INSTANCES = 10
+
+
+def collecting_sort_rule(header, args):
+    '''
+    an error row per series, an OR date row per subject and study date, like sort_rule_clinical's
+    '''
+    subject = 'P' + str(header.PatientName)[-3:]
+    study_date = str(header.StudyDate)
+    collecting_sort_rule.collector.add_error(
+        [subject, study_date, '{:04d}'.format(int(header.SeriesNumber))])
+    collecting_sort_rule.collector.add_or_date([subject, study_date])
+    return os.path.join(subject, header.SOPInstanceUID + '.dcm')
+
+
+collecting_sort_rule.collector = clinical_collector.ClinicalCollector()
+
+
+def expected_rows():
+    '''
+    (error rows, OR date rows) of the synthetic sessions, set of tuples
+    '''
+    # synthetic_session.make_instance's study date of session 1
+    study_date = '20190102'
+    subjects = ['P{:03d}'.format(subject) for subject in range(1, SUBJECTS + 1)]
+    return (set((subject, study_date, '{:04d}'.format(series))
+                for subject in subjects for series in range(1, SERIES + 1)),
+            set((subject, study_date) for subject in subjects))
+
+
+def read_tsv(filename):
+    with open(filename, 'r') as f:
+        reader = csv.reader(f, delimiter='\t')
+        next(reader, None)
+        return set(tuple(row) for row in reader)
+
+
+def run_sorter(dicom_dir, output_dir, pool):
+    '''
+    tar dicom_dir with collecting_sort_rule, parsing on pool, as main does for each study
+
+    output:
+        the main process' collector
+    '''
+    collector = collecting_sort_rule.collector
+    collector.clear()
+    with DicomSorter.DicomSorter(dicom_dir, collecting_sort_rule, output_dir, None,
+                                 jobs=2, chunksize=2, pool=pool) as d:
+        d.tar(1)
+    return collector
+
+
+def generate(tmp_dir):
+    dicom_dir = os.path.join(tmp_dir, 'dicom')
+    output_dir = os.path.join(tmp_dir, 'tar')
+    os.makedirs(output_dir)
+    synthetic_session.generate_sessions(dicom_dir, subjects=SUBJECTS, series=SERIES, instances=INSTANCES,
+                                        templates=[synthetic_session.synthetic_dataset(8, 8)])
+    return dicom_dir, output_dir
+
+
+def test_worker_rows_reach_tsv_files():
+    tmp_dir = tempfile.mkdtemp(prefix='test_clinical_collector')
+    cwd = os.getcwd()
+    pool = multiprocessing.Pool(2)
+    try:
+        dicom_dir, output_dir = generate(tmp_dir)
+        collector = run_sorter(dicom_dir, output_dir, pool)
+
+        # the tsv files are written next to tar_dir's windows parent directory, the working directory here
+        os.chdir(tmp_dir)
+        clinical_helpers.combine_or_dates(dicom_dir, output_dir, collector)
+        clinical_helpers.combine_error_info_tsv(dicom_dir, output_dir, collector)
+
+        error_rows, or_date_rows = expected_rows()
+        assert read_tsv(os.path.join(tmp_dir, 'errorInfo.tsv')) == error_rows
+        assert read_tsv(os.path.join(tmp_dir, 'or_dates.tsv')) == or_date_rows
+    finally:
+        os.chdir(cwd)
+        pool.close()
+        pool.join()
+        shutil.rmtree(tmp_dir)
+
+
+def test_warm_pool_rows_sent_again():
+    tmp_dir = tempfile.mkdtemp(prefix='test_clinical_collector')
+    pool = multiprocessing.Pool(2)
+    try:
+        dicom_dir, output_dir = generate(tmp_dir)
+        error_rows, or_date_rows = expected_rows()
+
+        # a study tarred again(changed since) by the same workers
+        for run in range(2):
+            collector = run_sorter(dicom_dir, output_dir, pool)
+            assert collector.error_rows == error_rows, run
+            assert collector.or_date_rows == or_date_rows, run
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(tmp_dir)
+
+
+def test_drain_forgets_rows():
+    collector = clinical_collector.ClinicalCollector()
+    collector.add_error(['P001', '2019_01_02', '0003'])
+    collector.add_error(['P001', '2019_01_02', '0003'])
+    assert collector.drain() == ([('P001', '2019_01_02', '0003')], [])
+    assert collector.drain() == ([], [])
+
+    collector.add_error(['P001', '2019_01_02', '0003'])
+    assert collector.drain() == ([('P001', '2019_01_02', '0003')], [])
+
+
+if __name__ == "__main__":
+    test_worker_rows_reach_tsv_files()
+    test_warm_pool_rows_sent_again()
+    test_drain_forgets_rows()
+    print('ok')
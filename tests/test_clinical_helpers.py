@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+'''
+test clinical_helpers.assign_sessions: a subject's tars numbered in date order, an .attached.tar(non-imaging)
+numbered with its imaging tar, not as a session of its own
+
+Usage:
+    python -m pytest test_clinical_helpers.py
+    python test_clinical_helpers.py
+'''
+
+import os
+import sys
+import inspect
+
+current_dir = os.path.dirname(os.path.abspath(
+    inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.join(os.path.dirname(current_dir), 'dicom2tar'))
+
+import clinical_helpers
+
+TAR_DIR = os.path.join(os.sep, 'tar')
+
+
+def tar(subject, date, attached=False):
+    # DicomSorter.tar()'s clinical tar name: subject_yyyy_mm_dd_date_modality
+    return os.path.join(TAR_DIR, '{}_{}_{}_{}_{}_MR{}'.format(
+        subject, date[:4], date[4:6], date[6:], date, '.attached.tar' if attached else '.tar'))
+
+
+def test_attached_tar_shares_session():
+    sessions = clinical_helpers.assign_sessions([tar('P001', '20190102'),
+                                                 tar('P001', '20190102', attached=True)])
+
+    assert sessions == {tar('P001', '20190102'): '001',
+                        tar('P001', '20190102', attached=True): '001'}
+
+
+def test_sessions_by_date():
+    # scan order isn't date order, an attached tar listed before its imaging tar
+    sessions = clinical_helpers.assign_sessions([tar('P001', '20190305', attached=True),
+                                                 tar('P002', '20190102'),
+                                                 tar('P001', '20190305'),
+                                                 tar('P001', '20190102')])
+
+    assert list(sessions.items()) == [(tar('P001', '20190102'), '001'),
+                                      (tar('P001', '20190305'), '002'),
+                                      (tar('P001', '20190305', attached=True), '002'),
+                                      (tar('P002', '20190102'), '001')]
+
+
+if __name__ == "__main__":
+    test_attached_tar_shares_session()
+    test_sessions_by_date()
+    print('ok')
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+'''
+test siemens CMRR MB physio extraction in process(cmrr_physio): the .log files are written without falling
+back to the extractCMRRPhysio command
+
+the physio files are the CMRR MB physio dicoms in tests/data/MRS_Physio_data if present, otherwise a
+synthetic one(see synthetic_session.make_instance)
+
+Usage:
+    python -m pytest test_cmrr_physio.py
+    python test_cmrr_physio.py
+'''
+
+import os
+import sys
+import shutil
+import inspect
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(
+    inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.join(os.path.dirname(current_dir), 'dicom2tar'))
+
+import DicomSorter
+import dicom_header
+import cmrr_physio
+import sort_rules
+import synthetic_session
+
+PHYSIO_DATA_DIR = os.path.join(synthetic_session.DATA_DIR, 'MRS_Physio_data')
+
+SYNTHETIC_LOG_FILENAME = 'Physio_7_1_RESP.log'
+SYNTHETIC_LOG_DATA = b'ACQ_TIME_TICS RESP\n0 2048\n'
+
+
+def synthetic_physio_file(to_dir):
+    '''
+    a synthetic CMRR MB physio dicom file(series 7, instance 1) in to_dir, holding SYNTHETIC_LOG_FILENAME
+    '''
+    dataset = synthetic_session.make_instance(
+        synthetic_session.synthetic_dataset(8, 8), '001', 1, 7, 1, non_imaging=True)
+    full_filename = os.path.join(to_dir, 'physio.dcm')
+    dataset.save_as(full_filename, write_like_original=False)
+    return full_filename
+
+
+def physio_files(to_dir):
+    '''
+    real CMRR MB physio dicom files if any, otherwise one synthetic file written to to_dir
+
+    output:
+        list of (filename, expected log filenames or None if unknown)
+    '''
+    files = []
+    for root, dirs, filenames in os.walk(PHYSIO_DATA_DIR):
+        for filename in sorted(filenames):
+            full_filename = os.path.join(root, filename)
+            try:
+                header = dicom_header.read_header(full_filename)
+            except Exception:
+                continue
+            if header.is_siemens_CMRR_MB_physio:
+                files.append((full_filename, None))
+    if files:
+        return files
+
+    return [(synthetic_physio_file(to_dir), [SYNTHETIC_LOG_FILENAME])]
+
+
+def test_unwrap_in_process():
+    tmp_dir = tempfile.mkdtemp(prefix='test_cmrr_physio')
+    try:
+        with DicomSorter.DicomSorter(tmp_dir, sort_rules.sort_rule_CFMM, os.path.join(tmp_dir, 'out'),
+                                     None) as d:
+            # any fallback to the extractCMRRPhysio command fails the test
+            def no_fallback(cmd):
+                raise AssertionError('fell back to {}'.format(cmd))
+            d._run_unwrap_command = no_fallback
+
+            for filename, expected_logs in physio_files(tmp_dir):
+                header = dicom_header.read_header(filename)
+                assert header.is_siemens_CMRR_MB_physio, filename
+
+                output_directory = d._check_non_imaging_and_unwrap(
+                    filename, header)
+                assert output_directory, filename
+
+                logs = sorted(os.listdir(output_directory))
+                assert logs and all(log.endswith('.log')
+                                    for log in logs), logs
+                if expected_logs is not None:
+                    assert logs == expected_logs, logs
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_unwrap_synthetic_content():
+    tmp_dir = tempfile.mkdtemp(prefix='test_cmrr_physio')
+    try:
+        log_filenames = cmrr_physio.unwrap(
+            cmrr_physio.read_physio_dataset(synthetic_physio_file(tmp_dir)), tmp_dir)
+        assert log_filenames == [os.path.join(tmp_dir, SYNTHETIC_LOG_FILENAME)]
+        with open(log_filenames[0], 'rb') as f:
+            assert f.read() == SYNTHETIC_LOG_DATA
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    test_unwrap_in_process()
+    test_unwrap_synthetic_content()
+    print('ok')
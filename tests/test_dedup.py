@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+'''
+test main's --dedup/--dedup_verify: the first of duplicate instances is kept, a duplicate with different
+content(--dedup_verify) is kept renamed name.conflict_<sha1>.dcm, an identical duplicate is dropped silently
+
+dicom_dir/a is a synthetic session(see synthetic_session), dicom_dir/b holds a duplicate of its first file,
+scanned after it
+
+Usage:
+    python -m pytest test_dedup.py
+    python test_dedup.py
+'''
+
+import os
+import re
+import sys
+import shutil
+import inspect
+import logging
+import tarfile
+import tempfile
+
+import pydicom
+
+current_dir = os.path.dirname(os.path.abspath(
+    inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.join(os.path.dirname(current_dir), 'dicom2tar'))
+
+import main
+import synthetic_session
+
+SERIES = 2
+INSTANCES = 2
+
+
+class WarningRecords(logging.Handler):
+    '''
+    collect the warnings logged while installed on the root logger
+    '''
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record.getMessage())
+
+
+def run_dedup(duplicate, dedup_args):
+    '''
+    tar dicom_dir/a alone, then dicom_dir/a and a duplicate of its first file in dicom_dir/b
+
+    input:
+        duplicate: function(pydicom dataset of the first file), changes the dataset written to dicom_dir/b,
+                   None: a copy of the file
+        dedup_args: main's --dedup arguments
+
+    output:
+        (tar members of a alone, {tar member: content} of a and b with dedup_args, warnings logged)
+    '''
+    tmp_dir = tempfile.mkdtemp(prefix='test_dedup')
+    try:
+        session_dir = os.path.join(tmp_dir, 'dicom', 'a')
+        synthetic_session.generate_sessions(session_dir, series=SERIES, instances=INSTANCES,
+                                            templates=[synthetic_session.synthetic_dataset(8, 8)])
+        first_filename = sorted(os.path.join(root, filename)
+                                for root, dirs, filenames in os.walk(session_dir) for filename in filenames)[0]
+
+        reference_dir = os.path.join(tmp_dir, 'reference')
+        main.main(session_dir, reference_dir, main.build_parser().parse_args(
+            [session_dir, reference_dir]))
+        reference_members = tar_members(reference_dir)
+
+        duplicate_dir = os.path.join(tmp_dir, 'dicom', 'b')
+        os.makedirs(duplicate_dir)
+        if duplicate is None:
+            shutil.copy(first_filename, os.path.join(duplicate_dir, 'duplicate.dcm'))
+        else:
+            dataset = pydicom.read_file(first_filename)
+            duplicate(dataset)
+            dataset.save_as(os.path.join(duplicate_dir, 'duplicate.dcm'))
+
+        dicom_dir = os.path.join(tmp_dir, 'dicom')
+        output_dir = os.path.join(tmp_dir, 'tar')
+        warnings = WarningRecords()
+        logging.getLogger().addHandler(warnings)
+        try:
+            main.main(dicom_dir, output_dir, main.build_parser().parse_args(
+                [dicom_dir, output_dir] + dedup_args))
+        finally:
+            logging.getLogger().removeHandler(warnings)
+
+        return reference_members, tar_members(output_dir), warnings.records
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def tar_members(output_dir):
+    '''
+    {member name: content} of the only tar in output_dir
+    '''
+    tars = [name for name in os.listdir(output_dir) if name.endswith('.tar')]
+    assert len(tars) == 1, tars
+    with tarfile.open(os.path.join(output_dir, tars[0])) as t:
+        return dict((info.name, t.extractfile(info).read()) for info in t.getmembers() if info.isfile())
+
+
+def test_sop_instance_uid_keeps_first():
+    # same SOPInstanceUID, sorted under another instance number
+    def renumber(dataset):
+        dataset.InstanceNumber = INSTANCES + 10
+
+    reference_members, members, warnings = run_dedup(
+        renumber, ['--dedup', 'SOPInstanceUID'])
+    assert members == reference_members
+
+    # not a duplicate by sorted filename
+    reference_members, members, warnings = run_dedup(
+        renumber, ['--dedup', 'sorted'])
+    assert len(members) == len(reference_members) + 1
+
+
+def test_sorted_verify_keeps_conflict():
+    # same sorted filename, different content
+    def change(dataset):
+        dataset.StationName = 'changed'
+
+    reference_members, members, warnings = run_dedup(
+        change, ['--dedup', 'sorted', '--dedup_verify'])
+
+    conflicts = [name for name in members if name not in reference_members]
+    assert len(conflicts) == 1, conflicts
+    # name.conflict_<sha1[:8]>.dcm, next to the kept name.dcm
+    kept_name = re.sub(r'\.conflict_[0-9a-f]{8}(\.[^.]*)$', r'\1', conflicts[0])
+    assert kept_name != conflicts[0] and kept_name in reference_members, conflicts
+    assert members[kept_name] == reference_members[kept_name]
+    assert dict((name, members[name]) for name in reference_members) == reference_members
+    assert any('conflicting duplicate' in warning for warning in warnings), warnings
+
+
+def test_identical_duplicate_dropped_silently():
+    reference_members, members, warnings = run_dedup(
+        None, ['--dedup', 'sorted', '--dedup_verify'])
+
+    assert members == reference_members
+    assert not any('duplicate' in warning for warning in warnings), warnings
+
+
+if __name__ == "__main__":
+    test_sop_instance_uid_keeps_first()
+    test_sorted_verify_keeps_conflict()
+    test_identical_duplicate_dropped_silently()
+    print('ok')
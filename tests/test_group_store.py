@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+'''
+test memory-bounded grouping(group_store.GroupStore, DicomSorter's group_memory_limit): with a limit of 1 byte
+every scan result is spilled to disk, the tars written are the same as grouping in memory
+
+the dicom files are synthetic(see synthetic_session), loose files and a zip
+
+Usage:
+    python -m pytest test_group_store.py
+    python test_group_store.py
+'''
+
+import os
+import sys
+import shutil
+import inspect
+import tarfile
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(
+    inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.join(os.path.dirname(current_dir), 'dicom2tar'))
+
+import main
+import DicomSorter
+import sort_rules
+import group_store
+import archive_stream
+import synthetic_session
+
+
+def tar_contents(output_dir):
+    '''
+    {tar filename: [(member name, content), ...] in tar order}
+    '''
+    contents = {}
+    for name in sorted(os.listdir(output_dir)):
+        if name.endswith('.tar'):
+            with tarfile.open(os.path.join(output_dir, name)) as t:
+                contents[name] = [(info.name, t.extractfile(info).read())
+                                  for info in t.getmembers() if info.isfile()]
+    return contents
+
+
+def run_tar(dicom_dir, output_dir, group_memory_limit):
+    os.makedirs(output_dir)
+    args = main.build_parser().parse_args([dicom_dir, output_dir])
+    with DicomSorter.DicomSorter(dicom_dir, sort_rules.sort_rule_CFMM, output_dir, args,
+                                 stream_archives=True, group_memory_limit=group_memory_limit) as d:
+        d.tar(args.tar_depth)
+    return tar_contents(output_dir)
+
+
+def test_spilled_tars_match_in_memory():
+    tmp_dir = tempfile.mkdtemp(prefix='test_group_store')
+    try:
+        dicom_dir = os.path.join(tmp_dir, 'dicom')
+        templates = [synthetic_session.synthetic_dataset(8, 8)]
+        synthetic_session.generate_session(os.path.join(dicom_dir, 'sub-001'), '001', 1, series=2, instances=3,
+                                           non_imaging_fraction=0.5, templates=templates)
+        os.makedirs(os.path.join(dicom_dir, 'sub-002'))
+        synthetic_session.generate_session(os.path.join(dicom_dir, 'sub-002'), '002', 1, series=2, instances=3,
+                                           archive='zip', templates=templates)
+
+        in_memory = run_tar(dicom_dir, os.path.join(tmp_dir, 'in_memory'), None)
+        spilled = run_tar(dicom_dir, os.path.join(tmp_dir, 'spilled'), 1)
+
+        # a tar per subject, and the non-imaging series' attached tar
+        assert len(in_memory) == 3, sorted(in_memory)
+        assert spilled == in_memory
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_spill_keeps_entries():
+    tmp_dir = tempfile.mkdtemp(prefix='test_group_store')
+    try:
+        member = archive_stream.ArchiveMember(
+            os.path.join(tmp_dir, 'study.zip'), 'a/00001.dcm', 10, 0.0)
+        added = [('b.tar', os.path.join(tmp_dir, 'a', '00001.dcm'), os.path.join('x', '1.dcm'), 'uid1'),
+                 ('a.tar', member, os.path.join('y', '1.dcm'), None),
+                 # unicode, a separate type from str on python 2
+                 ('b.tar', u'{}'.format(os.path.join(tmp_dir, u'é', '00002.dcm')),
+                  os.path.join('x', '2.dcm'), 'uid2')]
+
+        with group_store.GroupStore(1, tmp_dir) as store:
+            for group, original, sorted_filename, key in added:
+                store.add(group, original, sorted_filename, key)
+
+            assert store.spill_count == len(added)
+            assert store.keys() == ['b.tar', 'a.tar']
+            for group in store.keys():
+                assert list(store.entries(group)) == [entry[1:] for entry in added if entry[0] == group]
+                assert store.count(group) == len([entry for entry in added if entry[0] == group])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    test_spilled_tars_match_in_memory()
+    test_spill_keeps_entries()
+    print('ok')
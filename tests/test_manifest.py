@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+'''
+test main's --incremental re-runs and the manifest(manifest.Manifest): unchanged files aren't parsed again,
+a file with a new mtime is, a removed file leaves its tar's rows, a run only replaces the rows under its
+dicom_dir
+
+the dicom files are synthetic, see synthetic_session
+
+Usage:
+    python -m pytest test_manifest.py
+    python test_manifest.py
+'''
+
+import os
+import sys
+import shutil
+import inspect
+import tarfile
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(
+    inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.join(os.path.dirname(current_dir), 'dicom2tar'))
+
+import main
+import manifest
+import DicomSorter
+import synthetic_session
+
+SERIES = 2
+INSTANCES = 3
+
+
+class IncrementalRun(object):
+    '''
+    a synthetic session in a temp directory, run with --incremental, counting the files parsed per run
+    '''
+
+    def __init__(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='test_manifest')
+        self.dicom_dir = os.path.join(self.tmp_dir, 'dicom')
+        self.output_dir = os.path.join(self.tmp_dir, 'tar')
+        synthetic_session.generate_sessions(self.dicom_dir, series=SERIES, instances=INSTANCES,
+                                            templates=[synthetic_session.synthetic_dataset(8, 8)])
+        self.parsed = []
+
+    def run(self):
+        '''
+        output:
+            filenames parsed by the run
+        '''
+        self.parsed = []
+        apply_sort_rule = DicomSorter._apply_sort_rule
+
+        def counting_apply_sort_rule(full_filename, *args, **kwargs):
+            self.parsed.append(str(full_filename))
+            return apply_sort_rule(full_filename, *args, **kwargs)
+
+        DicomSorter._apply_sort_rule = counting_apply_sort_rule
+        try:
+            main.main(self.dicom_dir, self.output_dir, main.build_parser().parse_args(
+                [self.dicom_dir, self.output_dir, '--incremental']))
+        finally:
+            DicomSorter._apply_sort_rule = apply_sort_rule
+        return self.parsed
+
+    def dicom_files(self):
+        return sorted(os.path.join(root, filename)
+                      for root, dirs, filenames in os.walk(self.dicom_dir) for filename in filenames)
+
+    def tar(self):
+        tars = [name for name in os.listdir(self.output_dir) if name.endswith('.tar')]
+        assert len(tars) == 1, tars
+        return os.path.join(self.output_dir, tars[0])
+
+    def manifest(self):
+        return manifest.Manifest(os.path.join(self.output_dir, '.dicom2tar_manifest.sqlite'))
+
+    def close(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+def test_unchanged_rerun_skips_parsing():
+    run = IncrementalRun()
+    try:
+        assert len(run.run()) == SERIES * INSTANCES
+        with tarfile.open(run.tar()) as t:
+            members = sorted(t.getnames())
+
+        assert run.run() == []
+        with tarfile.open(run.tar()) as t:
+            assert sorted(t.getnames()) == members
+    finally:
+        run.close()
+
+
+def test_changed_mtime_reparses():
+    run = IncrementalRun()
+    try:
+        run.run()
+        touched = run.dicom_files()[0]
+        file_stat = os.stat(touched)
+        os.utime(touched, (file_stat.st_atime, file_stat.st_mtime + 10))
+
+        assert run.run() == [touched]
+    finally:
+        run.close()
+
+
+def test_removed_file_drops_tar_row():
+    run = IncrementalRun()
+    try:
+        run.run()
+        removed = run.dicom_files()[0]
+        with run.manifest() as m:
+            assert removed in m.tar_paths(run.tar())
+
+        os.remove(removed)
+        assert run.run() == []
+
+        with run.manifest() as m:
+            tar_paths = m.tar_paths(run.tar())
+            assert removed not in tar_paths
+            assert removed not in m.paths()
+            assert tar_paths == set(run.dicom_files())
+        with tarfile.open(run.tar()) as t:
+            assert len(t.getnames()) == SERIES * INSTANCES - 1
+    finally:
+        run.close()
+
+
+def test_update_root_keeps_other_roots():
+    tmp_dir = tempfile.mkdtemp(prefix='test_manifest')
+    try:
+        def row(path, tar):
+            return (path, None, None, 1, 1.0, None, 'sorted', tar, None)
+
+        study_a = os.path.join(tmp_dir, 'a')
+        # a prefix of study_ab's path, its rows aren't study_a's
+        study_ab = os.path.join(tmp_dir, 'ab')
+        a_tar = os.path.join(tmp_dir, 'a.tar')
+        ab_tar = os.path.join(tmp_dir, 'ab.tar')
+
+        with manifest.Manifest(os.path.join(tmp_dir, 'manifest.sqlite')) as m:
+            m.update([row(os.path.join(study_a, '1.dcm'), a_tar),
+                      row(os.path.join(study_ab, '1.dcm'), ab_tar)], [])
+
+            m.update([row(os.path.join(study_a, '2.dcm'), a_tar)], [], root=study_a)
+
+            assert m.paths() == set([os.path.join(study_a, '2.dcm'),
+                                     os.path.join(study_ab, '1.dcm')])
+            assert m.paths(study_a) == set([os.path.join(study_a, '2.dcm')])
+            assert m.tar_paths(ab_tar) == set([os.path.join(study_ab, '1.dcm')])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    test_unchanged_rerun_skips_parsing()
+    test_changed_mtime_reparses()
+    test_removed_file_drops_tar_row()
+    test_update_root_keeps_other_roots()
+    print('ok')
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+'''
+test main's --shard i/N with more shards than tar files: a shard owning no tar is done and writes its report,
+--merge_shards finds every tar once and no shard missing, in each tar mode(list, --stream_tar,
+--group_memory_limit, --plan then --execute)
+
+the dicom files are synthetic, see synthetic_session
+
+Usage:
+    python -m pytest test_shards.py
+    python test_shards.py
+'''
+
+import os
+import sys
+import shutil
+import inspect
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(
+    inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.join(os.path.dirname(current_dir), 'dicom2tar'))
+
+import main
+import shards
+import synthetic_session
+
+SUBJECTS = 2
+SHARDS = 5
+
+TAR_MODES = {'list': [],
+             'stream_tar': ['--stream_tar'],
+             'group_memory_limit': ['--group_memory_limit', '1'],
+             'execute': None}
+
+
+def run_shards(dicom_dir, output_dir, mode_args):
+    '''
+    run every shard of SHARDS into output_dir, mode_args None: --plan once, --execute in each shard
+
+    output:
+        --merge_shards' merged report
+    '''
+    parser = main.build_parser()
+    plan_filename = os.path.join(os.path.dirname(output_dir), 'plan.json')
+    if mode_args is None:
+        main.main(dicom_dir, output_dir, parser.parse_args(
+            [dicom_dir, output_dir, '--plan', plan_filename]))
+
+    for index in range(SHARDS):
+        shard_args = ['--shard', '{}/{}'.format(index, SHARDS)]
+        if mode_args is None:
+            shard_args += ['--execute', plan_filename]
+        else:
+            shard_args += mode_args
+        main.main(dicom_dir, output_dir, parser.parse_args(
+            [dicom_dir, output_dir] + shard_args))
+
+    return main.merge_shards(output_dir)
+
+
+def check_mode(mode):
+    tmp_dir = tempfile.mkdtemp(prefix='test_shards')
+    try:
+        dicom_dir = os.path.join(tmp_dir, 'dicom')
+        output_dir = os.path.join(tmp_dir, 'tar')
+        # one tar per subject
+        synthetic_session.generate_sessions(dicom_dir, subjects=SUBJECTS, series=2, instances=2,
+                                            templates=[synthetic_session.synthetic_dataset(8, 8)])
+
+        merged = run_shards(dicom_dir, output_dir, TAR_MODES[mode])
+
+        assert merged['done'] == list(range(SHARDS)), merged
+        assert merged['missing'] == [], merged
+        assert merged['errors'] == [], merged
+        assert merged['overlapping'] == [], merged
+        assert len(merged['tars']) == SUBJECTS, merged
+        assert sorted(os.path.basename(tar) for tar in merged['tars']) == \
+            sorted(name for name in os.listdir(output_dir) if name.endswith('.tar'))
+        assert os.path.exists(os.path.join(
+            output_dir, shards.MERGED_REPORT_FILENAME))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_empty_shards_list():
+    check_mode('list')
+
+
+def test_empty_shards_stream_tar():
+    check_mode('stream_tar')
+
+
+def test_empty_shards_group_memory_limit():
+    check_mode('group_memory_limit')
+
+
+def test_empty_shards_execute():
+    check_mode('execute')
+
+
+if __name__ == "__main__":
+    for mode in TAR_MODES:
+        check_mode(mode)
+    print('ok')
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+'''
+test main's --plan then --execute: the plan is read back as written, executing it(without dicom_dir) writes
+the same tars as the default mode, --execute_tars writes only the ones named, and planning leaves the
+DicomSorter's stream_archives as it was
+
+the dicom files are synthetic(see synthetic_session), loose files of two subjects, a non-imaging series and
+a zip
+
+Usage:
+    python -m pytest test_sort_plan.py
+    python test_sort_plan.py
+'''
+
+import os
+import sys
+import shutil
+import inspect
+import tarfile
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(
+    inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.join(os.path.dirname(current_dir), 'dicom2tar'))
+
+import main
+import sort_plan
+import sort_rules
+import DicomSorter
+import synthetic_session
+
+
+def tar_members(output_dir):
+    '''
+    {tar filename: sorted [(member name, content), ...]}
+    '''
+    members = {}
+    for name in os.listdir(output_dir):
+        if name.endswith('.tar'):
+            with tarfile.open(os.path.join(output_dir, name)) as t:
+                members[name] = sorted((info.name, t.extractfile(info).read())
+                                       for info in t.getmembers() if info.isfile())
+    return members
+
+
+def generate(tmp_dir):
+    dicom_dir = os.path.join(tmp_dir, 'dicom')
+    templates = [synthetic_session.synthetic_dataset(8, 8)]
+    synthetic_session.generate_sessions(dicom_dir, subjects=2, series=3, instances=2,
+                                        non_imaging_fraction=0.34, templates=templates)
+    synthetic_session.generate_session(os.path.join(dicom_dir, 'sub-001'), '001', 2, series=2, instances=2,
+                                       archive='zip', templates=templates)
+    return dicom_dir
+
+
+def test_plan_execute_round_trip():
+    tmp_dir = tempfile.mkdtemp(prefix='test_sort_plan')
+    try:
+        dicom_dir = generate(tmp_dir)
+        parser = main.build_parser()
+        plan_filename = os.path.join(tmp_dir, 'plan.json')
+
+        # planning reads the zip in memory, the sorter's mode isn't changed for a later tar()
+        plan_dir = os.path.join(tmp_dir, 'plan')
+        os.makedirs(plan_dir)
+        with DicomSorter.DicomSorter(dicom_dir, sort_rules.sort_rule_CFMM, plan_dir,
+                                     parser.parse_args([dicom_dir, plan_dir])) as d:
+            plan = d.plan(5)
+            assert d.stream_archives is False
+        assert os.listdir(plan_dir) == []
+
+        sort_plan.write_plan(plan_filename, plan)
+        assert sort_plan.read_plan(plan_filename) == plan
+
+        default_dir = os.path.join(tmp_dir, 'default')
+        main.main(dicom_dir, default_dir, parser.parse_args([dicom_dir, default_dir]))
+        default = tar_members(default_dir)
+
+        # the plan's files are read, no dicom_dir
+        execute_dir = os.path.join(tmp_dir, 'execute')
+        args = parser.parse_args([execute_dir, '--execute', plan_filename])
+        assert args.dicom_dir is None
+        main.main(args.dicom_dir, execute_dir, args)
+
+        # a tar and an attached tar per loose session, a tar for the zipped session
+        assert len(default) == 5, sorted(default)
+        assert tar_members(execute_dir) == default
+
+        # one tar of the plan, e.g. a failed one
+        tar_name = sorted(plan['tars'])[0]
+        subset_dir = os.path.join(tmp_dir, 'subset')
+        args = parser.parse_args([subset_dir, '--execute', plan_filename, '--execute_tars', tar_name])
+        main.main(args.dicom_dir, subset_dir, args)
+        subset = tar_members(subset_dir)
+        assert tar_name + '.tar' in subset
+        for name in subset:
+            assert subset[name] == default[name], name
+
+        # dicom_dir is only optional with --execute
+        args = parser.parse_args([os.path.join(tmp_dir, 'none')])
+        assert main.main(args.dicom_dir, args.output_dir, args) is False
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    test_plan_execute_round_trip()
+    print('ok')
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+test main's --sort_template: compile_sort_rule(CFMM_TEMPLATE, CFMM_DEFAULTS) sorts as sort_rule_CFMM does,
+including headers missing StudyID or SeriesDescription, and a non-ASCII PatientName
+
+the headers are synthetic, see synthetic_session
+
+Usage:
+    python -m pytest test_sort_template.py
+    python test_sort_template.py
+'''
+
+import os
+import sys
+import shutil
+import inspect
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(
+    inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.join(os.path.dirname(current_dir), 'dicom2tar'))
+
+import main
+import sort_rules
+import dicom_header
+import synthetic_session
+
+
+def no_study_id(dataset):
+    del dataset.StudyID
+
+
+def no_series_description(dataset):
+    del dataset.SeriesDescription
+
+
+def non_ascii_patient_name(dataset):
+    dataset.SpecificCharacterSet = 'ISO_IR 192'
+    dataset.PatientName = u'Müller^Jörg'
+
+
+def ge_study_description(dataset):
+    # CFMM's older GE data: 'PI project'
+    dataset.StudyDescription = 'Khan NeuroAnalytics'
+
+
+CHANGES = [None, no_study_id, no_series_description,
+           non_ascii_patient_name, ge_study_description]
+
+
+def synthetic_headers(to_dir):
+    '''
+    a header of each CHANGES applied to a synthetic instance, read back from a file written to to_dir
+    '''
+    headers = []
+    for index, change in enumerate(CHANGES):
+        dataset = synthetic_session.make_instance(
+            synthetic_session.synthetic_dataset(8, 8), '001', 1, 3, index + 1)
+        if change is not None:
+            change(dataset)
+        full_filename = os.path.join(to_dir, '{}.dcm'.format(index))
+        dataset.save_as(full_filename, write_like_original=False)
+        headers.append(dicom_header.read_header(full_filename))
+    return headers
+
+
+def test_cfmm_template_parity():
+    tmp_dir = tempfile.mkdtemp(prefix='test_sort_template')
+    try:
+        args = main.build_parser().parse_args([tmp_dir, tmp_dir])
+        template_rule = sort_rules.compile_sort_rule(
+            sort_rules.CFMM_TEMPLATE, sort_rules.CFMM_DEFAULTS)
+
+        for change, header in zip(CHANGES, synthetic_headers(tmp_dir)):
+            expected = sort_rules.sort_rule_CFMM(header, args)
+            assert expected is not None, change
+            assert template_rule(header, args) == expected, change
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    test_cfmm_template_parity()
+    print('ok')
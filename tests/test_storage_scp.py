@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+'''
+test storage_scp.StorageReceiver: instances pushed to an in-process SCP are in their study's tar once, a
+re-sent instance or the study pushed again(a later run appending to the same tar) isn't stored twice
+
+the instances are synthetic, see synthetic_session. needs pynetdicom, skipped without it
+
+Usage:
+    python -m pytest test_storage_scp.py
+    python test_storage_scp.py
+'''
+
+import os
+import sys
+import shutil
+import socket
+import inspect
+import argparse
+import tarfile
+import tempfile
+
+import pytest
+
+pytest.importorskip('pynetdicom')
+
+current_dir = os.path.dirname(os.path.abspath(
+    inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.join(os.path.dirname(current_dir), 'dicom2tar'))
+
+import sort_rules
+import storage_scp
+import synthetic_session
+import scp_push
+
+SERIES = 2
+INSTANCES = 3
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind(('', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
+def datasets():
+    template = synthetic_session.synthetic_dataset(8, 8)
+    return [synthetic_session.make_instance(template, '001', 1, series, instance)
+            for series in range(1, SERIES + 1) for instance in range(1, INSTANCES + 1)]
+
+
+def receive(output_dir, pushes):
+    '''
+    start a receiver, push each of pushes(a list of datasets, one association each), stop
+
+    output:
+        the stopped receiver
+    '''
+    # the sort rule's fallback tag values, see main.py
+    args = argparse.Namespace(StudyDescription='PI^Project', StudyDate='19000101',
+                              PatientName='Anonymous')
+    port = free_port()
+    receiver = storage_scp.StorageReceiver(output_dir, sort_rules.sort_rule_CFMM, args, port=port)
+    receiver.start(block=False)
+    try:
+        for pushed in pushes:
+            assert scp_push.push(pushed, port) == len(pushed)
+    finally:
+        receiver.stop()
+    return receiver
+
+
+def tar_members(output_dir):
+    '''
+    {tar filename: [member name, ...]}, in tar order
+    '''
+    members = {}
+    for name in os.listdir(output_dir):
+        if name.endswith('.tar'):
+            with tarfile.open(os.path.join(output_dir, name)) as t:
+                members[name] = [info.name for info in t.getmembers() if info.isfile()]
+    return members
+
+
+def test_push_twice_stored_once():
+    tmp_dir = tempfile.mkdtemp(prefix='test_storage_scp')
+    try:
+        output_dir = os.path.join(tmp_dir, 'tar')
+        pushed = datasets()
+
+        # an instance re-sent on the same association, then the study pushed again on another
+        receiver = receive(output_dir, [pushed + pushed[:1], pushed])
+        assert receiver.received == len(pushed)
+        assert receiver.duplicates == len(pushed) + 1
+
+        members = tar_members(output_dir)
+        assert len(members) == 1, sorted(members)
+        names = list(members.values())[0]
+        assert len(names) == len(pushed)
+        assert len(set(names)) == len(names)
+
+        # a later run appends to the tar, what it already holds is skipped
+        receiver = receive(output_dir, [pushed])
+        assert receiver.received == 0
+        assert receiver.duplicates == len(pushed)
+        assert tar_members(output_dir) == members
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    test_push_twice_stored_once()
+    print('ok')
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+'''
+test main's --stream_tar: tars written while scanning, with at most --max_open_tars open(1: each tar closed
+and reopened for appending as the scan moves between subjects), have the same members as the default mode
+
+the dicom files are synthetic(see synthetic_session), loose files of several subjects, a non-imaging series,
+a zip, and a series away from the rest of its session
+
+Usage:
+    python -m pytest test_stream_tar.py
+    python test_stream_tar.py
+'''
+
+import os
+import sys
+import shutil
+import inspect
+import tarfile
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(
+    inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.join(os.path.dirname(current_dir), 'dicom2tar'))
+
+import main
+import synthetic_session
+
+
+def tar_members(output_dir):
+    '''
+    {tar filename: sorted [(member name, content), ...]}
+    '''
+    members = {}
+    for name in os.listdir(output_dir):
+        if name.endswith('.tar'):
+            with tarfile.open(os.path.join(output_dir, name)) as t:
+                members[name] = sorted((info.name, t.extractfile(info).read())
+                                       for info in t.getmembers() if info.isfile())
+    return members
+
+
+def run_main(dicom_dir, output_dir, options):
+    main.main(dicom_dir, output_dir, main.build_parser().parse_args(
+        [dicom_dir, output_dir] + options))
+    return tar_members(output_dir)
+
+
+def test_stream_tar_max_open_tars_1():
+    tmp_dir = tempfile.mkdtemp(prefix='test_stream_tar')
+    try:
+        dicom_dir = os.path.join(tmp_dir, 'dicom')
+        templates = [synthetic_session.synthetic_dataset(8, 8)]
+        synthetic_session.generate_sessions(dicom_dir, subjects=3, series=3, instances=2,
+                                            non_imaging_fraction=0.34, templates=templates)
+        synthetic_session.generate_session(os.path.join(dicom_dir, 'sub-001'), '001', 2, series=2, instances=2,
+                                           archive='zip', templates=templates)
+        # a series of the first session scanned last, its tar is reopened after the other subjects'
+        os.makedirs(os.path.join(dicom_dir, 'sub-004'))
+        shutil.move(os.path.join(dicom_dir, 'sub-001', 'ses-001', '0001'),
+                    os.path.join(dicom_dir, 'sub-004', '0001'))
+
+        default = run_main(dicom_dir, os.path.join(tmp_dir, 'default'), [])
+        streamed = run_main(dicom_dir, os.path.join(tmp_dir, 'stream_tar'),
+                            ['--stream_tar', '--max_open_tars', '1'])
+
+        # a tar and an attached tar per loose session, a tar for the zipped session
+        assert len(default) == 7, sorted(default)
+        assert sorted(streamed) == sorted(default)
+        for name in default:
+            assert [member for member, content in streamed[name]] == \
+                [member for member, content in default[name]], name
+            assert streamed[name] == default[name], name
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    test_stream_tar_max_open_tars_1()
+    print('ok')
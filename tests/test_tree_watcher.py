@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+'''
+test main's --watch: tree_watcher.TreeWatcher.poll() on a fake clock(a study is complete once quiet, a done
+study isn't walked again until a file is added), loose files in the drop folder, and a study split over two
+subdirectories tarred into one tar
+
+the dicom files are synthetic, see synthetic_session
+
+Usage:
+    python -m pytest test_tree_watcher.py
+    python test_tree_watcher.py
+'''
+
+import os
+import sys
+import shutil
+import inspect
+import tarfile
+import tempfile
+
+current_dir = os.path.dirname(os.path.abspath(
+    inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.join(os.path.dirname(current_dir), 'dicom2tar'))
+
+import main
+import tree_watcher
+import synthetic_session
+
+QUIET_PERIOD = 60
+
+
+def write(full_filename, data=b'dicom'):
+    if not os.path.exists(os.path.dirname(full_filename)):
+        os.makedirs(os.path.dirname(full_filename))
+    with open(full_filename, 'wb') as f:
+        f.write(data)
+
+
+def test_poll_fake_clock():
+    dicom_dir = tempfile.mkdtemp(prefix='test_tree_watcher')
+    walked = []
+    tree_signature = tree_watcher.tree_signature
+
+    def counting_tree_signature(directory):
+        walked.append(directory)
+        return tree_signature(directory)
+
+    tree_watcher.tree_signature = counting_tree_signature
+    try:
+        study_a = os.path.join(dicom_dir, 'a')
+        study_b = os.path.join(dicom_dir, 'b')
+        write(os.path.join(study_a, '0001', '1.dcm'))
+        os.makedirs(study_b)
+
+        watcher = tree_watcher.TreeWatcher(dicom_dir, QUIET_PERIOD)
+
+        # first seen, an empty study is never complete
+        assert watcher.poll(now=0) == []
+        assert watcher.poll(now=QUIET_PERIOD - 1) == []
+
+        # a file added restarts the quiet period
+        write(os.path.join(study_a, '0001', '2.dcm'))
+        assert watcher.poll(now=QUIET_PERIOD) == []
+        assert watcher.poll(now=2 * QUIET_PERIOD - 1) == []
+        assert watcher.poll(now=2 * QUIET_PERIOD) == [study_a]
+
+        # not done yet: reported again
+        assert watcher.poll(now=2 * QUIET_PERIOD + 1) == [study_a]
+        watcher.done(study_a)
+
+        # done: not reported, not walked
+        del walked[:]
+        assert watcher.poll(now=3 * QUIET_PERIOD) == []
+        assert study_a not in walked
+
+        # changed after done: walked, reported again once quiet
+        write(os.path.join(study_a, '0002', '1.dcm'))
+        assert watcher.poll(now=3 * QUIET_PERIOD + 1) == []
+        assert study_a in walked
+        assert watcher.poll(now=4 * QUIET_PERIOD + 1) == [study_a]
+    finally:
+        tree_watcher.tree_signature = tree_signature
+        shutil.rmtree(dicom_dir)
+
+
+def test_loose_files():
+    tmp_dir = tempfile.mkdtemp(prefix='test_tree_watcher')
+    try:
+        dicom_dir = os.path.join(tmp_dir, 'dicom')
+        write(os.path.join(dicom_dir, 'a', '1.dcm'))
+        write(os.path.join(dicom_dir, '.hidden'))
+
+        watcher = tree_watcher.TreeWatcher(dicom_dir, QUIET_PERIOD)
+        assert watcher.loose_files() == []
+
+        write(os.path.join(dicom_dir, 'study.zip'))
+        assert watcher.loose_files() == [os.path.join(dicom_dir, 'study.zip')]
+
+        # refused at start
+        args = main.build_parser().parse_args(
+            [dicom_dir, os.path.join(tmp_dir, 'tar'), '--watch'])
+        assert main.watch(dicom_dir, os.path.join(tmp_dir, 'tar'), args, polls=1) is False
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_split_study_one_tar():
+    tmp_dir = tempfile.mkdtemp(prefix='test_tree_watcher')
+    try:
+        dicom_dir = os.path.join(tmp_dir, 'dicom')
+        output_dir = os.path.join(tmp_dir, 'tar')
+        templates = [synthetic_session.synthetic_dataset(8, 8)]
+        synthetic_session.generate_session(os.path.join(tmp_dir, 'session'), '001', 1, series=2, instances=2,
+                                           templates=templates)
+        # the study's series in two subdirectories(studies to the watcher), and a study of its own
+        os.makedirs(dicom_dir)
+        shutil.move(os.path.join(tmp_dir, 'session', 'ses-001', '0001'),
+                    os.path.join(dicom_dir, 'a'))
+        shutil.move(os.path.join(tmp_dir, 'session', 'ses-001', '0002'),
+                    os.path.join(dicom_dir, 'b'))
+        synthetic_session.generate_session(os.path.join(dicom_dir, 'c'), '002', 1, series=1, instances=2,
+                                           templates=templates)
+
+        args = main.build_parser().parse_args(
+            [dicom_dir, output_dir, '--watch', '--quiet_period', '0', '--poll_interval', '0'])
+        # first poll: seen, second: complete
+        main.watch(dicom_dir, output_dir, args, polls=2)
+
+        tars = sorted(name for name in os.listdir(output_dir) if name.endswith('.tar'))
+        assert len(tars) == 2, tars
+        counts = []
+        for name in tars:
+            with tarfile.open(os.path.join(output_dir, name)) as t:
+                counts.append(len([info for info in t.getmembers() if info.isfile()]))
+        # subject 001: both series of a and b, subject 002: c's
+        assert counts == [4, 2], counts
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    test_poll_fake_clock()
+    test_loose_files()
+    test_split_study_one_tar()
+    print('ok')